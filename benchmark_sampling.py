@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the samplings of the perturbations, see
+eustace.random_streams.SAMPLINGS, by how many perturbations they need
+for the std of the perturbed surface temperatures of a pixel,
+i.e. std(p.surface_temp - s.surface_temp), to reach a relative standard
+error.
+
+The pixels are drawn uniformly over the ranges of the algorithms. The
+std of each pixel is estimated with a number of perturbations, for a
+number of random seeds, and compared with the std from many random
+perturbations.
+"""
+import numpy as np
+import eustace.coefficients
+import eustace.perturbation
+import eustace.random_streams
+import eustace.sigmas
+import eustace.surface_temperature
+import logging
+import datetime
+import warnings
+
+LOG = logging.getLogger(__name__)
+
+
+def get_pixels(number_of_pixels, random_seed=0):
+    """
+    Pixels over the ranges of the algorithms, t11, t12, t37, t_clim,
+    sun and satellite zenith angles.
+    """
+    random_state = np.random.RandomState(random_seed)
+    t11 = random_state.uniform(235.0, 285.0, number_of_pixels)
+    t12 = t11 - random_state.uniform(0.0, 2.0, number_of_pixels)
+    t37 = t11 + random_state.uniform(-1.0, 3.0, number_of_pixels)
+    t_clim = t11 + random_state.uniform(-1.0, 1.0, number_of_pixels)
+    sun_zenith_angle = random_state.uniform(40.0, 130.0, number_of_pixels)
+    sat_zenith_angle = random_state.uniform(0.0, 60.0, number_of_pixels)
+    return t11, t12, t37, t_clim, sun_zenith_angle, sat_zenith_angle
+
+
+def get_stds(coeff, sigmas, pixels, number_of_perturbations, sampling, random_seed):
+    """
+    The std of the perturbed surface temperatures of each pixel.
+    """
+    t11, t12, t37, t_clim, sun_zenith_angle, sat_zenith_angle = pixels
+    streams = eustace.random_streams.RandomStreams(coeff.sat_id, "benchmark",
+                                                   random_seed, sampling)
+    buffers = eustace.perturbation.PerturbationBuffers(len(t11), number_of_perturbations)
+    block = eustace.perturbation.perturb(coeff, buffers, t11, t12, t37, t_clim,
+                                         sigmas["sigma_11"], sigmas["sigma_12"],
+                                         sigmas["sigma_37"], sun_zenith_angle,
+                                         sat_zenith_angle,
+                                         streams.for_pixels(np.arange(len(t11)),
+                                                            np.zeros(len(t11), dtype=np.int64)))
+    # Pixels with less than two perturbed surface temperatures have no std.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanstd(block.surface_temp, axis=1, ddof=1)
+
+
+def get_number_of_perturbations(numbers_of_perturbations, relative_errors, target):
+    """
+    The number of perturbations reaching the target relative error,
+    interpolated in log-log, or None if not reached.
+    """
+    log_n = np.log(numbers_of_perturbations)
+    log_e = np.log(relative_errors)
+    if relative_errors[-1] > target:
+        return None
+    if relative_errors[0] <= target:
+        return numbers_of_perturbations[0]
+    i = np.nonzero(np.array(relative_errors) <= target)[0][0]
+    w = (np.log(target) - log_e[i - 1]) / (log_e[i] - log_e[i - 1])
+    return np.exp(log_n[i - 1] + w * (log_n[i] - log_n[i - 1]))
+
+
+if __name__ == "__main__":
+    import docopt
+    __doc__ = """
+File: {filename}
+
+Usage:
+  {filename} [<satellite-id>] [-d|-v] [options]
+  {filename} (-h | --help)
+  {filename} --version
+
+Options:
+  -h --help                       Show this screen.
+  --version                       Show version.
+  -v --verbose                    Show some diagostics.
+  -d --debug                      Show some more diagostics.
+  --number-of-pixels=<pixels>     The number of pixels, [default: 500].
+  --perturbations=<list>          The numbers of perturbations, [default: 4,8,16,32,64,128,256,512].
+  --reference-perturbations=<N>   The number of random perturbations of the reference std, [default: 8192].
+  --repetitions=<repetitions>     The number of random seeds, [default: 10].
+  --target=<relative-error>       The relative standard error of the std to reach, [default: 0.05].
+""".format(filename=__file__)
+    args = docopt.docopt(__doc__, version='0.1')
+    if args["--debug"]:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args["--verbose"]:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+    LOG.info(args)
+
+    satellite_id = args["<satellite-id>"] or "noaa18"
+    numbers_of_perturbations = [int(n) for n in args["--perturbations"].split(",")]
+    repetitions = int(args["--repetitions"])
+    target = float(args["--target"])
+    sigmas = eustace.sigmas.get_sigmas(satellite_id)
+    pixels = get_pixels(int(args["--number-of-pixels"]))
+
+    with eustace.coefficients.Coefficients(satellite_id) as coeff:
+        algorithms = eustace.surface_temperature.select_surface_temperature_algorithms(
+            pixels[4], pixels[0], pixels[2])
+        st = eustace.surface_temperature.get_surface_temperatures(algorithms, coeff, *pixels)
+        has_st = ~np.isnan(st)
+        pixels = [values[has_st] for values in pixels]
+
+        reference = get_stds(coeff, sigmas, pixels, int(args["--reference-perturbations"]),
+                             "random", 0)
+        has_std = reference > 0
+
+        print "%s, %i pixels, %i repetitions, relative standard error of the std per pixel." % (
+            satellite_id, has_std.sum(), repetitions)
+        print "%-8s %s %14s %10s" % ("sampling", " ".join(["%7s" % ("N=%i" % n)
+                                                           for n in numbers_of_perturbations]),
+                                     "N(%.3f)" % (target), "seconds")
+        needed = {}
+        for sampling in eustace.random_streams.SAMPLINGS:
+            start_time = datetime.datetime.now()
+            relative_errors = []
+            for number_of_perturbations in numbers_of_perturbations:
+                errors = []
+                for random_seed in range(1, repetitions + 1):
+                    stds = get_stds(coeff, sigmas, pixels, number_of_perturbations,
+                                    sampling, random_seed)
+                    errors.append((stds[has_std] - reference[has_std]) / reference[has_std])
+                relative_errors.append(np.sqrt(np.nanmean(np.square(errors))))
+            needed[sampling] = get_number_of_perturbations(numbers_of_perturbations,
+                                                           relative_errors, target)
+            print "%-8s %s %14s %10.1f" % (
+                sampling, " ".join(["%7.4f" % (e) for e in relative_errors]),
+                "-" if needed[sampling] is None else "%.0f" % (needed[sampling]),
+                (datetime.datetime.now() - start_time).total_seconds())
+
+        for sampling in ["lhs", "sobol"]:
+            if needed[sampling] is not None and needed["random"] is not None:
+                print "%s needs %.1fx fewer perturbations than random." % (
+                    sampling, needed["random"] / needed[sampling])
@@ -17,6 +17,7 @@ import pylab
 # Own.
 import eustace.surface_temperature
 import models.avhrr_hdf5
+import models.climatology
 import coefficients
 import eustace.db
 
@@ -37,6 +38,7 @@ Options:
   -v --verbose                      Show some diagostics.
   -d --debug                        Show some more diagostics.
   --number-of-perturbations = NoP   The number of perturbations per pixel, [default: 10].
+  --climatology=<filename>          A netCDF file with a gridded SST climatology, used for t_clim.
 """.format(filename=__file__)
     args = docopt.docopt(__doc__, version='0.1')
     print args
@@ -54,6 +56,8 @@ Options:
                                     args["<sunsatangle-filename>"],
                                     args["<cloudmask-filename>"]) as avhrr_model:
             print avhrr_model
+            climatology_field = models.climatology.get_climatology(
+                args["--climatology"]).get_field(avhrr_model.swath_datetime.month)
             assert(avhrr_model.lat.shape == avhrr_model.lon.shape)
             resulting_st_K = np.ma.masked_all_like(avhrr_model.lat)
             errors = np.ma.masked_all_like(avhrr_model.lat)
@@ -125,14 +129,16 @@ Options:
                             sun_zenith_angle = float(avhrr_model.sun_zenith_angle[row_index, col_index])
                             sat_zenith_angle = float(avhrr_model.sat_zenith_angle[row_index, col_index])
 
-                            # Missing climatology
-                            t_clim_K = t11_K
-
                             lat = avhrr_model.lat[row_index, col_index]
                             lon = avhrr_model.lon[row_index, col_index]
                             if lat is None or np.isnan(lat) or lon is None or np.isnan(lon):
                                 continue
 
+                            # The climatology, or T11 if missing.
+                            t_clim_K = climatology_field.get_t_clim(np.array([lat]),
+                                                                    np.array([lon]),
+                                                                    np.array([t11_K]))[0]
+
                             # Pick algorithm.
                             algorithm = eustace.surface_temperature.select_surface_temperature_algorithm(
                                 sun_zenith_angle,
@@ -5,6 +5,8 @@ import matplotlib.gridspec
 import pylab
 import eustace.db
 import eustace.surface_temperature
+import eustace.stratified_subsampling
+import eustace.bootstrap
 import numpy as np
 import logging
 import datetime
@@ -23,6 +25,24 @@ _ALGORITHMS = [eustace.surface_temperature.ST_ALGORITHM.SST_DAY,
                eustace.surface_temperature.ST_ALGORITHM.MIZT_SST_IST_NIGHT,
                eustace.surface_temperature.ST_ALGORITHM.MIZT_SST_IST_TWILIGHT]
 
+# The columns of the group of each perturbation, by the unit resampled
+# by the bootstrap, see eustace.bootstrap. The values are summed by
+# group in the database. The pixels, which reused the perturbations of
+# their memo pixel, see eustace.memo, are resampled together with it.
+_BOOTSTRAP_GROUPS = {"granule": ["s.satellite", "s.swath_datetime"],
+                     "pixel": ["COALESCE(s.memo_pixel, s.id)"]}
+
+# The weight of each perturbation, as given by
+# eustace.stratified_subsampling.get_weights, with and without the
+# number of perturbations of all the pixels.
+_WEIGHT_SQL = "COALESCE(s.inclusion_weight, 1.0) / s.number_of_perturbations"
+_UNWEIGHTED_SQL = "COALESCE(s.inclusion_weight, 1.0)"
+
+# Whether the pixel of a perturbation was perturbed, and did not reuse
+# the perturbations of its memo pixel.
+_PERTURBED_SQL = "(s.memo_pixel IS NULL OR s.memo_pixel = s.id)"
+
+
 if __name__ == "__main__":
     import docopt
     __doc__ = """
@@ -43,8 +63,20 @@ Options:
   --lat-gt=<lat>             Include lats greater than.
   --t11-t12-limit=<limit>    Only include values where t_11 - t12 is less than this value.
   --algorithm=<algo>         Only include values calculated with the given algorithm. Must be one of '{algorithms}'.
+  --bootstrap=<replicates>   Also compute bootstrap confidence intervals of the avg and std, from this many
+                             replicates, e.g. 1000. The sums of each granule (or pixel) are resampled, not
+                             the values, see eustace/bootstrap.py.
+  --bootstrap-by=<unit>      The unit resampled by the bootstrap, granule (a block bootstrap) or pixel,
+                             [default: granule].
+  --confidence=<level>       The confidence level of the intervals, [default: {confidence}].
   --output-dir=<output-dir>  Output directory, [default: .].
-""".format(filename=__file__, algorithms="', '".join(_ALGORITHMS))
+
+N is the number of values. If the database was populated with --memo,
+N_perturbed is the number of values of the pixels perturbed, i.e. not
+counting the values reused by the pixels with the same inputs, which
+are not independent.
+""".format(filename=__file__, algorithms="', '".join(_ALGORITHMS),
+           confidence=eustace.bootstrap.DEFAULT_CONFIDENCE)
     args = docopt.docopt(__doc__, version='0.1')
     if args["--debug"]:
         logging.basicConfig(level=logging.DEBUG)
@@ -56,6 +88,11 @@ Options:
     LOG.info(args)
 
     limit = None if args["--limit"] is None else int(args["--limit"])
+    number_of_replicates = None if args["--bootstrap"] is None else int(args["--bootstrap"])
+    if args["--bootstrap-by"] not in eustace.bootstrap.UNITS:
+        raise RuntimeError("The bootstrap unit must be one of '%s', not '%s'." % (
+                "', '".join(eustace.bootstrap.UNITS), args["--bootstrap-by"]))
+    confidence = float(args["--confidence"])
     if args["--algorithm"] is not None:
         assert(args["--algorithm"] in _ALGORITHMS)
         algorithms = [args["--algorithm"],]
@@ -69,11 +106,25 @@ Options:
         LOG.info("Removing %s" % (output_filename))
         os.remove(output_filename)
 
-    with open(output_filename, "a") as fp:
-        fp.write("# %s\n" % (satellite_id))
-        fp.write("# algo avg std N\n")
-    
     with eustace.db.Db(args["<database-filename>"]) as db:
+        has_memo = len(list(db.get_rows("SELECT 1 FROM swath_inputs WHERE memo_pixel IS NOT NULL LIMIT 1"))) > 0
+
+        with open(output_filename, "a") as fp:
+            fp.write("# %s\n" % (satellite_id))
+            header = "# algo avg std N"
+            if has_memo:
+                header += " N_perturbed"
+            if number_of_replicates is None:
+                fp.write("%s\n" % (header))
+            else:
+                fp.write("%s avg_low avg_high std_low std_high (%g confidence, %i replicates by %s)\n" % (
+                        header, confidence, number_of_replicates, args["--bootstrap-by"]))
+
+        # The number of perturbations and the inclusion weight of the
+        # pixel of each perturbation, see
+        # eustace.stratified_subsampling.get_weights, and whether the
+        # pixel was perturbed.
+        swath_variables = ["s.number_of_perturbations", "s.inclusion_weight", _PERTURBED_SQL]
         for algorithm in algorithms:
             LOG.debug("Get the values from the database.")
             t = datetime.datetime.now()
@@ -94,14 +145,19 @@ Options:
                 st_greater_than = None
                 algo = algorithm
 
-            y_array = np.array([row[0] for row in db.get_perturbed_values(swath_variables=None,
-                                                                          lat_less_than=args["--lat-lt"],
-                                                                          lat_greater_than=args["--lat-gt"],
-                                                                          tb_11_minus_tb_12_limit=args["--t11-t12-limit"],
-                                                                          st_less_than=st_less_than,
-                                                                          st_greater_than=st_greater_than,
-                                                                          algorithm=algo,
-                                                                          limit=limit)])
+            selection = dict(lat_less_than=args["--lat-lt"],
+                             lat_greater_than=args["--lat-gt"],
+                             tb_11_minus_tb_12_limit=args["--t11-t12-limit"],
+                             st_less_than=st_less_than,
+                             st_greater_than=st_greater_than,
+                             algorithm=algo,
+                             limit=limit)
+            rows = list(db.get_perturbed_values(swath_variables=swath_variables, **selection))
+            y_array = np.array([row[0] for row in rows], dtype=np.float64)
+            weights = eustace.stratified_subsampling.get_weights([row[1] for row in rows],
+                                                                 [row[2] for row in rows])
+            perturbed = np.array([bool(row[3]) for row in rows], dtype=bool)
+            weighted = None not in [row[1] for row in rows]
             LOG.debug("Took: %s" % (str(datetime.datetime.now() - t)))
 
             # Number of samples - total.
@@ -109,18 +165,39 @@ Options:
 
             # Make sure that there are no nan in the array.
             y_array_is_not_nan = y_array[~np.isnan(y_array)]
+            weights = weights[~np.isnan(y_array)]
+            perturbed = perturbed[~np.isnan(y_array)]
 
             # Number of samples.
             LOG.info("Number of samples without NaN: %i." %(len(y_array_is_not_nan)))
 
-            LOG.debug("Calculating the average.")
-            average_all = np.average(y_array_is_not_nan)
-
-            LOG.debug("Calculating the standard deviation.")
-            std_all = np.std(y_array_is_not_nan)
+            if len(y_array_is_not_nan) == 0:
+                average_all = std_all = np.NaN
+            else:
+                LOG.debug("Calculating the average.")
+                average_all = np.average(y_array_is_not_nan, weights=weights)
+
+                LOG.debug("Calculating the standard deviation.")
+                std_all = np.sqrt(np.average((y_array_is_not_nan - average_all)**2, weights=weights))
+
+            line = "%s %f %f %i" % (algorithm, average_all, std_all, len(y_array_is_not_nan))
+            if has_memo:
+                line += " %i" % (perturbed.sum())
+            if number_of_replicates is not None:
+                if len(y_array_is_not_nan) == 0:
+                    average_interval = std_interval = (np.NaN, np.NaN)
+                else:
+                    LOG.debug("Bootstrapping the average and the standard deviation.")
+                    group_sums = list(db.get_perturbed_group_sums(
+                            _BOOTSTRAP_GROUPS[args["--bootstrap-by"]],
+                            _WEIGHT_SQL if weighted else _UNWEIGHTED_SQL,
+                            average_all, **selection))
+                    average_interval, std_interval = eustace.bootstrap.get_confidence_intervals_of_sums(
+                        group_sums, average_all, number_of_replicates, confidence)
+                line += " %f %f %f %f" % (average_interval + std_interval)
 
             with open(output_filename, "a") as fp:
-                print ("%s %f %f %i\n" % (algorithm, average_all, std_all, len(y_array_is_not_nan)))
-                fp.write("%s %f %f %i\n" % (algorithm, average_all, std_all, len(y_array_is_not_nan)))
+                print ("%s\n" % (line))
+                fp.write("%s\n" % (line))
                 LOG.debug("Writing to %s" % (output_filename))
             LOG.debug("Written to %s" % (output_filename))
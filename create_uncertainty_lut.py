@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Computes the uncertainty lookup table of a satellite, see
+eustace.uncertainty_lut, i.e. the std of the perturbed surface
+temperatures over a grid of t11, t11 - t12, t37 - t11, t_clim - t11,
+sun and sat zenith angles, with the coefficients and sigmas of the
+satellite. The table is used by populate_database.py --uncertainty-lut.
+"""
+import eustace.coefficients
+import eustace.random_streams
+import eustace.sigmas
+import eustace.uncertainty_lut
+import logging
+import datetime
+import os
+
+LOG = logging.getLogger(__name__)
+
+
+if __name__ == "__main__":
+    import docopt
+    __doc__ = """
+File: {filename}
+
+Usage:
+  {filename} <satellite-id> [-d|-v] [--output-dir=<output-dir>] [options]
+  {filename} (-h | --help)
+  {filename} --version
+
+Options:
+  -h --help                        Show this screen.
+  --version                        Show version.
+  -v --verbose                     Show some diagostics.
+  -d --debug                       Show some more diagostics.
+  --number-of-perturbations=<NoP>  The number of perturbations of each grid point, [default: {perturbations}].
+  --sampling=<sampling>            The sampling of the perturbations, random, lhs or sobol, [default: random].
+  --sigmas=<filename>              The NEdT file of the sigmas. Defaults to the one in eustace.
+  --memory-budget=<MB>             The memory used for perturbing a block of grid points, [default: {memory}].
+  --output-dir=<output-dir>        Output directory, [default: .].
+""".format(filename=__file__,
+           perturbations=eustace.uncertainty_lut.DEFAULT_NUMBER_OF_PERTURBATIONS,
+           memory=eustace.uncertainty_lut.DEFAULT_MEMORY_BUDGET_MB)
+    args = docopt.docopt(__doc__, version='0.1')
+    if args["--debug"]:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args["--verbose"]:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    LOG.info(args)
+
+    if args["--sampling"] not in eustace.random_streams.SAMPLINGS:
+        raise RuntimeError("The sampling must be one of '%s', not '%s'." % (
+                "', '".join(eustace.random_streams.SAMPLINGS), args["--sampling"]))
+
+    satellite_id = args["<satellite-id>"]
+    output_filename = os.path.abspath(os.path.join(args["--output-dir"], satellite_id + ".lut.npz"))
+    sigmas = eustace.sigmas.get_sigmas(satellite_id, args["--sigmas"] or eustace.sigmas.SIGMAS_FILE)
+
+    start_time = datetime.datetime.now()
+    with eustace.coefficients.Coefficients(satellite_id) as coeff:
+        lut = eustace.uncertainty_lut.generate(coeff, sigmas,
+                                               number_of_perturbations=int(args["--number-of-perturbations"]),
+                                               memory_budget_mb=float(args["--memory-budget"]),
+                                               sampling=args["--sampling"])
+    LOG.info("Took: %s" % (str(datetime.datetime.now() - start_time)))
+
+    lut.save(output_filename)
+    print lut
+    print("'%s' saved." % output_filename)
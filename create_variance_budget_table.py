@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+The variance budget of a database populated with --variance-budget,
+i.e. how much of the variance of the perturbed surface temperatures
+comes from the noise of each channel, by algorithm.
+
+For each algorithm, the std of the perturbations of all the channels,
+and for each channel the variance, its share of the sum of the channel
+variances, and the linear variance from the partial derivatives. The
+interaction is the variance of all the channels, less the sum of the
+channel variances, which is 0 where the retrieval is linear.
+"""
+import eustace.db
+import eustace.variance_budget
+import numpy as np
+import logging
+import os
+
+LOG = logging.getLogger(__name__)
+
+
+def get_budget_table(budget_rows):
+    """
+    The variances, and the linear variances, by algorithm and channel,
+    from the rows of Db.get_variance_budget.
+    """
+    table = {}
+    for row in budget_rows:
+        algorithm, channel = row[:2]
+        table.setdefault(algorithm, {})[channel] = eustace.variance_budget.get_variances(row[2:])
+    return table
+
+
+if __name__ == "__main__":
+    import docopt
+    __doc__ = """
+File: {filename}
+
+Usage:
+  {filename} <database-filename> [-d|-v] [--output-dir=<output-dir>] [options]
+  {filename} (-h | --help)
+  {filename} --version
+
+Options:
+  -h --help                  Show this screen.
+  --version                  Show version.
+  -v --verbose               Show some diagostics.
+  -d --debug                 Show some more diagostics.
+  --satellite=<satellite>    Only the pixels of the satellite.
+  --output-dir=<output-dir>  Output directory, [default: .].
+""".format(filename=__file__)
+    args = docopt.docopt(__doc__, version='0.1')
+    if args["--debug"]:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args["--verbose"]:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+
+    LOG.info(args)
+
+    satellite_id = os.path.basename(args["<database-filename>"]).replace(".sqlite3", "")
+    output_filename = os.path.abspath(os.path.join(args["--output-dir"], satellite_id + ".budget"))
+
+    with eustace.db.Db(args["<database-filename>"]) as db:
+        table = get_budget_table(db.get_variance_budget(args["--satellite"]))
+    if len(table) == 0:
+        raise RuntimeError("There is no variance budget in '%s'. Populate it with --variance-budget." % (
+                args["<database-filename>"]))
+
+    channels = eustace.variance_budget.CHANNELS
+    lines = ["# %s" % (satellite_id),
+             "# algo std %s interaction linear_std" % (
+                " ".join(["var_%s share_%s linear_var_%s" % (channel, channel, channel)
+                          for channel in channels]))]
+    for algorithm in sorted(table.keys()):
+        variances = table[algorithm]
+        variance_all, linear_variance_all = variances[eustace.variance_budget.ALL_CHANNELS]
+        channel_sum = sum([variances[channel][0] for channel in channels])
+        columns = [algorithm, "%f" % (np.sqrt(variance_all))]
+        for channel in channels:
+            variance, linear_variance = variances[channel]
+            columns.extend(["%f" % (variance),
+                            "%f" % (variance / channel_sum if channel_sum > 0 else np.NaN),
+                            "%f" % (linear_variance)])
+        columns.extend(["%f" % (variance_all - channel_sum), "%f" % (np.sqrt(linear_variance_all))])
+        lines.append(" ".join(columns))
+
+    with open(output_filename, "w") as fp:
+        for line in lines:
+            print line
+            fp.write("%s\n" % (line))
+    LOG.debug("Written to %s" % (output_filename))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Bootstrap confidence intervals of the weighted mean and std of the
+perturbed surface temperatures.
+
+The values are not resampled one by one. The values are grouped by the
+unit of the resampling, e.g. the granule (a block bootstrap, keeping
+the correlation of the pixels of a granule) or the pixel, and each group
+is reduced to its sufficient statistics,
+
+sum of w, sum of w * y, sum of w * y**2,
+
+by get_group_sums, or by the database, see
+eustace.db.Db.get_perturbed_group_sums.
+
+A replicate draws the groups with replacement, i.e. a count of each
+group, and its sums are the counts times the sums of the groups, so the
+replicates are a product of a <replicates> x <groups> matrix of counts
+and the <groups> x 3 matrix of the sums, whatever the number of values.
+"""
+import numpy as np
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The units of the resampling.
+UNITS = ["granule", "pixel"]
+
+DEFAULT_NUMBER_OF_REPLICATES = 1000
+DEFAULT_CONFIDENCE = 0.95
+
+# With fewer groups, the intervals are not to be trusted.
+MIN_NUMBER_OF_GROUPS = 10
+
+# The memory used for the counts of the replicates, a batch of
+# replicates at a time.
+DEFAULT_MEMORY_BUDGET_MB = 256
+
+
+class BootstrapException(Exception):
+    pass
+
+
+def get_group_sums(values, weights, groups):
+    """
+    The sums of the weights, the weighted values, and the weighted
+    squared values, of each group, as a <groups> x 3 array, in the order
+    of the unique groups.
+    """
+    _, inverse = np.unique(groups, return_inverse=True)
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    return np.column_stack([np.bincount(inverse, weights * values**power)
+                            for power in range(3)])
+
+
+def get_mean_std(sums):
+    """
+    The weighted mean and std from the sums, along the last axis.
+    """
+    sums = np.asarray(sums, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sums[..., 1] / sums[..., 0]
+        variance = sums[..., 2] / sums[..., 0] - mean**2
+    return mean, np.sqrt(np.maximum(variance, 0))
+
+
+def resample(group_sums, number_of_replicates, random_state,
+             memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    The sums of each replicate, <replicates> x 3, drawing the groups
+    with replacement. The counts of the groups are drawn a batch of
+    replicates at a time, within the memory budget.
+    """
+    number_of_groups = len(group_sums)
+    if number_of_groups == 0:
+        raise BootstrapException("There are no groups to resample.")
+    batch_size = max(1, int(memory_budget_mb * 1024**2 / (8 * number_of_groups)))
+    probabilities = np.ones(number_of_groups) / number_of_groups
+    replicate_sums = np.empty((number_of_replicates, 3))
+    for start in range(0, number_of_replicates, batch_size):
+        stop = min(start + batch_size, number_of_replicates)
+        counts = random_state.multinomial(number_of_groups, probabilities, size=stop - start)
+        replicate_sums[start:stop] = np.dot(counts, group_sums)
+    return replicate_sums
+
+
+def get_confidence_intervals(values, weights, groups,
+                             number_of_replicates=DEFAULT_NUMBER_OF_REPLICATES,
+                             confidence=DEFAULT_CONFIDENCE, random_state=None,
+                             memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    The percentile confidence intervals, (low, high), of the weighted
+    mean and of the weighted std of the values, resampling the groups.
+    The values are centred on their mean first, so that the sums do not
+    lose the precision of the small differences.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    centre = np.average(values, weights=weights)
+    group_sums = get_group_sums(values - centre, weights, groups)
+    return get_confidence_intervals_of_sums(group_sums, centre, number_of_replicates,
+                                            confidence, random_state, memory_budget_mb)
+
+
+def get_confidence_intervals_of_sums(group_sums, centre,
+                                     number_of_replicates=DEFAULT_NUMBER_OF_REPLICATES,
+                                     confidence=DEFAULT_CONFIDENCE, random_state=None,
+                                     memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    The confidence intervals, like get_confidence_intervals, from the
+    sums of the groups of the values centred on centre, e.g. the
+    weighted mean of the values.
+    """
+    if not 0 < confidence < 1:
+        raise BootstrapException("The confidence must be between 0 and 1, not %s." % (confidence))
+    if random_state is None:
+        random_state = np.random.RandomState(1)
+    group_sums = np.asarray(group_sums, dtype=np.float64)
+    LOG.debug("Resampling %i groups %i times." % (len(group_sums), number_of_replicates))
+    if len(group_sums) < MIN_NUMBER_OF_GROUPS:
+        LOG.warning("Only %i groups to resample. The confidence intervals are too narrow." % (
+                len(group_sums)))
+
+    means, stds = get_mean_std(resample(group_sums, number_of_replicates, random_state,
+                                        memory_budget_mb))
+    percentiles = [50 * (1 - confidence), 50 * (1 + confidence)]
+    mean_interval = tuple(np.percentile(means + centre, percentiles))
+    std_interval = tuple(np.percentile(stds, percentiles))
+    return mean_interval, std_interval
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    The replicate sums are the sums of the values drawn, the intervals
+    cover the mean and std of the values, and are wider, when the
+    granules are resampled instead of the pixels of correlated granules.
+    """
+    random_state = np.random.RandomState(1)
+    group_sums = get_group_sums([1.0, 2.0, 3.0], [1.0, 1.0, 2.0], ["b", "a", "b"])
+    assert(group_sums.tolist() == [[1.0, 2.0, 4.0], [3.0, 7.0, 19.0]])
+    mean, std = get_mean_std(group_sums.sum(axis=0))
+    assert(np.isclose(mean, np.average([1.0, 2.0, 3.0], weights=[1, 1, 2])))
+    assert(np.isclose(std, np.sqrt(np.average(([1.0, 2.0, 3.0] - mean)**2, weights=[1, 1, 2]))))
+
+    # A batch of one replicate at a time gives the same replicates.
+    replicates = resample(group_sums, 7, np.random.RandomState(2))
+    assert(np.allclose(replicates, resample(group_sums, 7, np.random.RandomState(2), 1e-9)))
+    assert(np.allclose(replicates[:, 0] % 1, 0) and (replicates[:, 0] <= 6).all())
+
+    # 50 granules of 200 pixels, with an offset per granule.
+    number_of_granules, pixels_per_granule = 50, 200
+    granules = np.repeat(np.arange(number_of_granules), pixels_per_granule)
+    values = (random_state.normal(0, 0.3, number_of_granules)[granules] +
+              random_state.normal(0, 1.0, len(granules)))
+    weights = random_state.uniform(0.5, 1.5, len(granules))
+    mean = np.average(values, weights=weights)
+    std = np.sqrt(np.average((values - mean)**2, weights=weights))
+
+    granule_intervals = get_confidence_intervals(values, weights, granules, 500)
+    pixel_intervals = get_confidence_intervals(values, weights, np.arange(len(values)), 500)
+    for (mean_interval, std_interval) in [granule_intervals, pixel_intervals]:
+        assert(mean_interval[0] < mean < mean_interval[1])
+        assert(std_interval[0] < std < std_interval[1])
+    assert(np.diff(granule_intervals[0]) > 2 * np.diff(pixel_intervals[0]))
+
+    # The same intervals from the sums of the granules.
+    group_sums = get_group_sums(values - mean, weights, granules)
+    assert(np.allclose(get_confidence_intervals_of_sums(group_sums, mean, 500), granule_intervals))
+    print granule_intervals
+    print pixel_intervals
+    print "OK"
@@ -1,11 +1,148 @@
 #!/usr/bin/env python
 # coding: utf-8
 import os
+import threading
+import numpy as np
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The names of the ist bands, by their band codes, see get_ist_bands.
+IST_BANDS = ["lss240", "range240_260", "grt260"]
+
+# The upper t11 limits of the ist bands, but the last.
+_IST_BAND_LIMITS = np.array([240.0, 260.0])
+
 
 class CoefficientsException(Exception):
     pass
 
 
+def get_ist_bands(t11):
+    """
+    The ist band code of every t11, i.e. 0 for t11 < 240, 1 for
+    240 <= t11 < 260 and 2 otherwise, also for NaN. See IST_BANDS.
+    """
+    return np.searchsorted(_IST_BAND_LIMITS, t11, side="right").astype(np.int8)
+
+
+class CoefficientRegistry(object):
+    """
+    The coefficients of all the satellites in a calibration file, parsed
+    once. The values are in read only arrays,
+
+    registry.table[satellite code, coefficient index]
+
+    where the satellite codes are the positions in satellite_ids, and
+    the coefficients are named as the headers of the file, with "-"
+    replaced by "_". The ist coefficients are also in tables by band,
+
+    registry.ist_tables["a"][satellite code, band code]
+
+    so that the coefficients of the pixels are gathered with the codes,
+    also for pixels of different satellites.
+
+    Use get_registry, rather than creating one, so that the file is
+    parsed once per process.
+    """
+    def __init__(self, filename, split_text="::"):
+        self.filename = filename
+        with open(filename, 'r') as fp:
+            line = fp.readline()
+            if not line.startswith("#") or split_text not in line:
+                raise CoefficientsException("No header in '%s'." % (filename))
+            headers = [header.replace("-", "_") for header in line.split(split_text)[1].split()]
+            rows = [line.split() for line in fp
+                    if not line.startswith("#") and line.strip() != ""]
+
+        sat_id_index = headers.index("sat_id")
+        self.satellite_ids = tuple(row[sat_id_index] for row in rows)
+        self.names = tuple(header for header in headers if header != "sat_id")
+        self._indexes = dict((name, i) for i, name in enumerate(self.names))
+        self._satellite_codes = dict((sat_id, code) for code, sat_id
+                                     in enumerate(self.satellite_ids))
+
+        self.table = np.array([[float(value) for header, value in zip(headers, row)
+                                if header != "sat_id"] for row in rows], dtype=np.float64)
+        if self.table.shape != (len(self.satellite_ids), len(self.names)):
+            raise CoefficientsException("Missing coefficients in '%s'." % (filename))
+        self.table.flags.writeable = False
+
+        self.ist_tables = {}
+        for name in ["a", "b", "c", "d"]:
+            ist_table = self.table[:, [self._indexes["%s_ist_%s" % (name, band)]
+                                       for band in IST_BANDS]]
+            ist_table.flags.writeable = False
+            self.ist_tables[name] = ist_table
+        LOG.debug("Read the coefficients of %i satellites from '%s'." % (
+                len(self.satellite_ids), filename))
+
+    def __repr__(self):
+        return "CoefficientRegistry(%s)" % (self.filename)
+
+    def get_satellite_code(self, sat_id):
+        if sat_id not in self._satellite_codes:
+            raise CoefficientsException("Satellite id, '%s', must be one of "
+                                        "'%s'. Config file used: %s." % (
+                    sat_id, "', '".join(self.satellite_ids), self.filename))
+        return self._satellite_codes[sat_id]
+
+    def get_satellite_codes(self, sat_ids):
+        """
+        The satellite codes of the satellite ids, e.g. of every pixel.
+        """
+        sat_ids = np.asarray(sat_ids)
+        codes = np.empty(sat_ids.shape, dtype=np.int8)
+        for sat_id in np.unique(sat_ids):
+            codes[sat_ids == sat_id] = self.get_satellite_code(sat_id)
+        return codes
+
+    def get_values(self, sat_id):
+        """
+        The coefficients of the satellite, by name.
+        """
+        return dict(zip(self.names, self.table[self.get_satellite_code(sat_id)]))
+
+    def vector(self, name):
+        """
+        The coefficient of all the satellites, by satellite code.
+        """
+        return self.table[:, self._indexes[name]]
+
+    def gather(self, name, satellite_codes):
+        """
+        The coefficient of every pixel, given the satellite code of the
+        pixels.
+        """
+        return self.vector(name)[satellite_codes]
+
+    def gather_ist(self, satellite_codes, t11):
+        """
+        The ist coefficients, a, b, c, d, of every pixel.
+        """
+        bands = get_ist_bands(t11)
+        return tuple(self.ist_tables[name][satellite_codes, bands]
+                     for name in ["a", "b", "c", "d"])
+
+
+_REGISTRIES = {}
+_REGISTRIES_LOCK = threading.Lock()
+
+
+def get_registry(filename=None):
+    """
+    The coefficients in the calibration file, parsed the first time
+    they are used in the process.
+    """
+    if filename is None:
+        filename = Coefficients.DEFAULT_COEFFICIENT_FILE
+    filename = os.path.realpath(filename)
+    with _REGISTRIES_LOCK:
+        if filename not in _REGISTRIES:
+            _REGISTRIES[filename] = CoefficientRegistry(filename)
+        return _REGISTRIES[filename]
+
+
 class Coefficients(object):
     DEFAULT_COEFFICIENT_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "calibration_nh_ktuned_20140814.txt")
 
@@ -17,33 +154,11 @@ class Coefficients(object):
         self.filename = filename
         assert(os.path.isfile(self.filename))
         self.split_text = split_text
-
-        if self.sat_id not in [id for id in
-                               Coefficients.satellite_ids(self.filename)]:
-            raise CoefficientsException("Satellite id, '%s', must be one of "
-                                        "'%s'. Config file used: %s." % (
-                    self.sat_id,
-                    "', '".join(Coefficients.satellite_ids(self.filename)),
-                    self.filename
-                    ))
+        self.registry = get_registry(self.filename)
+        self.satellite_code = self.registry.get_satellite_code(self.sat_id)
 
     def __enter__(self):
-        with open(self.filename, 'r') as fp:
-            # Header line
-            line = fp.readline()
-            headers = self.get_headers(line)
-
-            sat_found = False
-            for line in fp:
-                if line.split()[0] == self.sat_id:
-                    for header, value in zip(headers, line.split()):
-                        try:
-                            self.__dict__[header.replace("-", "_")] = float(value)
-                        except ValueError:
-                            self.__dict__[header.replace("-", "_")] = value
-                    sat_found = True
-                    break
-            assert(sat_found)
+        self.__dict__.update(self.registry.get_values(self.sat_id))
         return self
 
     def __exit__(self, type, value, traceback):
@@ -72,12 +187,8 @@ class Coefficients(object):
     @staticmethod
     def satellite_ids(filename=DEFAULT_COEFFICIENT_FILE):
         assert(os.path.isfile(filename))
-        with open(filename, 'r') as fp:
-            line = fp.readline()
-            sat_id_index = Coefficients._get_sat_index_from_comment_line(line)
-            for line in fp:
-                if not line.startswith("#") and line.strip() != "":
-                    yield line.split()[sat_id_index]
+        for sat_id in get_registry(filename).satellite_ids:
+            yield sat_id
 
     def get_sst_night_coefficients(self, s_teta):
         a_n = self.a_sst_night
@@ -101,6 +212,9 @@ class Coefficients(object):
 
     def get_ist_coefficients(self, t11):
         # /* coefficients for noaa 12 from Key et al 1997 */
+        if np.ndim(t11) > 0:
+            return self.get_ist_coefficient_arrays(t11)
+
         if t11 < 240.0:
             a = self.a_ist_lss240
             b = self.b_ist_lss240
@@ -118,6 +232,58 @@ class Coefficients(object):
             d = self.d_ist_grt260
         return a, b, c, d
 
+    def get_ist_coefficient_arrays(self, t11):
+        """
+        The ist coefficients for every t11 in the array.
+        """
+        return self.registry.gather_ist(self.satellite_code, t11)
+
+
+class PixelCoefficients(object):
+    """
+    The coefficients of pixels of several satellites, gathered per
+    pixel by the satellite codes of the pixels, see
+    CoefficientRegistry. Used like Coefficients, with the array
+    functions in surface_temperature, which select the coefficients of
+    the pixels of each algorithm.
+
+    coeff = PixelCoefficients(registry.get_satellite_codes(sat_ids))
+    """
+    def __init__(self, satellite_codes, registry=None):
+        self.registry = registry if registry is not None else get_registry()
+        self.satellite_codes = np.asarray(satellite_codes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def __repr__(self):
+        return "PixelCoefficients(%i pixels, %s)" % (self.satellite_codes.size, self.registry)
+
+    def select(self, mask):
+        """
+        The coefficients of the pixels in the mask.
+        """
+        return PixelCoefficients(self.satellite_codes[mask], self.registry)
+
+    def _gather(self, *names):
+        return tuple(self.registry.gather(name, self.satellite_codes) for name in names)
+
+    def get_sst_night_coefficients(self, s_teta):
+        a_n, b_n, c_n, d_n, e_n, f_n, gain, offset = self._gather(
+            "a_sst_night", "b_sst_night", "c_sst_night", "d_sst_night",
+            "e_sst_night", "f_sst_night", "gain_sst_night", "offset_sst_night")
+        return a_n, b_n, c_n, d_n, e_n, f_n, gain * s_teta + offset
+
+    def get_sst_day_coefficients(self):
+        return self._gather("a_sst_day", "b_sst_day", "c_sst_day", "d_sst_day",
+                            "e_sst_day", "f_sst_day", "g_sst_day")
+
+    def get_ist_coefficients(self, t11):
+        return self.registry.gather_ist(self.satellite_codes, t11)
+
 
 if __name__ == "__main__":
     """
@@ -125,7 +291,7 @@ if __name__ == "__main__":
     """
     try:
         Coefficients("noaa3")
-    except AssertionError, e:
+    except CoefficientsException, e:
         pass
     else:
         raise Exception("Should fail.")
@@ -138,3 +304,20 @@ if __name__ == "__main__":
         print c.__dict__
     with Coefficients("noaa11") as c:
         print c.__dict__
+
+    # The gathered coefficients are those of the satellites.
+    t11 = np.array([230.0, 240.0, 259.9, 260.0, np.NaN])
+    assert(get_ist_bands(t11).tolist() == [0, 1, 1, 2, 2])
+    registry = get_registry()
+    assert(registry is get_registry(Coefficients.DEFAULT_COEFFICIENT_FILE))
+    sat_ids = np.array(["noaa7", "noaa9", "noaa11", "noaa9", "noaa7"])
+    coeff = PixelCoefficients(registry.get_satellite_codes(sat_ids))
+    for i, sat_id in enumerate(sat_ids):
+        with Coefficients(sat_id) as c:
+            assert(np.allclose(np.array(coeff.get_ist_coefficients(t11))[:, i],
+                               c.get_ist_coefficients(t11[i])))
+            assert(np.allclose(np.array(coeff.get_sst_day_coefficients())[:, i],
+                               c.get_sst_day_coefficients()))
+            assert(np.allclose(np.array(coeff.get_sst_night_coefficients(0.5))[:, i],
+                               c.get_sst_night_coefficients(0.5)))
+    print "OK"
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Perturbs the pixels in batches, until the std of the perturbed surface
+temperatures of each pixel, std(p.surface_temp - s.surface_temp), is
+known to a relative precision. Pixels far from the thresholds of the
+algorithms converge after a few batches, while e.g. the MIZT and
+twilight pixels get more perturbations.
+
+The number of perturbations of each pixel is returned, so that the
+statistics can weight the perturbations by the pixels, as when every
+pixel has the same number of perturbations.
+"""
+import numpy as np
+import eustace.perturbation
+
+import logging
+LOG = logging.getLogger(__name__)
+
+
+class ConvergenceException(Exception):
+    pass
+
+
+class ConvergenceStopping(object):
+    """
+    The stopping rule. The pixels are perturbed in batches of
+    batch_size perturbations, by default min_perturbations, and a pixel
+    is done when its std has a relative standard error of at most
+    relative_precision, after at least min_perturbations, or when it has
+    max_perturbations.
+    """
+    def __init__(self, relative_precision, min_perturbations, max_perturbations,
+                 batch_size=None):
+        if batch_size is None:
+            batch_size = min_perturbations
+        if relative_precision <= 0:
+            raise ConvergenceException("The relative precision must be positive, not %f." % (
+                    relative_precision))
+        if not 2 <= min_perturbations <= max_perturbations:
+            raise ConvergenceException("Needs 2 <= min_perturbations (%i) <= max_perturbations (%i)." % (
+                    min_perturbations, max_perturbations))
+        if batch_size < 1:
+            raise ConvergenceException("The batch size must be positive, not %i." % (batch_size))
+        self.relative_precision = relative_precision
+        self.min_perturbations = min_perturbations
+        self.max_perturbations = max_perturbations
+        self.batch_size = batch_size
+
+    def __repr__(self):
+        return "ConvergenceStopping(%g, %i, %i, %i)" % (self.relative_precision,
+                                                       self.min_perturbations,
+                                                       self.max_perturbations,
+                                                       self.batch_size)
+
+    def is_done(self, moments, number_of_perturbations):
+        """
+        True for the pixels that need no more perturbations, given the
+        moments and the number of perturbations of all the pixels.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            converged = moments.relative_std_error() <= self.relative_precision
+        return ((converged & (number_of_perturbations >= self.min_perturbations)) |
+                (number_of_perturbations >= self.max_perturbations))
+
+
+class RunningMoments(object):
+    """
+    The sums of the powers of the differences of each pixel, leaving out
+    NaN.
+    """
+    def __init__(self, number_of_pixels):
+        self.count = np.zeros(number_of_pixels, dtype=np.int64)
+        self.sums = np.zeros((4, number_of_pixels), dtype=np.float64)
+
+    def add(self, pixels, differences):
+        """
+        Adds the differences (pixels x perturbations) of the pixels.
+        """
+        is_number = ~np.isnan(differences)
+        differences = np.where(is_number, differences, 0.0).astype(np.float64)
+        self.count[pixels] += is_number.sum(axis=1)
+        power = np.ones_like(differences)
+        for i in range(4):
+            power *= differences
+            self.sums[i, pixels] += power.sum(axis=1)
+
+    def relative_std_error(self):
+        """
+        The relative standard error of the std of each pixel, from the
+        variance of the sample variance, i.e.
+        se(std) / std ~ sqrt((m4 / m2**2 - (n - 3) / (n - 1)) / n) / 2.
+        NaN for pixels with less than 2 differences, or no spread.
+        """
+        n = self.count.astype(np.float64)
+        s1, s2, s3, s4 = self.sums / np.maximum(n, 1)
+        m2 = s2 - s1**2
+        m4 = s4 - 4 * s1 * s3 + 6 * s1**2 * s2 - 3 * s1**4
+        kurtosis_term = m4 / m2**2 - (n - 3) / (n - 1)
+        relative_error = 0.5 * np.sqrt(np.maximum(kurtosis_term, 0.0) / n)
+        relative_error[(n < 2) | ~(m2 > 0)] = np.NaN
+        return relative_error
+
+
+def perturb_until_converged(coeff, buffers, convergence, t11_K, t12_K, t37_K, t_clim_K,
+                            sigma_11, sigma_12, sigma_37, sun_zenith_angle,
+                            sat_zenith_angle, st_truth_K, random_streams, rows, columns):
+    """
+    Perturbs the pixels, given by the rows and columns in the swath, a
+    batch at a time, see eustace.perturbation.perturb, until they are
+    done by the convergence. The batches continue the random streams
+    of the pixels, so a pixel gets the same perturbations as with a
+    fixed number of perturbations, as far as it goes.
+
+    Returns the pixel indexes, algorithm codes, epsilons and surface
+    temperatures of the perturbations that are a number, and the number
+    of perturbations of each pixel.
+    """
+    number_of_pixels = len(t11_K)
+    if buffers.number_of_perturbations != convergence.batch_size:
+        raise ConvergenceException("The buffers have %i perturbations per pixel, not the batch size %i." % (
+                buffers.number_of_perturbations, convergence.batch_size))
+
+    moments = RunningMoments(number_of_pixels)
+    number_of_perturbations = np.zeros(number_of_pixels, dtype=np.int64)
+    active = np.arange(number_of_pixels)
+    results = []
+    while len(active) > 0:
+        # All the active pixels have had the same number of
+        # perturbations.
+        first_perturbation = number_of_perturbations[active[0]]
+        block = eustace.perturbation.perturb(coeff, buffers,
+                                             t11_K[active], t12_K[active], t37_K[active],
+                                             t_clim_K[active], sigma_11, sigma_12, sigma_37,
+                                             sun_zenith_angle[active], sat_zenith_angle[active],
+                                             random_streams.for_pixels(rows[active],
+                                                                       columns[active],
+                                                                       first_perturbation))
+        # The last batch does not go beyond the max number of perturbations.
+        batch_size = min(convergence.batch_size,
+                         convergence.max_perturbations - first_perturbation)
+        surface_temp = block.surface_temp[:, :batch_size]
+        moments.add(active, surface_temp - st_truth_K[active, np.newaxis])
+        number_of_perturbations[active] += batch_size
+
+        # Indexing copies the values out of the buffers.
+        has_perturbed_st = ~np.isnan(surface_temp)
+        results.append((active[np.nonzero(has_perturbed_st)[0]],
+                        block.algorithm[:, :batch_size][has_perturbed_st],
+                        block.epsilon_11[:, :batch_size][has_perturbed_st],
+                        block.epsilon_12[:, :batch_size][has_perturbed_st],
+                        block.epsilon_37[:, :batch_size][has_perturbed_st],
+                        surface_temp[has_perturbed_st]))
+
+        active = active[~convergence.is_done(moments, number_of_perturbations)[active]]
+
+    LOG.debug("Perturbed %i pixels %.1f times on average, in %i batches." % (
+            number_of_pixels, number_of_perturbations.mean(), len(results)))
+    pixel_indexes, algorithms, epsilon_11, epsilon_12, epsilon_37, surface_temps = [
+        np.concatenate(values) for values in zip(*results)]
+    return (pixel_indexes, algorithms, epsilon_11, epsilon_12, epsilon_37, surface_temps,
+            number_of_perturbations)
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    The relative error of normal samples, and the adaptive perturbations
+    continue the fixed ones.
+    """
+    import eustace.coefficients
+    import eustace.random_streams
+    import eustace.surface_temperature
+    random_state = np.random.RandomState(1)
+    moments = RunningMoments(1)
+    samples = random_state.normal(0.0, 0.5, (1, 2000))
+    moments.add(np.arange(1), samples)
+    assert(abs(moments.relative_std_error()[0] - np.sqrt(0.5 / 2000)) < 0.002)
+
+    number_of_pixels = 50
+    t11_K = random_state.uniform(235, 285, number_of_pixels)
+    t12_K = t11_K - random_state.uniform(0.0, 2.0, number_of_pixels)
+    t37_K = t11_K + random_state.uniform(-1.0, 3.0, number_of_pixels)
+    t_clim_K = t11_K + 1.0
+    sun_zenith_angle = random_state.uniform(40, 130, number_of_pixels)
+    sat_zenith_angle = random_state.uniform(0, 60, number_of_pixels)
+    rows, columns = np.arange(number_of_pixels), np.zeros(number_of_pixels, dtype=np.int64)
+    streams = eustace.random_streams.RandomStreams("noaa18", "test")
+    convergence = ConvergenceStopping(0.1, 8, 60)
+    with eustace.coefficients.Coefficients("noaa18") as coeff:
+        st_truth_K = eustace.surface_temperature.get_surface_temperatures(
+            eustace.surface_temperature.select_surface_temperature_algorithms(
+                sun_zenith_angle, t11_K, t37_K),
+            coeff, t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle, sat_zenith_angle)
+        buffers = eustace.perturbation.PerturbationBuffers(number_of_pixels, 8)
+        values = perturb_until_converged(coeff, buffers, convergence, t11_K, t12_K, t37_K,
+                                         t_clim_K, 0.2, 0.2, 0.3, sun_zenith_angle,
+                                         sat_zenith_angle, st_truth_K, streams, rows, columns)
+        pixel_indexes, surface_temps, numbers = values[0], values[5], values[6]
+        assert(((numbers >= 8) & (numbers <= 60)).all())
+        assert(len(set(numbers)) > 1)
+
+        fixed = eustace.perturbation.perturb(coeff, eustace.perturbation.PerturbationBuffers(
+                number_of_pixels, 60), t11_K, t12_K, t37_K, t_clim_K, 0.2, 0.2, 0.3,
+                sun_zenith_angle, sat_zenith_angle, streams.for_pixels(rows, columns))
+        for i in range(number_of_pixels):
+            expected = fixed.surface_temp[i, :numbers[i]]
+            assert(np.array_equal(np.sort(surface_temps[pixel_indexes == i]),
+                                  np.sort(expected[~np.isnan(expected)])))
+    print "OK"
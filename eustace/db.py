@@ -1,6 +1,8 @@
 # coding: UTF-8
 import sqlite3
 import logging
+import threading
+import Queue
 import numpy as np
 
 # Define the logger
@@ -9,10 +11,21 @@ LOG = logging.getLogger(__name__)
 # Temp structure that should be removed.
 # Valid values to insert into the different tables. There are more values in the tables, and this functionality
 # should be removed when the structure is more decided.
-_SWATH_KEYS = ["satellite_name", "surface_temp", "t_11", "t_12", "t_37", "sat_zenith_angle", "sun_zenith_angle", "sea_ice_fraction", "cloudmask", "swath_datetime", "lat", "lon"]
+_SWATH_KEYS = ["satellite_name", "surface_temp", "t_11", "t_12", "t_37", "sat_zenith_angle", "sun_zenith_angle", "sea_ice_fraction", "cloudmask", "swath_datetime", "lat", "lon", "number_of_perturbations", "inclusion_weight", "uncertainty", "memo_pixel"]
 _PERTURBATION_KEYS = ["epsilon_11", "epsilon_12", "epsilon_37", "surface_temp"]
 
 
+def _to_sql_values(values):
+    """
+    Converts an array (or list) of values to a list of values that sqlite
+    understands. NaN is stored as NULL.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == "f":
+        return [None if np.isnan(v) else v for v in values.tolist()]
+    return values.tolist()
+
+
 class Db:
     # Create tables.
     SETUP_SQLS = [
@@ -29,7 +42,11 @@ class Db:
            cloudmask INT NOT NULL,
            swath_datetime DATETIME NOT NULL,
            lat REAL NOT NULL,
-           lon REAL NOT NULL
+           lon REAL NOT NULL,
+           number_of_perturbations INT,
+           inclusion_weight REAL,
+           uncertainty REAL,
+           memo_pixel INT
         )""",
         """CREATE INDEX IF NOT EXISTS swath_satellite_index ON swath_inputs(satellite)""",
         """CREATE INDEX IF NOT EXISTS swath_datetime_index ON swath_inputs(swath_datetime)""",
@@ -50,8 +67,40 @@ class Db:
         )""",
         """CREATE INDEX IF NOT EXISTS pert_swath_input_index ON perturbations(swath_input_id)""",
         """CREATE INDEX IF NOT EXISTS pert_algorithm_index ON perturbations(algorithm)""",
+
+        # The scanlines that were skipped, as they are in the previous
+        # granule of the satellite, which owns them.
+        """CREATE TABLE IF NOT EXISTS duplicate_scanlines (
+           satellite TEXT NOT NULL,
+           granule TEXT NOT NULL,
+           scanline INT NOT NULL,
+           owner_granule TEXT NOT NULL,
+           owner_scanline INT NOT NULL
+        )""",
+
+        # The sums of the variance budget of the perturbations, by the
+        # algorithm of the pixels and the perturbed channel, see
+        # eustace.variance_budget. The rows are added up by the queries.
+        """CREATE TABLE IF NOT EXISTS variance_budget (
+           satellite TEXT NOT NULL,
+           granule TEXT NOT NULL,
+           algorithm TEXT NOT NULL,
+           channel TEXT NOT NULL,
+           number_of_pixels INT NOT NULL,
+           number_of_perturbations INT NOT NULL,
+           sum REAL NOT NULL,
+           sum_of_squares REAL NOT NULL,
+           linear_variance_sum REAL NOT NULL
+        )""",
         ]
 
+    # The columns added to the tables since they were first created,
+    # which are added to the tables of older database files.
+    ADDED_COLUMNS = [("swath_inputs", "number_of_perturbations", "INT"),
+                     ("swath_inputs", "inclusion_weight", "REAL"),
+                     ("swath_inputs", "uncertainty", "REAL"),
+                     ("swath_inputs", "memo_pixel", "INT")]
+
     def __init__(self, db_filename):
         self.db_filename = db_filename
         self.conn = sqlite3.connect(self.db_filename)
@@ -60,6 +109,10 @@ class Db:
         # TODO: Create tables.
         for sql in Db.SETUP_SQLS:
             self.execute_and_commit(sql)
+        for table, column, column_type in Db.ADDED_COLUMNS:
+            if column not in self.get_columns(table):
+                LOG.info("Adding the column %s to %s." % (column, table))
+                self.execute_and_commit("ALTER TABLE %s ADD COLUMN %s %s" % (table, column, column_type))
 
     def __enter__(self):
         LOG.debug("Entering db.")
@@ -93,7 +146,16 @@ class Db:
             for row in self.c.execute(sql, where_values):
                 yield row
 
-    def insert_swath_values(self, satellite_name, **kwargs):
+    def commit(self):
+        self.conn.commit()
+
+    def get_columns(self, table):
+        """
+        The names of the columns of the table.
+        """
+        return [row[1] for row in self.get_rows("PRAGMA table_info(%s)" % (table))]
+
+    def insert_swath_values(self, satellite_name, commit=True, **kwargs):
         """
         Returns the id of the inserted swath pixel.
         """
@@ -106,7 +168,10 @@ class Db:
         variable_string = ", ".join([str(k) for k in kwargs.keys()])
         value_string = ", ?"*len(kwargs)
         sql = "INSERT INTO swath_inputs (satellite, %s) VALUES ('%s'%s)" % (variable_string, satellite_name, value_string)
-        self.execute_and_commit(sql, kwargs.values())
+        if commit:
+            self.execute_and_commit(sql, kwargs.values())
+        else:
+            self.execute(sql, kwargs.values())
         return self.c.lastrowid
 
 
@@ -122,7 +187,7 @@ class Db:
         sql = "INSERT INTO perturbations (swath_input_id, algorithm, %s) VALUES (%i, '%s'%s)" % (variable_string, swath_input_id, algorithm_name, value_string)
         self.execute(sql, kwargs.values())
 
-    def insert_many_perturbations(self, swath_input_id, perturbations):
+    def insert_many_perturbations(self, swath_input_id, perturbations, commit=True):
         counter = 0
         for algorithm, epsilon_11, epsilon_12, epsilon_37, st_K in perturbations:
             if np.isnan(st_K) or st_K is None:
@@ -135,10 +200,118 @@ class Db:
                                             epsilon_37 = epsilon_37,
                                             surface_temp = st_K)
             counter += 1
-        self.conn.commit()
+        if commit:
+            self.conn.commit()
         return counter
 
+    def insert_swath_with_perturbations(self, satellite_name, swath_values, perturbations):
+        """
+        Inserts a swath pixel and its perturbations, without committing.
+        Returns the number of perturbations inserted.
+        """
+        swath_input_id = self.insert_swath_values(satellite_name, commit=False, **swath_values)
+        return self.insert_many_perturbations(swath_input_id, perturbations, commit=False)
+
+    def insert_perturbed_pixels(self, satellite_name, swath_values, pixel_indexes,
+                                algorithms, epsilon_11, epsilon_12, epsilon_37,
+                                surface_temps):
+        """
+        Inserts a block of swath pixels and their perturbations, without
+        committing. The swath values are given by column, as arrays with
+        a value per pixel. The perturbations are given as arrays with a
+        value per perturbation, and the pixel_indexes are the indexes of
+        their pixels in the swath values.
 
+        Returns the number of perturbations inserted.
+        """
+        keys = sorted(swath_values.keys())
+        for k in keys:
+            if k not in _SWATH_KEYS:
+                raise RuntimeError("%s must be one of '%s'" % (k, ", ".join(_SWATH_KEYS)))
+
+        # The ids of the new pixels follow the ones already in the table.
+        self.execute("SELECT MAX(id) FROM swath_inputs")
+        max_id = self.c.fetchone()[0]
+        first_id = 1 if max_id is None else max_id + 1
+        number_of_pixels = len(swath_values[keys[0]])
+        swath_input_ids = np.arange(first_id, first_id + number_of_pixels)
+
+        # The memo pixels are given by their indexes in the swath values,
+        # and are stored by their ids, see eustace.memo.
+        if "memo_pixel" in swath_values:
+            swath_values = dict(swath_values,
+                                memo_pixel=swath_input_ids[swath_values["memo_pixel"]])
+
+        sql = "INSERT INTO swath_inputs (id, satellite, %s) VALUES (?, '%s'%s)" % (
+            ", ".join(keys), satellite_name, ", ?"*len(keys))
+        LOG.debug("Executing SQL: '%s' for %i pixels." % (sql, number_of_pixels))
+        self.c.executemany(sql, zip(swath_input_ids.tolist(),
+                                    *[_to_sql_values(swath_values[k]) for k in keys]))
+
+        sql = "INSERT INTO perturbations (swath_input_id, algorithm, epsilon_11, epsilon_12, epsilon_37, surface_temp) VALUES (?, ?, ?, ?, ?, ?)"
+        LOG.debug("Executing SQL: '%s' for %i perturbations." % (sql, len(surface_temps)))
+        self.c.executemany(sql, zip(swath_input_ids[pixel_indexes].tolist(),
+                                    _to_sql_values(algorithms),
+                                    _to_sql_values(epsilon_11),
+                                    _to_sql_values(epsilon_12),
+                                    _to_sql_values(epsilon_37),
+                                    _to_sql_values(surface_temps)))
+        return len(surface_temps)
+
+    def insert_duplicate_scanlines(self, satellite_name, granule, scanlines,
+                                   owner_granule, owner_scanlines):
+        """
+        Records the skipped scanlines of the granule, and the scanlines
+        of the owner granule they duplicate. Returns the number of
+        scanlines.
+        """
+        sql = "INSERT INTO duplicate_scanlines (satellite, granule, scanline, owner_granule, owner_scanline) VALUES (?, ?, ?, ?, ?)"
+        LOG.debug("Executing SQL: '%s' for %i scanlines." % (sql, len(scanlines)))
+        self.c.executemany(sql, [(satellite_name, granule, scanline, owner_granule, owner_scanline)
+                                 for scanline, owner_scanline in zip(_to_sql_values(scanlines),
+                                                                     _to_sql_values(owner_scanlines))])
+        return len(scanlines)
+
+    def insert_variance_budget(self, satellite_name, granule, sums):
+        """
+        Inserts the sums of the variance budget of a block of pixels,
+        see eustace.variance_budget.VarianceBudget.get_sums. Returns the
+        number of rows.
+        """
+        sql = "INSERT INTO variance_budget (satellite, granule, algorithm, channel, number_of_pixels, number_of_perturbations, sum, sum_of_squares, linear_variance_sum) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        LOG.debug("Executing SQL: '%s' for %i rows." % (sql, len(sums)))
+        self.c.executemany(sql, [(satellite_name, granule) + tuple(row) for row in sums])
+        return len(sums)
+
+    def delete_granule(self, satellite_name, swath_datetime, granule):
+        """
+        Deletes the values of the granule, e.g. of a granule that was
+        completed by another worker, see eustace.work_queue. Returns the
+        number of pixels.
+        """
+        swath_where = "WHERE satellite = ? AND swath_datetime = ?"
+        self.execute("DELETE FROM perturbations WHERE swath_input_id IN (SELECT id FROM swath_inputs %s)" % (swath_where),
+                     (satellite_name, swath_datetime))
+        self.execute("DELETE FROM swath_inputs %s" % (swath_where), (satellite_name, swath_datetime))
+        number_of_pixels = self.c.rowcount
+        for table in ["duplicate_scanlines", "variance_budget"]:
+            self.execute("DELETE FROM %s WHERE satellite = ? AND granule = ?" % (table),
+                         (satellite_name, granule))
+        return number_of_pixels
+
+    def get_variance_budget(self, satellite_name=None):
+        """
+        The sums of the variance budget, added up by algorithm and
+        channel, as (algorithm, channel, number of pixels, number of
+        perturbations, sum, sum of squares, linear variance sum).
+        """
+        sql = "SELECT algorithm, channel, SUM(number_of_pixels), SUM(number_of_perturbations), SUM(sum), SUM(sum_of_squares), SUM(linear_variance_sum) FROM variance_budget"
+        where_values = []
+        if satellite_name is not None:
+            sql += " WHERE satellite = ?"
+            where_values.append(satellite_name)
+        sql += " GROUP BY algorithm, channel ORDER BY algorithm, channel"
+        return list(self.get_rows(sql, where_values))
 
     """
     def get_perturbed_statistics(self, variable, where=None):
@@ -188,6 +361,39 @@ class Db:
         return where_sql
 
  
+    def get_perturbed_group_sums(self, group_variables, weight_sql, centre,
+                                 lat_less_than=None, lat_greater_than=None,
+                                 tb_11_minus_tb_12_limit=None, st_less_than=None,
+                                 st_greater_than=None, algorithm=None, limit=None):
+        """
+        Gets the sums of the weights, the weighted values and the
+        weighted squared values, of the (perturbed) values of
+        get_perturbed_values minus centre, of each group of the values
+        by the group variables, see eustace.bootstrap. The weight of a
+        value is given by weight_sql.
+        """
+        groups_string = ", ".join(["%s AS g%i" % (variable, i)
+                                   for i, variable in enumerate(group_variables)])
+        sql = "SELECT {weight_sql} AS w, p.surface_temp - s.surface_temp - ? AS y, {groups_string} FROM swath_inputs AS s JOIN perturbations AS p ON p.swath_input_id = s.id".format(
+            weight_sql=weight_sql, groups_string=groups_string)
+
+        where_sql = self.build_where_sql(lat_less_than=lat_less_than,
+                                         lat_greater_than=lat_greater_than,
+                                         tb_11_minus_tb_12_limit=tb_11_minus_tb_12_limit,
+                                         st_less_than=st_less_than,
+                                         st_greater_than=st_greater_than,
+                                         algorithm=algorithm)
+        if where_sql is not None and where_sql.strip() != "":
+            sql += " WHERE %s" % (where_sql)
+        if limit is not None:
+            sql += " LIMIT %i" % (limit)
+
+        sql = "SELECT SUM(w), SUM(w * y), SUM(w * y * y) FROM (%s) WHERE y IS NOT NULL GROUP BY %s" % (
+            sql, ", ".join(["g%i" % (i) for i in range(len(group_variables))]))
+        LOG.debug(sql)
+        for row in self.get_rows(sql, (float(centre),)):
+            yield row
+
     def get_perturbed_values(self, swath_variables=None, lat_less_than=None,
                              lat_greater_than=None, tb_11_minus_tb_12_limit=None,
                              st_less_than=None, st_greater_than=None,
@@ -225,6 +431,143 @@ class Db:
             yield row
 
 
+class DbWriterException(Exception):
+    pass
+
+
+class DbWriter(object):
+    """
+    Write-behind sink for the database.
+
+    The inserts are collected in batches, which are committed by a
+    dedicated thread, so that the caller can continue while sqlite is
+    writing to disk. The inserts are given by the name of the Db method
+    doing the insert, e.g.:
+
+    with DbWriter(db_filename) as writer:
+        writer.insert("insert_swath_with_perturbations", satellite_name,
+                      swath_values, perturbations)
+
+    A batch is handed over to the thread, when it holds batch_size rows.
+    An insert counts as one row, unless given its number_of_rows, e.g.
+    an insert of a block of perturbations:
+
+        writer.insert("insert_perturbed_pixels", ..., number_of_rows=len(surface_temps))
+
+    At most max_queued_batches batches are waiting to be written. If
+    the writing fails, the error is raised in the caller by the next
+    insert, flush or close.
+    """
+    def __init__(self, db_filename, batch_size=1000, max_queued_batches=8):
+        self.db_filename = db_filename
+        self.batch_size = batch_size
+        self._batch = []
+        self._batch_rows = 0
+        self._queue = Queue.Queue(maxsize=max_queued_batches)
+        self._error = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name="db-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            # Do not hide the original exception.
+            try:
+                self.close()
+            except DbWriterException:
+                LOG.exception("Closing the db writer failed.")
+
+    def _run(self):
+        # The connection must be created in the thread using it.
+        db = None
+        try:
+            db = Db(self.db_filename)
+        except Exception, e:
+            LOG.exception("Could not open '%s'." % (self.db_filename))
+            self._error = e
+
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    break
+
+                if self._error is not None:
+                    # Keep emptying the queue, so that the caller is
+                    # not blocked, until it sees the error.
+                    continue
+
+                try:
+                    for method, args, kwargs in batch:
+                        getattr(db, method)(*args, **kwargs)
+                    db.commit()
+                except Exception, e:
+                    LOG.exception("Could not write to '%s'." % (self.db_filename))
+                    db.conn.rollback()
+                    self._error = e
+            finally:
+                self._queue.task_done()
+
+        if db is not None:
+            db.__exit__(None, None, None)
+
+    def _check_error(self):
+        if self._error is not None:
+            raise DbWriterException("Writing to '%s' failed: %s" % (self.db_filename,
+                                                                   str(self._error)))
+
+    def _hand_over_batch(self):
+        if len(self._batch) > 0:
+            batch, self._batch = self._batch, []
+            self._batch_rows = 0
+            self._queue.put(batch)
+
+    def insert(self, method, *args, **kwargs):
+        """
+        Inserts the values, using the Db method with the given name. The
+        keyword number_of_rows is the number of rows inserted, 1 if not
+        given, and is not passed on to the method.
+        """
+        number_of_rows = kwargs.pop("number_of_rows", 1)
+        if self._closed:
+            raise DbWriterException("The writer for '%s' is closed." % (self.db_filename))
+        if not hasattr(Db, method):
+            raise DbWriterException("Db has no method '%s'." % (method))
+        self._check_error()
+
+        self._batch.append((method, args, kwargs))
+        self._batch_rows += number_of_rows
+        if self._batch_rows >= self.batch_size:
+            self._hand_over_batch()
+
+    def flush(self):
+        """
+        Waits until everything inserted so far is committed.
+        """
+        if not self._closed:
+            self._hand_over_batch()
+            self._queue.join()
+        self._check_error()
+
+    def close(self):
+        """
+        Commits the remaining inserts and closes the database.
+        """
+        if not self._closed:
+            self._closed = True
+            self._hand_over_batch()
+            self._queue.put(None)
+            self._thread.join()
+        self._check_error()
+
+
 if __name__ == "__main__":
     with Db("/tmp/fisk.db") as db:
         for sql in sql_list:
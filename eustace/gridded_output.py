@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+The per pixel output of a granule, on the grid of the swath. Instead
+of rows of the valid pixels in the database, each field is an array of
+the shape of the AVHRR swath, so that the uncertainty of any slice of
+the granule is read directly, without the database.
+
+The arrays are written to an HDF5 file per granule, chunked by blocks
+of rows and compressed. The pixels, which are not retrieved, e.g. not
+selected by the ingest filter, or skipped, have the fill value of the
+field.
+
+The uncertainty of a pixel is the std of its perturbed surface
+temperatures, or, with an uncertainty lut, the uncertainty interpolated
+from the table.
+"""
+import os
+import h5py
+import numpy as np
+import eustace.surface_temperature
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The fields, their dtypes and fill values.
+FIELDS = [("surface_temp", np.float32, np.NaN),
+          ("algorithm", np.int8, -1),
+          ("uncertainty", np.float32, np.NaN),
+          ("number_of_perturbations", np.int32, 0),
+          ("sea_ice_fraction", np.float32, np.NaN),
+          ("inclusion_weight", np.float32, 0)]
+
+# The number of rows in a chunk.
+CHUNK_ROWS = 256
+
+# The gzip level of the chunks.
+COMPRESSION_LEVEL = 4
+
+
+class GriddedOutputException(Exception):
+    pass
+
+
+def get_gridded_filename(directory, granule_id):
+    """
+    noaa18_20080901_1157_99999_satproj_00000_12119
+    -> <directory>/noaa18_20080901_1157_99999_satproj_00000_12119_uncertainty.h5
+    """
+    return os.path.join(directory, "%s_uncertainty.h5" % (granule_id))
+
+
+def get_pixel_stds(pixel_indexes, differences, number_of_pixels):
+    """
+    The std of the perturbations of each pixel, from the index of the
+    pixel of each perturbation. NaN for the pixels with less than two
+    perturbations.
+    """
+    counts = np.bincount(pixel_indexes, minlength=number_of_pixels).astype(np.float64)
+    sums = np.bincount(pixel_indexes, differences, minlength=number_of_pixels)
+    sums_of_squares = np.bincount(pixel_indexes, differences**2, minlength=number_of_pixels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variances = (sums_of_squares - sums**2 / counts) / (counts - 1)
+    variances[counts < 2] = np.NaN
+    return np.sqrt(np.maximum(variances, 0))
+
+
+class GriddedGranule(object):
+    """
+    The fields of a granule, filled a block of pixels at a time by add,
+    and written by write.
+    """
+    def __init__(self, shape):
+        if len(shape) != 2:
+            raise GriddedOutputException("The swath must have two dimensions, not %i." % (len(shape)))
+        self.shape = tuple(shape)
+        self.arrays = {}
+        for name, dtype, fill_value in FIELDS:
+            self.arrays[name] = np.empty(self.shape, dtype=dtype)
+            self.arrays[name].fill(fill_value)
+        self.uncertainty_method = None
+
+    def __repr__(self):
+        return "GriddedGranule(%s, %i pixels)" % (
+            "x".join([str(n) for n in self.shape]),
+            (self.arrays["algorithm"] >= 0).sum())
+
+    def add(self, perturbed_values):
+        """
+        Adds the pixels of the values of a block, see
+        populate_database.perturb_row_block.
+        """
+        if perturbed_values is None:
+            return
+        (swath_values, pixel_indexes, algorithm_names, epsilon_11, epsilon_12, epsilon_37,
+         surface_temps) = perturbed_values[:7]
+        rows, columns, algorithms = perturbed_values[8]
+        truth = swath_values["surface_temp"]
+
+        if "uncertainty" in swath_values:
+            uncertainty = swath_values["uncertainty"]
+            self.uncertainty_method = "lut"
+        else:
+            uncertainty = get_pixel_stds(pixel_indexes, surface_temps - truth[pixel_indexes],
+                                         len(truth))
+            self.uncertainty_method = "monte_carlo"
+
+        self.arrays["surface_temp"][rows, columns] = truth
+        self.arrays["algorithm"][rows, columns] = algorithms
+        self.arrays["uncertainty"][rows, columns] = uncertainty
+        self.arrays["number_of_perturbations"][rows, columns] = swath_values["number_of_perturbations"]
+        self.arrays["sea_ice_fraction"][rows, columns] = swath_values["sea_ice_fraction"]
+        self.arrays["inclusion_weight"][rows, columns] = swath_values["inclusion_weight"]
+
+    def write(self, filename, **attributes):
+        """
+        Writes the fields, with the attributes, e.g. the satellite and
+        the granule, to the HDF5 file. The file is written under a
+        temporary name, and renamed when done, so that a file is always
+        complete.
+        """
+        temporary_filename = "%s.%i.tmp" % (filename, os.getpid())
+        chunks = (min(CHUNK_ROWS, self.shape[0]), self.shape[1])
+        try:
+            with h5py.File(temporary_filename, "w") as fp:
+                for name, value in attributes.items():
+                    fp.attrs[name] = value
+                if self.uncertainty_method is not None:
+                    fp.attrs["uncertainty_method"] = self.uncertainty_method
+                for name, dtype, fill_value in FIELDS:
+                    fp.create_dataset(name, data=self.arrays[name], chunks=chunks,
+                                      compression="gzip", compression_opts=COMPRESSION_LEVEL,
+                                      shuffle=True, fillvalue=fill_value)
+                fp["algorithm"].attrs["flag_values"] = np.arange(
+                    len(eustace.surface_temperature.ALGORITHMS), dtype=np.int8)
+                fp["algorithm"].attrs["flag_meanings"] = " ".join(
+                    [str(algorithm) for algorithm in eustace.surface_temperature.ALGORITHMS])
+            os.rename(temporary_filename, filename)
+        except:
+            if os.path.exists(temporary_filename):
+                os.remove(temporary_filename)
+            raise
+        LOG.info("%s written to '%s'." % (self, filename))
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    The pixels are put in place, with the std of their perturbations,
+    and read back from the file.
+    """
+    import tempfile
+    import shutil
+
+    random_state = np.random.RandomState(1)
+    differences = random_state.normal(0, 0.5, (3, 400))
+    swath_values = dict(surface_temp=np.array([270.0, 280.0, 290.0]),
+                        number_of_perturbations=np.array([400, 400, 400]),
+                        sea_ice_fraction=np.array([0.5, np.NaN, 0.0]),
+                        inclusion_weight=np.array([1.0, 2.0, 1.0]))
+    pixel_indexes = np.repeat(np.arange(3), 400)
+    surface_temps = (swath_values["surface_temp"][:, np.newaxis] + differences).ravel()
+    perturbed_values = (swath_values, pixel_indexes, None, None, None, None, surface_temps,
+                        None, (np.array([0, 2, 4]), np.array([1, 0, 2]), np.array([3, 0, 1])))
+
+    gridded = GriddedGranule((5, 3))
+    gridded.add(perturbed_values)
+    gridded.add(None)
+    assert(np.allclose(gridded.arrays["uncertainty"][[0, 2, 4], [1, 0, 2]],
+                       differences.std(axis=1, ddof=1)))
+    assert(np.isnan(gridded.arrays["uncertainty"][1, 1]))
+    assert(get_pixel_stds(np.array([0, 1, 1]), np.array([0.0, 1.0, 3.0]), 3)[1] == np.sqrt(2.0))
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = get_gridded_filename(directory, "noaa18_test")
+        gridded.write(filename, satellite_id="noaa18")
+        with h5py.File(filename, "r") as fp:
+            assert(fp.attrs["satellite_id"] == "noaa18")
+            assert(fp.attrs["uncertainty_method"] == "monte_carlo")
+            assert(fp["algorithm"][:].tolist() == [[-1, 3, -1], [-1, -1, -1], [0, -1, -1],
+                                                   [-1, -1, -1], [-1, -1, 1]])
+            assert(fp["surface_temp"][4, 2] == 290.0)
+            assert(fp["inclusion_weight"][2, 0] == 2.0)
+            assert(fp["sea_ice_fraction"][0, 1] == 0.5 and np.isnan(fp["sea_ice_fraction"][2, 0]))
+        assert(os.listdir(directory) == [os.path.basename(filename)])
+    finally:
+        shutil.rmtree(directory)
+    print gridded
+    print "OK"
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding: utf-8
+import numpy as np
+import eustace.surface_temperature
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The cloud mask classes of the pixels that are ingested by default.
+DEFAULT_CLOUDMASK_CLASSES = (1, 4)
+
+
+class IngestFilterException(Exception):
+    pass
+
+
+class IngestFilter(object):
+    """
+    Selects the pixels to ingest, when populating the database.
+
+    The latitude limits select bands, like build_where_sql in db.py,
+    i.e. lat < lat_less_than OR lat > lat_greater_than, so that
+    IngestFilter(lat_less_than=-50, lat_greater_than=50) selects both
+    polar regions.
+
+    The algorithms are names or families, e.g. "SST" for all the SST
+    algorithms, and are matched against the algorithm retrieving the
+    unperturbed surface temperature.
+
+    The filters are meant to be applied in the order of the methods
+    below, so that the values of pixels (or blocks) that are filtered
+    out by the latitudes are never read.
+    """
+    def __init__(self, lat_less_than=None, lat_greater_than=None,
+                 cloudmask_classes=DEFAULT_CLOUDMASK_CLASSES,
+                 t11_greater_than=None, t11_less_than=None,
+                 algorithms=None):
+        self.lat_less_than = lat_less_than
+        self.lat_greater_than = lat_greater_than
+        self.cloudmask_classes = list(cloudmask_classes)
+        self.t11_greater_than = t11_greater_than
+        self.t11_less_than = t11_less_than
+        self.algorithms = None
+        if algorithms is not None:
+            self.algorithms = []
+            for family in algorithms:
+                matching = [algorithm for algorithm in eustace.surface_temperature.ALGORITHMS
+                            if algorithm == family or algorithm.startswith("%s_" % (family))]
+                if len(matching) == 0:
+                    raise IngestFilterException("Unknown algorithm '%s'. Must be one of '%s', "
+                                                "or the start of them, e.g. 'SST'." % (
+                            family, "', '".join(eustace.surface_temperature.ALGORITHMS)))
+                self.algorithms.extend(matching)
+            self._algorithm_codes = [eustace.surface_temperature.ALGORITHM_CODES[algorithm]
+                                     for algorithm in self.algorithms]
+
+    def __repr__(self):
+        return ("IngestFilter(lat < %s or lat > %s, cloudmask in %s, "
+                "%s < t11 < %s, algorithms: %s)" % (
+                self.lat_less_than, self.lat_greater_than, self.cloudmask_classes,
+                self.t11_greater_than, self.t11_less_than,
+                "all" if self.algorithms is None else ", ".join(self.algorithms)))
+
+    @property
+    def has_lat_bands(self):
+        return self.lat_less_than is not None or self.lat_greater_than is not None
+
+    def lat_mask(self, lat):
+        """
+        The pixels within the latitude bands. Pixels without latitude
+        are never within.
+        """
+        if not self.has_lat_bands:
+            return ~np.isnan(lat)
+        mask = np.zeros(np.shape(lat), dtype=np.bool)
+        with np.errstate(invalid="ignore"):
+            if self.lat_less_than is not None:
+                mask |= lat < self.lat_less_than
+            if self.lat_greater_than is not None:
+                mask |= lat > self.lat_greater_than
+        return mask
+
+    def any_in_lat_bands(self, lat):
+        """
+        False if none of the pixels are within the latitude bands, e.g.
+        for a block of rows outside the polar regions.
+        """
+        if not self.has_lat_bands:
+            return True
+        lat = lat[~np.isnan(lat)]
+        if lat.size == 0:
+            return False
+        return ((self.lat_less_than is not None and lat.min() < self.lat_less_than) or
+                (self.lat_greater_than is not None and lat.max() > self.lat_greater_than))
+
+    def cloudmask_mask(self, cloudmask):
+        return np.in1d(cloudmask, self.cloudmask_classes).reshape(np.shape(cloudmask))
+
+    def t11_mask(self, t11):
+        mask = np.ones(np.shape(t11), dtype=np.bool)
+        with np.errstate(invalid="ignore"):
+            if self.t11_greater_than is not None:
+                mask &= t11 > self.t11_greater_than
+            if self.t11_less_than is not None:
+                mask &= t11 < self.t11_less_than
+        return mask
+
+    def algorithm_mask(self, algorithms):
+        """
+        The pixels retrieved by the algorithms, given as algorithm codes.
+        """
+        if self.algorithms is None:
+            return np.ones(np.shape(algorithms), dtype=np.bool)
+        return np.in1d(algorithms, self._algorithm_codes).reshape(np.shape(algorithms))
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    """
+    lat = np.array([[-80.0, -40.0, np.NaN], [10.0, 55.0, 89.0]])
+    ingest_filter = IngestFilter(lat_less_than=-50, lat_greater_than=50)
+    assert(ingest_filter.lat_mask(lat).tolist() == [[True, False, False], [False, True, True]])
+    assert(ingest_filter.any_in_lat_bands(lat))
+    assert(not ingest_filter.any_in_lat_bands(np.array([[-40.0, 10.0, np.NaN]])))
+    assert(IngestFilter().lat_mask(lat).tolist() == [[True, True, False], [True, True, True]])
+
+    cloudmask = np.array([[0, 1, 2], [3, 4, 1]], dtype=np.uint8)
+    assert(IngestFilter().cloudmask_mask(cloudmask).tolist() == [[False, True, False],
+                                                                [False, True, True]])
+
+    t11 = np.array([250.0, 270.0, 280.0])
+    assert(IngestFilter(t11_greater_than=260).t11_mask(t11).tolist() == [False, True, True])
+
+    ingest_filter = IngestFilter(algorithms=["SST", "IST"])
+    assert(len(ingest_filter.algorithms) == 4)
+    codes = np.array([eustace.surface_temperature.ALGORITHM_CODES[algorithm]
+                      for algorithm in eustace.surface_temperature.ALGORITHMS])
+    assert(ingest_filter.algorithm_mask(codes).tolist() == [True] * 4 + [False] * 3)
+
+    try:
+        IngestFilter(algorithms=["SS"])
+        assert(False)
+    except IngestFilterException:
+        pass
+    print ingest_filter
+    print "OK"
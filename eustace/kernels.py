@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+A per pixel kernel retrieving the perturbed surface temperatures in one
+pass, without the temporary arrays of the NumPy version in
+eustace.perturbation and eustace.surface_temperature. The kernel is
+compiled with numba the first time it is used, if numba is installed.
+Otherwise the NumPy version is used.
+
+The kernel is plain Python, so it is also run uncompiled, e.g. by the
+test below.
+"""
+import math
+import threading
+import numpy as np
+import eustace.coefficients
+import eustace.surface_temperature
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+import logging
+LOG = logging.getLogger(__name__)
+
+BACKENDS = ["auto", "numba", "numpy"]
+
+_CODES = eustace.surface_temperature.ALGORITHM_CODES
+_ST_ALGORITHM = eustace.surface_temperature.ST_ALGORITHM
+_SST_DAY = _CODES[_ST_ALGORITHM.SST_DAY]
+_SST_NIGHT = _CODES[_ST_ALGORITHM.SST_NIGHT]
+_SST_TWILIGHT = _CODES[_ST_ALGORITHM.SST_TWILIGHT]
+_IST = _CODES[_ST_ALGORITHM.IST]
+_MIZT_DAY = _CODES[_ST_ALGORITHM.MIZT_SST_IST_DAY]
+_MIZT_NIGHT = _CODES[_ST_ALGORITHM.MIZT_SST_IST_NIGHT]
+_MIZT_TWILIGHT = _CODES[_ST_ALGORITHM.MIZT_SST_IST_TWILIGHT]
+
+# The coefficients given to the kernel, in this order.
+COEFFICIENT_NAMES = (["%s_sst_night" % (name) for name in "abcdef"] +
+                     ["gain_sst_night", "offset_sst_night"] +
+                     ["%s_sst_day" % (name) for name in "abcdefg"] +
+                     ["%s_ist_%s" % (name, band) for band in eustace.coefficients.IST_BANDS
+                      for name in "abcd"])
+
+# The indexes of the coefficients in COEFFICIENT_NAMES, used by the
+# kernel. The a, b, c and d coefficients of an ist band follow its
+# first index.
+_A_SST_NIGHT = COEFFICIENT_NAMES.index("a_sst_night")
+_B_SST_NIGHT = COEFFICIENT_NAMES.index("b_sst_night")
+_C_SST_NIGHT = COEFFICIENT_NAMES.index("c_sst_night")
+_D_SST_NIGHT = COEFFICIENT_NAMES.index("d_sst_night")
+_E_SST_NIGHT = COEFFICIENT_NAMES.index("e_sst_night")
+_F_SST_NIGHT = COEFFICIENT_NAMES.index("f_sst_night")
+_GAIN_SST_NIGHT = COEFFICIENT_NAMES.index("gain_sst_night")
+_OFFSET_SST_NIGHT = COEFFICIENT_NAMES.index("offset_sst_night")
+_A_SST_DAY = COEFFICIENT_NAMES.index("a_sst_day")
+_B_SST_DAY = COEFFICIENT_NAMES.index("b_sst_day")
+_C_SST_DAY = COEFFICIENT_NAMES.index("c_sst_day")
+_D_SST_DAY = COEFFICIENT_NAMES.index("d_sst_day")
+_E_SST_DAY = COEFFICIENT_NAMES.index("e_sst_day")
+_F_SST_DAY = COEFFICIENT_NAMES.index("f_sst_day")
+_G_SST_DAY = COEFFICIENT_NAMES.index("g_sst_day")
+_IST_BAND_0, _IST_BAND_1, _IST_BAND_2 = [COEFFICIENT_NAMES.index("a_ist_%s" % (band))
+                                         for band in eustace.coefficients.IST_BANDS]
+
+_backend = "auto"
+_compiled_kernel = None
+_compile_lock = threading.Lock()
+
+
+class KernelException(Exception):
+    pass
+
+
+def set_backend(backend):
+    """
+    The backend used by perturb, "numba", "numpy" or "auto", which is
+    numba if installed.
+    """
+    global _backend
+    if backend not in BACKENDS:
+        raise KernelException("Unknown backend '%s'. Must be one of '%s'." % (
+                backend, "', '".join(BACKENDS)))
+    if backend == "numba" and numba is None:
+        raise KernelException("The numba backend needs numba, which is not installed.")
+    _backend = backend
+
+
+def use_kernel(coeff):
+    """
+    True if the kernel is used for the coefficients. Only the
+    coefficients of a single satellite are supported by the kernel.
+    """
+    if _backend == "numpy" or numba is None:
+        return False
+    return hasattr(coeff, "satellite_code") and np.ndim(coeff.satellite_code) == 0
+
+
+def pack_coefficients(coeff):
+    """
+    The coefficients of the satellite, in the order of
+    COEFFICIENT_NAMES.
+    """
+    return np.array([coeff.registry.vector(name)[coeff.satellite_code]
+                     for name in COEFFICIENT_NAMES], dtype=np.float64)
+
+
+def _perturbed_surface_temperatures(c, t11_K, t12_K, t37_K, t_clim_K,
+                                    sun_zenith_angle, sat_zenith_angle,
+                                    epsilon_11, epsilon_12, epsilon_37,
+                                    t11, t12, t37, algorithm, surface_temp):
+    """
+    The kernel. Adds the epsilons to the temperatures of the pixels,
+    selects the algorithms and retrieves the sanity checked surface
+    temperatures, writing them into the 2d arrays (pixels x
+    perturbations). See eustace.perturbation.perturb.
+    """
+    number_of_pixels, number_of_perturbations = surface_temp.shape
+    for i in range(number_of_pixels):
+        s_teta = 1.0 / math.cos(math.radians(sat_zenith_angle[i])) - 1.0
+        sun = sun_zenith_angle[i]
+        has_t37 = not math.isnan(t37_K[i])
+        for k in range(number_of_perturbations):
+            p11 = t11_K[i] + epsilon_11[i, k]
+            p12 = t12_K[i] + epsilon_12[i, k]
+            p37 = t37_K[i] + epsilon_37[i, k]
+            if not has_t37:
+                epsilon_37[i, k] = np.nan
+            t11[i, k] = p11
+            t12[i, k] = p12
+            t37[i, k] = p37
+            dt = p11 - p12
+
+            # The day state, see select_surface_temperature_algorithms.
+            day = sun <= 90 or math.isnan(p37)
+            twilight = not day and sun < 110
+            night = not day and not twilight
+
+            # The ist coefficients of the band, see get_ist_bands.
+            if p11 < 240.0:
+                band = _IST_BAND_0
+            elif p11 < 260.0:
+                band = _IST_BAND_1
+            else:
+                band = _IST_BAND_2
+
+            ist = 0.0
+            sst_day = 0.0
+            sst_night = 0.0
+            if p11 >= 268.95 and p11 < 270.95:
+                if day:
+                    code = _MIZT_DAY
+                elif night:
+                    code = _MIZT_NIGHT
+                else:
+                    code = _MIZT_TWILIGHT
+            elif p11 >= 270.95:
+                if day:
+                    code = _SST_DAY
+                elif night:
+                    code = _SST_NIGHT
+                else:
+                    code = _SST_TWILIGHT
+            else:
+                code = _IST
+
+            if code == _IST or code >= _MIZT_DAY:
+                ist = (c[band] + c[band + 1] * p11 + c[band + 2] * dt +
+                       c[band + 3] * (dt * s_teta))
+            if not night:
+                sst_day = ((c[_A_SST_DAY] + c[_B_SST_DAY] * s_teta) * p11
+                           + (c[_C_SST_DAY] + c[_D_SST_DAY] * s_teta
+                              + c[_E_SST_DAY] * t_clim_K[i]) * dt
+                           + c[_F_SST_DAY] + c[_G_SST_DAY] * s_teta)
+            if not day:
+                sst_night = ((c[_A_SST_NIGHT] + c[_B_SST_NIGHT] * s_teta) * p37
+                             + (c[_C_SST_NIGHT] + c[_D_SST_NIGHT] * s_teta) * dt
+                             + c[_E_SST_NIGHT] + c[_F_SST_NIGHT] * s_teta
+                             + c[_GAIN_SST_NIGHT] * s_teta + c[_OFFSET_SST_NIGHT])
+
+            if code == _SST_DAY:
+                st = sst_day
+            elif code == _SST_NIGHT:
+                st = sst_night
+            elif code == _IST:
+                st = ist
+            elif code == _SST_TWILIGHT:
+                st = (sun - 110) * (-0.05) * sst_day + (sun - 90) * 0.05 * sst_night
+            else:
+                mizt_day = (p11 - 270.95) * (-0.5) * ist + (p11 - 268.95) * 0.5 * sst_day
+                mizt_night = (p11 - 270.95) * (-0.5) * ist + (p11 - 268.95) * 0.5 * sst_night
+                if code == _MIZT_DAY:
+                    st = mizt_day
+                elif code == _MIZT_NIGHT:
+                    st = mizt_night
+                else:
+                    st = (sun - 110) * (-0.05) * mizt_day + (sun - 90) * 0.05 * mizt_night
+
+            # The sanity check, see sanity_check_surface_temperatures.
+            if st < p11 or st < 150.0 or st > 350.0:
+                st = np.nan
+            algorithm[i, k] = code
+            surface_temp[i, k] = st
+
+
+def _get_kernel():
+    global _compiled_kernel
+    with _compile_lock:
+        if _compiled_kernel is None:
+            LOG.info("Compiling the kernel with numba %s." % (numba.__version__))
+            _compiled_kernel = numba.njit(nogil=True, cache=True)(_perturbed_surface_temperatures)
+        return _compiled_kernel
+
+
+def perturb_block(coeff, block, t11_K, t12_K, t37_K, t_clim_K,
+                  sun_zenith_angle, sat_zenith_angle, kernel=None):
+    """
+    Retrieves the perturbed surface temperatures of the block, whose
+    epsilons are set, like the rest of eustace.perturbation.perturb.
+    """
+    if kernel is None:
+        kernel = _get_kernel()
+    kernel(pack_coefficients(coeff),
+           *([np.ascontiguousarray(values) for values in
+              (t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle, sat_zenith_angle)] +
+             [block.epsilon_11, block.epsilon_12, block.epsilon_37,
+              block.t11, block.t12, block.t37, block.algorithm, block.surface_temp]))
+    return block
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    The kernel, uncompiled and compiled if numba is installed, gives the
+    surface temperatures of the scalar get_surface_temperature.
+    """
+    import eustace.perturbation
+    random_state = np.random.RandomState(1)
+    number_of_pixels, number_of_perturbations = 200, 5
+    t11_K = random_state.uniform(230, 280, number_of_pixels)
+    t12_K = t11_K - random_state.uniform(-0.5, 2.0, number_of_pixels)
+    t37_K = t11_K + random_state.uniform(-1.0, 3.0, number_of_pixels)
+    t37_K[::7] = np.NaN
+    t_clim_K = t11_K + 1.0
+    sun_zenith_angle = random_state.uniform(40, 130, number_of_pixels)
+    sat_zenith_angle = random_state.uniform(0, 60, number_of_pixels)
+    buffers = eustace.perturbation.PerturbationBuffers(number_of_pixels,
+                                                       number_of_perturbations)
+    block = buffers.get_block(number_of_pixels)
+    shape = block.surface_temp.shape
+    for values, sigma in [(block.epsilon_11, 0.5), (block.epsilon_12, 0.5), (block.epsilon_37, 0.5)]:
+        values[:] = random_state.normal(0.0, sigma, shape)
+    epsilons = [block.epsilon_11.copy(), block.epsilon_12.copy(), block.epsilon_37.copy()]
+
+    kernels = [_perturbed_surface_temperatures]
+    if numba is not None:
+        kernels.append(_get_kernel())
+    with eustace.coefficients.Coefficients("noaa18") as coeff:
+        for kernel in kernels:
+            block.epsilon_11[:], block.epsilon_12[:], block.epsilon_37[:] = epsilons
+            perturb_block(coeff, block, t11_K, t12_K, t37_K, t_clim_K,
+                          sun_zenith_angle, sat_zenith_angle, kernel)
+            assert(np.isnan(block.epsilon_37[np.isnan(t37_K)]).all())
+            for i in range(number_of_pixels):
+                for k in range(number_of_perturbations):
+                    algorithm = eustace.surface_temperature.select_surface_temperature_algorithm(
+                        sun_zenith_angle[i], block.t11[i, k], block.t37[i, k])
+                    assert(eustace.surface_temperature.ALGORITHMS[block.algorithm[i, k]] == algorithm)
+                    st = eustace.surface_temperature.get_surface_temperature(
+                        algorithm, coeff, block.t11[i, k], block.t12[i, k], block.t37[i, k],
+                        t_clim_K[i], sun_zenith_angle[i], sat_zenith_angle[i])
+                    assert(np.allclose(block.surface_temp[i, k], st, equal_nan=True))
+    print "OK (%s)" % ("numba %s" % (numba.__version__) if numba is not None else "uncompiled")
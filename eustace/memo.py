@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+A memo of the perturbations of pixels, keyed on the inputs of the
+retrieval. The channels and angles of the granules are quantized
+integers, decoded with a gain and offset, so many pixels of a granule
+have the same t11, t12, t37, t_clim, sun and satellite zenith angles.
+Such pixels of a block of rows get the perturbations of the first of
+them, instead of being perturbed again.
+
+The pixels with the same inputs then have the same perturbations, which
+are still perturbations of the inputs, but no longer independent of
+each other. Each pixel still weighs the same in the statistics, as the
+pixels differ in e.g. lat, lon and sea ice fraction, by which the
+statistics select and bin them, but the pixel, whose perturbations a
+pixel has, is stored with the pixel (the memo pixel), so that the
+statistics can count the independent values, and resample the
+perturbations of a memo pixel together, see create_std_table.py.
+
+The memo only holds the pixels of a block, so that the pixel perturbed
+for the inputs only depends on the rows of the block, and not on the
+blocks perturbed before it, e.g. by the same worker process. The
+lookups and hits are counted by the algorithm of the pixels, see
+log_statistics.
+"""
+import collections
+import numpy as np
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The arrays of the perturbations of a pixel, which are memoised.
+_FIELDS = ["algorithm", "epsilon_11", "epsilon_12", "epsilon_37", "surface_temp"]
+
+
+class MemoException(Exception):
+    pass
+
+
+def get_keys(*inputs):
+    """
+    A key per pixel, the bytes of the inputs of the pixel, i.e. equal
+    keys for equal inputs. NaN, e.g. a missing t37, equals NaN.
+    """
+    values = np.ascontiguousarray(np.column_stack([np.asarray(values, dtype=np.float64)
+                                                   for values in inputs]))
+    # All NaN are made the same NaN.
+    values[np.isnan(values)] = np.NaN
+    return values.view(np.dtype((np.void, values.dtype.itemsize * values.shape[1])))[:, 0]
+
+
+class PerturbationMemo(object):
+    """
+    The memo of the perturbations of the pixels of a block, and the
+    counts of the lookups and hits.
+    """
+    def __init__(self):
+        # [lookups, hits] by algorithm name.
+        self.counts = collections.defaultdict(lambda: [0, 0])
+
+    def __repr__(self):
+        return "PerturbationMemo()"
+
+    def perturb(self, keys, algorithm_names, perturb_pixels):
+        """
+        The perturbations of the pixels of a block, as arrays of
+        <number of pixels> x <number of perturbations> of the fields in
+        _FIELDS, followed by the index of the memo pixel of each pixel,
+        the pixel that was perturbed for its inputs.
+        perturb_pixels(indexes) perturbs the pixels of the indexes, and
+        returns a block of the perturbations, see
+        eustace.perturbation.perturb. It is only called for the first
+        pixel of each of the inputs.
+        """
+        _, first_pixels, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        block = perturb_pixels(first_pixels)
+        memo_pixels = first_pixels[inverse]
+
+        # The hits are the pixels, which were not perturbed.
+        hits = memo_pixels != np.arange(len(keys))
+        for name in np.unique(algorithm_names):
+            pixels = algorithm_names == name
+            self.counts[name][0] += int(pixels.sum())
+            self.counts[name][1] += int(hits[pixels].sum())
+
+        return tuple(getattr(block, field)[inverse] for field in _FIELDS) + (memo_pixels,)
+
+    def pop_counts(self):
+        """
+        The counts so far, which are reset, e.g. to add them to the
+        counts of another process, see add_counts.
+        """
+        counts = dict(self.counts)
+        self.counts.clear()
+        return counts
+
+    def add_counts(self, counts):
+        for name, (lookups, hits) in counts.items():
+            self.counts[name][0] += lookups
+            self.counts[name][1] += hits
+
+    def log_statistics(self):
+        lookups = sum([counts[0] for counts in self.counts.values()])
+        hits = sum([counts[1] for counts in self.counts.values()])
+        LOG.info("Memo: %i of %i pixels (%.1f%%) reused perturbations." % (
+                hits, lookups, 100.0 * hits / max(lookups, 1)))
+        for name in sorted(self.counts.keys()):
+            lookups, hits = self.counts[name]
+            LOG.info("Memo: %-22s %i of %i pixels (%.1f%%)." % (
+                    name, hits, lookups, 100.0 * hits / max(lookups, 1)))
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    Pixels with the same inputs get the perturbations of the first of
+    them, their memo pixel, and the blocks do not share their pixels.
+    """
+    Block = collections.namedtuple("Block", _FIELDS)
+
+    def perturb_pixels(indexes):
+        perturbed.extend(indexes.tolist())
+        values = np.arange(len(indexes) * 3, dtype=np.float64).reshape(len(indexes), 3) + len(perturbed)
+        return Block(np.zeros(values.shape, dtype=np.int8), values, values, values, values)
+
+    t11 = np.array([250.0, 260.0, 250.0, 250.0, 270.0])
+    t37 = np.array([np.NaN, 1.0, np.NaN, 2.0, 1.0])
+    names = np.array(["IST", "IST", "IST", "IST", "SST_DAY"])
+    keys = get_keys(t11, t37)
+    assert(keys[0] == keys[2] and keys[0] != keys[3])
+
+    memo = PerturbationMemo()
+    perturbed = []
+    values = memo.perturb(keys, names, perturb_pixels)
+    assert(sorted(perturbed) == [0, 1, 3, 4])
+    assert(np.array_equal(values[4][0], values[4][2]))
+    assert(not np.array_equal(values[4][0], values[4][3]))
+    assert(values[5].tolist() == [0, 1, 0, 3, 4])
+    assert(dict(memo.counts) == {"IST": [4, 1], "SST_DAY": [1, 0]})
+
+    # Another block perturbs its own pixels.
+    perturbed = []
+    again = memo.perturb(keys[2:], names[2:], perturb_pixels)
+    assert(sorted(perturbed) == [0, 1, 2] and again[5].tolist() == [0, 1, 2])
+    memo.log_statistics()
+    print "OK"
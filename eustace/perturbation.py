@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# coding: utf-8
+import logging
+import resource
+import collections
+import numpy as np
+import eustace.surface_temperature
+import eustace.random_streams
+import eustace.kernels
+
+LOG = logging.getLogger(__name__)
+
+# The number of arrays in the buffers, which are of size
+# <number of pixels> x <number of perturbations>. The epsilons (3),
+# the perturbed temperatures (3) and the perturbed surface temperature.
+_NUMBER_OF_BUFFER_ARRAYS = 7
+
+# While retrieving the perturbed surface temperatures, temporary arrays
+# of the same size are created. The terms shared by the algorithms (see
+# eustace.surface_temperature.SurfaceTemperatureTerms), the combinations
+# of the terms and the random values.
+_NUMBER_OF_TEMPORARY_ARRAYS = 11
+
+# Boolean masks and the algorithm codes, one byte per value.
+_NUMBER_OF_BYTE_ARRAYS = 12
+
+# The values of a scenario, copied out of the buffers to be inserted,
+# while the next scenarios and blocks are perturbed. The epsilons (3)
+# and the perturbed surface temperature, and, in bytes, the index of
+# the pixel, the algorithm code and the name of the algorithm.
+_NUMBER_OF_OUTPUT_ARRAYS = 4
+_OUTPUT_BYTES = (np.dtype(np.int64).itemsize + 1 +
+                 np.array(eustace.surface_temperature.ALGORITHMS).dtype.itemsize)
+
+# The random numbers drawn once for all the scenarios of a sweep, and
+# the copy of those of the pixels perturbed by a scenario.
+_NUMBER_OF_SWEEP_NORMAL_ARRAYS = 2 * eustace.random_streams.NUMBER_OF_NORMALS
+
+
+class PerturbationException(Exception):
+    pass
+
+
+# The perturbations for a block of pixels. All the arrays are of size
+# <number of pixels> x <number of perturbations>.
+PerturbedBlock = collections.namedtuple("PerturbedBlock",
+                                        ["algorithm",
+                                         "epsilon_11", "epsilon_12", "epsilon_37",
+                                         "t11", "t12", "t37",
+                                         "surface_temp"])
+
+
+def bytes_per_perturbation(dtype=np.float64, number_of_scenarios=1):
+    """
+    The estimated peak memory usage per pixel and perturbation, of
+    perturbing a block of pixels with the scenarios of a sweep, i.e. the
+    buffers and the temporary arrays, shared by the scenarios, the
+    values of each scenario, and, with more than one scenario, the
+    random numbers shared by the scenarios.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    shared_bytes = (itemsize * (_NUMBER_OF_BUFFER_ARRAYS + _NUMBER_OF_TEMPORARY_ARRAYS)
+                    + _NUMBER_OF_BYTE_ARRAYS)
+    if number_of_scenarios > 1:
+        shared_bytes += np.dtype(np.float64).itemsize * _NUMBER_OF_SWEEP_NORMAL_ARRAYS
+    return shared_bytes + number_of_scenarios * (itemsize * _NUMBER_OF_OUTPUT_ARRAYS +
+                                                 _OUTPUT_BYTES)
+
+
+def block_peak_bytes(buffers, number_of_pixels, number_of_scenarios=1):
+    """
+    The estimated peak memory usage of perturbing a block of pixels,
+    i.e. the buffers, which are allocated for the largest block, and the
+    other arrays of the pixels of the block, see bytes_per_perturbation.
+    """
+    other_bytes = (bytes_per_perturbation(buffers.dtype, number_of_scenarios) -
+                   buffers.dtype.itemsize * _NUMBER_OF_BUFFER_ARRAYS)
+    return buffers.nbytes + number_of_pixels * buffers.number_of_perturbations * other_bytes
+
+
+def rows_per_block(memory_budget_bytes, number_of_columns,
+                   number_of_perturbations, dtype=np.float64, number_of_scenarios=1):
+    """
+    The number of swath rows that can be perturbed at a time, with the
+    scenarios of a sweep, within the memory budget. At least one row is
+    returned, even if it does not fit within the budget.
+    """
+    bytes_per_row = (number_of_columns * number_of_perturbations *
+                     bytes_per_perturbation(dtype, number_of_scenarios))
+    rows = int(memory_budget_bytes // bytes_per_row)
+    if rows < 1:
+        LOG.warning("A single row needs %.1f MB, which exceeds the memory "
+                    "budget of %.1f MB." % (bytes_per_row / 1024.0**2,
+                                            memory_budget_bytes / 1024.0**2))
+        return 1
+    return rows
+
+
+def row_blocks(number_of_rows, rows_per_block):
+    """
+    Yields the (start, stop) rows of the blocks.
+    """
+    for start in range(0, number_of_rows, rows_per_block):
+        yield start, min(start + rows_per_block, number_of_rows)
+
+
+def max_rss_mb():
+    """
+    The peak resident memory of the process so far, in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory of the process, so that peak_rss_mb
+    gives the peak of e.g. a block. Linux resets it by writing 5 to
+    /proc/self/clear_refs. Returns False, if it could not be reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def peak_rss_mb():
+    """
+    The peak resident memory of the process since reset_peak_rss, in
+    MB, or since the process started, if it can not be read from
+    /proc/self/status.
+    """
+    try:
+        with open("/proc/self/status", "r") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return max_rss_mb()
+
+
+class PerturbationBuffers(object):
+    """
+    The arrays for the perturbations, which are reused from block to
+    block, so that they are only allocated once.
+    """
+    def __init__(self, number_of_pixels, number_of_perturbations,
+                 dtype=np.float64):
+        self.number_of_pixels = number_of_pixels
+        self.number_of_perturbations = number_of_perturbations
+        self.dtype = np.dtype(dtype)
+
+        shape = (number_of_pixels, number_of_perturbations)
+        self.algorithm = np.empty(shape, dtype=np.int8)
+        self.epsilon_11 = np.empty(shape, dtype=self.dtype)
+        self.epsilon_12 = np.empty(shape, dtype=self.dtype)
+        self.epsilon_37 = np.empty(shape, dtype=self.dtype)
+        self.t11 = np.empty(shape, dtype=self.dtype)
+        self.t12 = np.empty(shape, dtype=self.dtype)
+        self.t37 = np.empty(shape, dtype=self.dtype)
+        self.surface_temp = np.empty(shape, dtype=self.dtype)
+
+    @property
+    def nbytes(self):
+        return sum([a.nbytes for a in self.get_block(self.number_of_pixels)])
+
+    def get_block(self, number_of_pixels):
+        """
+        Views of the buffers for the first number_of_pixels pixels.
+        """
+        if number_of_pixels > self.number_of_pixels:
+            raise PerturbationException("The buffers have room for %i pixels, "
+                                        "not %i." % (self.number_of_pixels,
+                                                     number_of_pixels))
+        return PerturbedBlock(*[getattr(self, name)[:number_of_pixels]
+                                for name in PerturbedBlock._fields])
+
+
+def perturb(coeff, buffers, t11_K, t12_K, t37_K, t_clim_K,
+            sigma_11, sigma_12, sigma_37, sun_zenith_angle, sat_zenith_angle,
+            random_state):
+    """
+    Array version of get_n_perturbed_temeratures, perturbing all the
+    pixels at once. The inputs are 1d arrays with a value per pixel,
+    and the number of perturbations is given by the buffers.
+
+    Returns a PerturbedBlock of views into the buffers, which are
+    overwritten by the next call.
+
+    The random numbers are drawn from random_state, a numpy RandomState,
+    or the random streams of the pixels, see
+    eustace.random_streams.PixelStreams.
+
+    The perturbed surface temperatures are retrieved by the kernel in
+    eustace.kernels, if numba is installed, see eustace.kernels.set_backend.
+    """
+    block = buffers.get_block(len(t11_K))
+    shape = block.surface_temp.shape
+
+    # Calculate the gauss.
+    if hasattr(random_state, "get_standard_normals"):
+        normals_11, normals_12, normals_37 = random_state.get_standard_normals(shape[1])
+        np.multiply(normals_11, sigma_11, out=block.epsilon_11, casting="unsafe")
+        np.multiply(normals_12, sigma_12, out=block.epsilon_12, casting="unsafe")
+        np.multiply(normals_37, sigma_37, out=block.epsilon_37, casting="unsafe")
+    else:
+        block.epsilon_11[:] = random_state.normal(0.0, sigma_11, shape)
+        block.epsilon_12[:] = random_state.normal(0.0, sigma_12, shape)
+        block.epsilon_37[:] = random_state.normal(0.0, sigma_37, shape)
+
+    if eustace.kernels.use_kernel(coeff):
+        return eustace.kernels.perturb_block(coeff, block, t11_K, t12_K, t37_K, t_clim_K,
+                                             sun_zenith_angle, sat_zenith_angle)
+
+    np.add(t11_K[:, np.newaxis], block.epsilon_11, out=block.t11)
+    np.add(t12_K[:, np.newaxis], block.epsilon_12, out=block.t12)
+    np.add(t37_K[:, np.newaxis], block.epsilon_37, out=block.t37)
+
+    # Missing t37 is not perturbed, like in get_n_perturbed_temeratures.
+    block.epsilon_37[np.isnan(t37_K)] = np.NaN
+
+    # Pick algorithm for the perturbed values.
+    block.algorithm[:] = eustace.surface_temperature.select_surface_temperature_algorithms(
+        sun_zenith_angle[:, np.newaxis],
+        block.t11,
+        block.t37)
+
+    # Calculate the perturbed temperatures.
+    block.surface_temp[:] = eustace.surface_temperature.get_surface_temperatures(
+        block.algorithm,
+        coeff,
+        block.t11,
+        block.t12,
+        block.t37,
+        t_clim_K[:, np.newaxis],
+        sun_zenith_angle[:, np.newaxis],
+        sat_zenith_angle[:, np.newaxis])
+    return block
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Counter based random numbers (Philox4x32-10, Salmon et al. 2011), so
+that the random numbers of a perturbation only depend on where it is,
+
+(satellite, granule, random seed) -> the key
+(row, column, perturbation)       -> the counter
+
+and not on the order the pixels are perturbed in, the size of the
+blocks, or the process or node perturbing them.
+
+The perturbations of a pixel are either independent random draws, a
+Latin hypercube, or a scrambled Sobol sequence, see SAMPLINGS. The
+stratified samplings cover the (t11, t12, t37) noise more evenly, so
+the statistics of the perturbations converge with fewer perturbations.
+"""
+import hashlib
+import numpy as np
+
+import logging
+LOG = logging.getLogger(__name__)
+
+_PHILOX_M0 = np.uint64(0xD2511F53)
+_PHILOX_M1 = np.uint64(0xCD9E8D57)
+_PHILOX_W0 = 0x9E3779B9
+_PHILOX_W1 = 0xBB67AE85
+_MASK_32 = np.uint64(0xFFFFFFFF)
+_SHIFT_32 = np.uint64(32)
+PHILOX_ROUNDS = 10
+
+# The number of normal random numbers per perturbation, for epsilon 11,
+# epsilon 12 and epsilon 37.
+NUMBER_OF_NORMALS = 3
+
+# The samplings of the perturbations of a pixel.
+# random: Independent draws.
+# lhs:    A Latin hypercube, i.e. each of the N perturbations in its own
+#         1/N quantile of each normal, randomly paired.
+# sobol:  The first N points of a Sobol sequence, digitally shifted
+#         (scrambled) per pixel. Best with N a power of 2.
+SAMPLINGS = ["random", "lhs", "sobol"]
+
+# The third word of the counters of the per pixel random numbers of the
+# samplings, which are not used for the perturbations.
+_PIXEL_COUNTER = 0xFFFFFFFF
+
+# The direction numbers (s, a, m) of the Sobol dimensions after the
+# first, from Joe and Kuo (2008).
+_SOBOL_DIRECTIONS = [(1, 0, [1]),
+                     (2, 1, [1, 3])]
+_SOBOL_BITS = 32
+
+# The coefficients of the inverse normal cdf by Acklam.
+_ACKLAM_A = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+             1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+_ACKLAM_B = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+             6.680131188771972e+01, -1.328068155288572e+01]
+_ACKLAM_C = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+             -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+_ACKLAM_D = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+             3.754408661907416e+00]
+_ACKLAM_LOW = 0.02425
+
+
+class RandomStreamsException(Exception):
+    pass
+
+
+def philox4x32(counter, key, rounds=PHILOX_ROUNDS):
+    """
+    Philox4x32 of the counters, an array of (..., 4) uint32, with the
+    key, two uint32. Returns the (..., 4) random uint32.
+    """
+    counter = np.asarray(counter, dtype=np.uint32)
+    if counter.shape[-1] != 4:
+        raise RandomStreamsException("The counters must be (..., 4), not %s." % (
+                str(counter.shape)))
+    c0, c1, c2, c3 = [counter[..., i].astype(np.uint64) for i in range(4)]
+    k0, k1 = [int(k) & 0xFFFFFFFF for k in key]
+    for i in range(rounds):
+        if i > 0:
+            k0 = (k0 + _PHILOX_W0) & 0xFFFFFFFF
+            k1 = (k1 + _PHILOX_W1) & 0xFFFFFFFF
+        product0 = _PHILOX_M0 * c0
+        product1 = _PHILOX_M1 * c2
+        c0 = (product1 >> _SHIFT_32) ^ c1 ^ np.uint64(k0)
+        c1 = product1 & _MASK_32
+        c2 = (product0 >> _SHIFT_32) ^ c3 ^ np.uint64(k1)
+        c3 = product0 & _MASK_32
+    return np.stack([c0, c1, c2, c3], axis=-1).astype(np.uint32)
+
+
+def box_muller(u0, u1):
+    """
+    Two standard normal random numbers from two uniform uint32.
+    """
+    # u0 is in (0, 1], so that the log is finite.
+    r = np.sqrt(-2.0 * np.log((u0.astype(np.float64) + 1.0) / 2.0**32))
+    theta = (2.0 * np.pi / 2.0**32) * u1.astype(np.float64)
+    return r * np.cos(theta), r * np.sin(theta)
+
+
+def inverse_normal_cdf(p):
+    """
+    The standard normal quantiles of p, in (0, 1), by the rational
+    approximation of Acklam, with a relative error below 1.2e-9.
+    """
+    p = np.asarray(p, dtype=np.float64)
+    x = np.empty(p.shape)
+    a, b, c, d = _ACKLAM_A, _ACKLAM_B, _ACKLAM_C, _ACKLAM_D
+
+    central = (p >= _ACKLAM_LOW) & (p <= 1 - _ACKLAM_LOW)
+    q = p[central] - 0.5
+    r = q * q
+    x[central] = ((((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r + a[5]) * q /
+                  (((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1))
+
+    for tail, sign in [(p < _ACKLAM_LOW, 1), (p > 1 - _ACKLAM_LOW, -1)]:
+        q = np.sqrt(-2 * np.log(p[tail] if sign == 1 else 1 - p[tail]))
+        x[tail] = sign * ((((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5]) /
+                          ((((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1))
+    return x
+
+
+def _uniforms(random):
+    """
+    Uniforms in (0, 1) of random uint32.
+    """
+    return (random.astype(np.float64) + 0.5) / 2.0**32
+
+
+def get_sobol_direction_numbers(number_of_dimensions=NUMBER_OF_NORMALS):
+    """
+    The direction numbers, (dimensions, bits) uint32.
+    """
+    if number_of_dimensions > len(_SOBOL_DIRECTIONS) + 1:
+        raise RandomStreamsException("Only %i Sobol dimensions are defined." % (
+                len(_SOBOL_DIRECTIONS) + 1))
+    directions = np.zeros((number_of_dimensions, _SOBOL_BITS), dtype=np.uint64)
+    directions[0] = [1 << (_SOBOL_BITS - 1 - i) for i in range(_SOBOL_BITS)]
+    for dimension, (s, a, m) in enumerate(_SOBOL_DIRECTIONS[:number_of_dimensions - 1], 1):
+        v = [m[i] << (_SOBOL_BITS - 1 - i) for i in range(s)]
+        for i in range(s, _SOBOL_BITS):
+            value = v[i - s] ^ (v[i - s] >> s)
+            for k in range(1, s):
+                if (a >> (s - 1 - k)) & 1:
+                    value ^= v[i - k]
+            v.append(value)
+        directions[dimension] = v
+    return directions.astype(np.uint32)
+
+
+def get_sobol_points(number_of_points, number_of_dimensions=NUMBER_OF_NORMALS):
+    """
+    The first points of the Sobol sequence, (points, dimensions) uint32.
+    """
+    directions = get_sobol_direction_numbers(number_of_dimensions)
+    indexes = np.arange(number_of_points, dtype=np.uint64)
+    points = np.zeros((number_of_points, number_of_dimensions), dtype=np.uint32)
+    for bit in range(_SOBOL_BITS):
+        has_bit = ((indexes >> np.uint64(bit)) & np.uint64(1)).astype(np.bool)
+        if not has_bit.any():
+            break
+        points[has_bit] ^= directions[:, bit]
+    return points
+
+
+def get_key(satellite_id, granule_id, random_seed=1):
+    """
+    The key of the granule, two uint32.
+    """
+    digest = hashlib.md5("%s/%s/%i" % (satellite_id, granule_id, random_seed)).digest()
+    return tuple(int(k) for k in np.frombuffer(digest[:8], dtype="<u4"))
+
+
+class RandomStreams(object):
+    """
+    The random streams of a granule. The normal random numbers of a
+    pixel and perturbation are always the same, whenever and however
+    they are drawn.
+
+    streams = RandomStreams(satellite_id, granule_id, random_seed)
+    epsilon_11, epsilon_12, epsilon_37 = streams.get_standard_normals(rows, columns, 100)
+
+    With a stratified sampling, the perturbations of a pixel depend on
+    the number of perturbations.
+    """
+    def __init__(self, satellite_id, granule_id, random_seed=1, sampling="random"):
+        if sampling not in SAMPLINGS:
+            raise RandomStreamsException("Unknown sampling '%s'. Must be one of '%s'." % (
+                    sampling, "', '".join(SAMPLINGS)))
+        self.satellite_id = str(satellite_id)
+        self.granule_id = granule_id
+        self.random_seed = random_seed
+        self.sampling = sampling
+        self.key = get_key(self.satellite_id, granule_id, random_seed)
+
+    def __repr__(self):
+        return "RandomStreams(%s, %s, %i, %s)" % (self.satellite_id, self.granule_id,
+                                                  self.random_seed, self.sampling)
+
+    def _get_random(self, rows, columns, number_of_perturbations, word=0,
+                    first_perturbation=0):
+        """
+        The random uint32 of the pixels and perturbations, (pixels,
+        perturbations, 4), with the last word of the counter set to word.
+        """
+        counter = np.zeros((len(rows), number_of_perturbations, 4), dtype=np.uint32)
+        counter[..., 0] = rows[:, np.newaxis]
+        counter[..., 1] = columns[:, np.newaxis]
+        counter[..., 2] = np.arange(first_perturbation, first_perturbation + number_of_perturbations)
+        counter[..., 3] = word
+        return philox4x32(counter, self.key)
+
+    def _get_pixel_random(self, rows, columns):
+        """
+        The random uint32 of the pixels, (pixels, 4).
+        """
+        counter = np.zeros((len(rows), 4), dtype=np.uint32)
+        counter[:, 0] = rows
+        counter[:, 1] = columns
+        counter[:, 2] = _PIXEL_COUNTER
+        return philox4x32(counter, self.key)
+
+    def get_pixel_uniforms(self, rows, columns):
+        """
+        A uniform random number in (0, 1) of each pixel, given by the
+        rows and columns in the swath, e.g. to subsample the pixels. The
+        number is independent of the perturbations of the pixel.
+        """
+        return _uniforms(self._get_pixel_random(np.asarray(rows), np.asarray(columns))[:, 3])
+
+    def get_standard_normals(self, rows, columns, number_of_perturbations,
+                             first_perturbation=0):
+        """
+        The standard normal random numbers of the pixels, given by the
+        rows and columns in the swath, NUMBER_OF_NORMALS arrays of
+        <number of pixels> x <number of perturbations>.
+
+        The perturbations start at first_perturbation, so that more
+        perturbations of the pixels can be drawn later, continuing the
+        streams. The Latin hypercube depends on the number of
+        perturbations, and is always drawn from the start.
+        """
+        rows = np.asarray(rows)
+        columns = np.asarray(columns)
+        if self.sampling == "lhs":
+            if first_perturbation != 0:
+                raise RandomStreamsException("The lhs sampling can not be continued.")
+            # The quantile of each perturbation, randomly permuted per
+            # pixel and normal, and a random point within it.
+            random = self._get_random(rows, columns, number_of_perturbations)
+            order = self._get_random(rows, columns, number_of_perturbations, word=1)
+            strata = np.argsort(order[..., :NUMBER_OF_NORMALS], axis=1)
+            uniforms = (strata + _uniforms(random[..., :NUMBER_OF_NORMALS])) / number_of_perturbations
+            return tuple(inverse_normal_cdf(uniforms[..., i]) for i in range(NUMBER_OF_NORMALS))
+        elif self.sampling == "sobol":
+            # The same points for all the pixels, shifted by a random
+            # xor per pixel.
+            points = get_sobol_points(first_perturbation + number_of_perturbations)[first_perturbation:]
+            shifts = self._get_pixel_random(rows, columns)[:, :NUMBER_OF_NORMALS]
+            uniforms = _uniforms(points[np.newaxis, :, :] ^ shifts[:, np.newaxis, :])
+            return tuple(inverse_normal_cdf(uniforms[..., i]) for i in range(NUMBER_OF_NORMALS))
+
+        random = self._get_random(rows, columns, number_of_perturbations,
+                                  first_perturbation=first_perturbation)
+        z0, z1 = box_muller(random[..., 0], random[..., 1])
+        z2, z3 = box_muller(random[..., 2], random[..., 3])
+        return z0, z1, z2
+
+    def for_pixels(self, rows, columns, first_perturbation=0):
+        return PixelStreams(self, rows, columns, first_perturbation)
+
+
+class PixelStreams(object):
+    """
+    The random streams of some pixels, see eustace.perturbation.perturb.
+    """
+    def __init__(self, random_streams, rows, columns, first_perturbation=0):
+        self.random_streams = random_streams
+        self.rows = rows
+        self.columns = columns
+        self.first_perturbation = first_perturbation
+
+    def get_standard_normals(self, number_of_perturbations):
+        return self.random_streams.get_standard_normals(self.rows, self.columns,
+                                                        number_of_perturbations,
+                                                        self.first_perturbation)
+
+
+class DrawnNormals(object):
+    """
+    Standard normal random numbers already drawn for some pixels, e.g.
+    by PixelStreams, so that several perturbations of the pixels, e.g.
+    with different sigmas, use the same random numbers. See
+    eustace.perturbation.perturb.
+    """
+    def __init__(self, normals):
+        self.normals = normals
+
+    def get_standard_normals(self, number_of_perturbations):
+        if self.normals[0].shape[1] != number_of_perturbations:
+            raise RandomStreamsException("%i perturbations are drawn, not %i." % (
+                    self.normals[0].shape[1], number_of_perturbations))
+        return self.normals
+
+    def select(self, pixels):
+        """
+        The random numbers of some of the pixels, by index or mask.
+        """
+        return DrawnNormals(tuple(normals[pixels] for normals in self.normals))
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    The known answers of Random123, and the same numbers for a pixel,
+    whichever pixels are drawn with it.
+    """
+    assert(philox4x32([0, 0, 0, 0], (0, 0)).tolist() ==
+           [0x6627e8d5, 0xe169c58d, 0xbc57ac4c, 0x9b00dbd8])
+    assert(philox4x32([0xffffffff] * 4, (0xffffffff, 0xffffffff)).tolist() ==
+           [0x408f276d, 0x41c83b0e, 0xa20bc7c6, 0x6d5451fd])
+    assert(philox4x32([0x243f6a88, 0x85a308d3, 0x13198a2e, 0x03707344],
+                      (0xa4093822, 0x299f31d0)).tolist() ==
+           [0xd16cfe09, 0x94fdcceb, 0x5001e420, 0x24126ea1])
+
+    streams = RandomStreams("noaa18", "noaa18_20080901_1157_99999_satproj_00000_12119")
+    normals = streams.get_standard_normals(np.arange(100), np.arange(100) % 7, 50)
+    some = streams.get_standard_normals([42, 3], [0, 3], 60)
+    for i in range(NUMBER_OF_NORMALS):
+        assert(np.array_equal(some[i][0, :50], normals[i][42]))
+        assert(np.array_equal(some[i][1, :50], normals[i][3]))
+    continued = streams.get_standard_normals([42, 3], [0, 3], 20, first_perturbation=40)
+    for i in range(NUMBER_OF_NORMALS):
+        assert(np.array_equal(continued[i], some[i][:, 40:]))
+    assert(abs(np.mean(normals)) < 0.05 and abs(np.std(normals) - 1) < 0.05)
+
+    # The stratified samplings have one perturbation in each quantile.
+    assert(np.allclose(inverse_normal_cdf([0.025, 0.5, 0.975, 1e-6]),
+                       [-1.959963985, 0.0, 1.959963985, -4.753424309], atol=1e-8))
+    assert(get_sobol_points(4).tolist() ==
+           [[0, 0, 0], [2**31, 2**31, 2**31], [2**30, 3 * 2**30, 3 * 2**30],
+            [3 * 2**30, 2**30, 2**30]])
+    for sampling in ["lhs", "sobol"]:
+        stratified = RandomStreams("noaa18", "noaa18_20080901_1157_99999_satproj_00000_12119",
+                                   sampling=sampling)
+        normals = stratified.get_standard_normals(np.arange(10), np.arange(10), 64)
+        for i in range(NUMBER_OF_NORMALS):
+            quantiles = np.searchsorted(inverse_normal_cdf(np.arange(1, 64) / 64.0),
+                                        normals[i], side="right")
+            assert((np.sort(quantiles, axis=1) == np.arange(64)).all())
+        assert(np.array_equal(stratified.get_standard_normals([3], [3], 64)[1][0], normals[1][3]))
+    sobol = RandomStreams("noaa18", "noaa18_20080901_1157_99999_satproj_00000_12119",
+                          sampling="sobol")
+    assert(np.array_equal(sobol.get_standard_normals([3], [3], 24, first_perturbation=40)[2][0],
+                          normals[2][3][40:]))
+
+    uniforms = streams.get_pixel_uniforms(np.arange(1000), np.arange(1000) % 7)
+    assert(((uniforms > 0) & (uniforms < 1)).all() and abs(uniforms.mean() - 0.5) < 0.05)
+    assert(streams.get_pixel_uniforms([42], [0])[0] == uniforms[42])
+
+    other = RandomStreams("noaa18", "noaa18_20080901_1339_99999_satproj_00000_12120")
+    assert(not np.array_equal(other.get_standard_normals([0], [0], 10)[0],
+                              streams.get_standard_normals([0], [0], 10)[0]))
+    print "OK"
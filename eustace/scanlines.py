@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding: utf-8
+import hashlib
+import numpy as np
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The geolocation is compared with this many decimals, in degrees,
+# i.e. ~0.1 m, which is well below the differences between scanlines,
+# and above the rounding of the stored geolocation.
+DEFAULT_DECIMALS = 6
+
+# The number of rows read at a time, when hashing a model.
+_ROWS_PER_READ = 256
+
+
+def get_scanline_hashes(lat, lon, decimals=DEFAULT_DECIMALS):
+    """
+    A hash of the geolocation of each scanline (row). Rows without any
+    geolocation get None, and are never duplicates.
+    """
+    scale = 10.0 ** decimals
+    hashes = []
+    for row_lat, row_lon in zip(np.asarray(lat), np.asarray(lon)):
+        if np.isnan(row_lat).all() or np.isnan(row_lon).all():
+            hashes.append(None)
+            continue
+        # NaN is rounded to the same integer, wherever it is.
+        row = np.round(np.concatenate([row_lat, row_lon]) * scale)
+        row[np.isnan(row)] = np.iinfo(np.int64).min
+        hashes.append(hashlib.md5(row.astype(np.int64).tostring()).digest())
+    return hashes
+
+
+def get_model_scanline_hashes(model, decimals=DEFAULT_DECIMALS):
+    """
+    The scanline hashes of the model, reading a block of rows at a time.
+    """
+    number_of_rows = model.shape[0]
+    hashes = []
+    for row_start in range(0, number_of_rows, _ROWS_PER_READ):
+        row_stop = min(row_start + _ROWS_PER_READ, number_of_rows)
+        hashes.extend(get_scanline_hashes(model.block("lat", row_start, row_stop),
+                                          model.block("lon", row_start, row_stop),
+                                          decimals))
+    return hashes
+
+
+def find_duplicate_scanlines(hashes, previous_hashes):
+    """
+    The scanlines that are also in the previous granule, which owns
+    them. Returns the row in the previous granule for every row, or -1
+    where the row is not a duplicate.
+    """
+    previous_rows = {}
+    for row, scanline_hash in enumerate(previous_hashes):
+        if scanline_hash is not None and scanline_hash not in previous_rows:
+            previous_rows[scanline_hash] = row
+
+    owner_rows = np.empty(len(hashes), dtype=np.int64)
+    owner_rows.fill(-1)
+    for row, scanline_hash in enumerate(hashes):
+        if scanline_hash is not None:
+            owner_rows[row] = previous_rows.get(scanline_hash, -1)
+    return owner_rows
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    Two granules, where the last 3 rows of the first are the first 3
+    rows of the second.
+    """
+    lat = np.linspace(50, 90, 10 * 4).reshape(10, 4)
+    lon = np.linspace(-10, 10, 10 * 4).reshape(10, 4)
+    next_lat = np.concatenate([lat[7:], lat[:7] - 45])
+    next_lon = np.concatenate([lon[7:], lon[:7]])
+    next_lat[4] = np.NaN
+
+    owner_rows = find_duplicate_scanlines(get_scanline_hashes(next_lat, next_lon),
+                                          get_scanline_hashes(lat, lon))
+    assert(owner_rows.tolist() == [7, 8, 9] + [-1] * 7)
+
+    # A small difference in the geolocation is another scanline.
+    owner_rows = find_duplicate_scanlines(get_scanline_hashes(next_lat + 1e-4, next_lon),
+                                          get_scanline_hashes(lat, lon))
+    assert((owner_rows == -1).all())
+    print "OK"
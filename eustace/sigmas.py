@@ -1,33 +1,59 @@
 import os
+import threading
 import logging
 LOG = logging.getLogger("__name__")
 
 SIGMAS_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "NEdT_NOAAs.txt")
-def get_sigmas(satellite_id):
-    LOG.info("Getting sigmas for %s" % satellite_id)
-    with open(SIGMAS_FILE) as fp:
+
+# The sigmas of all the satellites, by the file, read the first time
+# they are used.
+_SIGMAS = {}
+_SIGMAS_LOCK = threading.Lock()
+
+
+def read_sigmas(filename=SIGMAS_FILE):
+    """
+    The sigmas of all the satellites in the file, by satellite id.
+    """
+    all_sigmas = {}
+    with open(filename) as fp:
         # Headerline
         header = fp.readline()
         header = header.split("::")[1]
         header_keys = header.split()
-        
+
         # Read the values.
         for line in fp:
             line_parts = line.split()
-            if line_parts[0] == satellite_id:
-                sigmas = {}
-                for i, key in enumerate(header_keys):
-                    key = key.lower()
-                    try:
-                        sigmas[key] = float(line_parts[i])
-                    except IndexError, e:
-                        sigmas[key] = None
-                    except Exception, e:
-                        sigmas[key] = line_parts[i]
-                return sigmas
+            if len(line_parts) == 0 or line_parts[0] in all_sigmas:
+                continue
+            sigmas = {}
+            for i, key in enumerate(header_keys):
+                key = key.lower()
+                try:
+                    sigmas[key] = float(line_parts[i])
+                except IndexError, e:
+                    sigmas[key] = None
+                except Exception, e:
+                    sigmas[key] = line_parts[i]
+            all_sigmas[line_parts[0]] = sigmas
+    return all_sigmas
+
+
+def get_sigmas(satellite_id, filename=SIGMAS_FILE):
+    LOG.info("Getting sigmas for %s" % satellite_id)
+    with _SIGMAS_LOCK:
+        if filename not in _SIGMAS:
+            _SIGMAS[filename] = read_sigmas(filename)
+        all_sigmas = _SIGMAS[filename]
 
-    raise RuntimeError("Could not find sigmas for satellite: %s" % satellite_id)
+    if satellite_id not in all_sigmas:
+        raise RuntimeError("Could not find sigmas for satellite: %s" % satellite_id)
+    # A copy, so that the sigmas of the file are never changed.
+    return dict(all_sigmas[satellite_id])
 
 
 if __name__ == "__main__":
     print get_sigmas("metop02")
+    assert(get_sigmas("noaa6")["sigma_12"] is None)
+    assert(get_sigmas("noaa18") == get_sigmas("noaa18"))
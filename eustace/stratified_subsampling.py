@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Stratified subsampling of the pixels of a granule. The statistics of
+the perturbations are per algorithm and per bins of the covariates, so
+instead of all the pixels, only a number of pixels of each stratum,
+
+(algorithm, sun zenith bin, sat zenith bin, lat band, t11 - t12 bin)
+
+are perturbed per granule. The pixels of a stratum are picked at
+random, and each picked pixel has the inclusion weight
+
+number of pixels in the stratum / number of pixels picked,
+
+so that the weighted statistics of the subsample are unbiased
+estimates of the statistics of all the pixels, see get_weights.
+"""
+import numpy as np
+import eustace.surface_temperature
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The inner edges of the bins of the strata.
+DEFAULT_SUN_ZENITH_EDGES = range(10, 180, 10)
+DEFAULT_SAT_ZENITH_EDGES = range(10, 70, 10)
+DEFAULT_LAT_EDGES = range(-80, 90, 10)
+DEFAULT_T11_T12_EDGES = [0.0, 0.5, 1.0, 1.5, 2.0, 3.0]
+
+
+class StratifiedSubsamplingException(Exception):
+    pass
+
+
+class StratifiedSubsampling(object):
+    """
+    Picks at most pixels_per_stratum pixels of each stratum.
+    """
+    def __init__(self, pixels_per_stratum,
+                 sun_zenith_edges=DEFAULT_SUN_ZENITH_EDGES,
+                 sat_zenith_edges=DEFAULT_SAT_ZENITH_EDGES,
+                 lat_edges=DEFAULT_LAT_EDGES,
+                 t11_t12_edges=DEFAULT_T11_T12_EDGES):
+        if pixels_per_stratum < 1:
+            raise StratifiedSubsamplingException("At least one pixel per stratum is needed, not %i." % (
+                    pixels_per_stratum))
+        self.pixels_per_stratum = pixels_per_stratum
+        self.edges = [np.asarray(edges, dtype=np.float64)
+                      for edges in [sun_zenith_edges, sat_zenith_edges, lat_edges, t11_t12_edges]]
+        for edges in self.edges:
+            if (np.diff(edges) <= 0).any():
+                raise StratifiedSubsamplingException("The edges must increase, not %s." % (
+                        edges.tolist()))
+
+    def __repr__(self):
+        return "StratifiedSubsampling(%i pixels per stratum, %i strata)" % (
+            self.pixels_per_stratum, self.number_of_strata())
+
+    def _get_shape(self):
+        return tuple([len(eustace.surface_temperature.ALGORITHMS)] +
+                     [len(edges) + 1 for edges in self.edges])
+
+    def number_of_strata(self):
+        return int(np.prod(self._get_shape()))
+
+    def get_strata(self, algorithms, sun_zenith_angle, sat_zenith_angle, lat, t11_minus_t12):
+        """
+        The stratum of each pixel, by the algorithm codes and the bins
+        of the covariates.
+        """
+        bins = [np.digitize(values, edges) for values, edges in
+                zip([sun_zenith_angle, sat_zenith_angle, lat, t11_minus_t12], self.edges)]
+        return np.ravel_multi_index([np.asarray(algorithms, dtype=np.int64)] + bins,
+                                    self._get_shape())
+
+    def get_inclusion_weights(self, strata, uniforms):
+        """
+        The inclusion weight of each pixel, given its stratum and a
+        uniform random number, 0 for the pixels not picked. The pixels
+        with the smallest random numbers of each stratum are picked.
+        """
+        strata = np.asarray(strata)
+        weights = np.zeros(len(strata))
+        if len(strata) == 0:
+            return weights
+        order = np.lexsort((uniforms, strata))
+        _, first, inverse, counts = np.unique(strata[order], return_index=True,
+                                              return_inverse=True, return_counts=True)
+        picked = np.arange(len(strata)) - first[inverse] < self.pixels_per_stratum
+        weights[order[picked]] = (counts.astype(np.float64) /
+                                  np.minimum(counts, self.pixels_per_stratum))[inverse[picked]]
+        return weights
+
+
+def get_weights(numbers_of_perturbations, inclusion_weights=None):
+    """
+    The weight of each perturbation, the inclusion weight of its pixel
+    over the number of perturbations of the pixel, so that every pixel
+    weighs the same, also when the pixels were perturbed until
+    converged, and the pixels of a subsample stand for the pixels of
+    their stratum.
+
+    Without the number of perturbations of all the pixels, e.g. in
+    databases populated before it was stored, the perturbations weigh
+    the same. Pixels without an inclusion weight were not subsampled,
+    and weigh 1.
+    """
+    numbers_of_perturbations = np.array(numbers_of_perturbations, dtype=np.float64)
+    if np.isnan(numbers_of_perturbations).any():
+        LOG.warning("The number of perturbations is not stored for all the pixels. Not weighting.")
+        weights = np.ones(len(numbers_of_perturbations))
+    else:
+        weights = 1.0 / numbers_of_perturbations
+    if inclusion_weights is not None:
+        inclusion_weights = np.array(inclusion_weights, dtype=np.float64)
+        weights *= np.where(np.isnan(inclusion_weights), 1.0, inclusion_weights)
+    return weights
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    At most the pixels per stratum are picked, and the weighted counts
+    and means of the subsample are those of all the pixels.
+    """
+    random_state = np.random.RandomState(1)
+    number_of_pixels = 100000
+    algorithms = random_state.randint(0, 3, number_of_pixels)
+    sun_zenith_angle = random_state.uniform(40, 130, number_of_pixels)
+    sat_zenith_angle = random_state.uniform(0, 60, number_of_pixels)
+    lat = random_state.uniform(50, 90, number_of_pixels)
+    t11_minus_t12 = random_state.uniform(-0.5, 3.5, number_of_pixels)
+    values = sun_zenith_angle / 10.0 + algorithms + random_state.normal(0, 1, number_of_pixels)
+
+    subsampling = StratifiedSubsampling(5)
+    strata = subsampling.get_strata(algorithms, sun_zenith_angle, sat_zenith_angle, lat,
+                                    t11_minus_t12)
+    assert(((strata >= 0) & (strata < subsampling.number_of_strata())).all())
+    weights = subsampling.get_inclusion_weights(strata, random_state.uniform(0, 1, number_of_pixels))
+    picked = weights > 0
+    for stratum in np.unique(strata):
+        in_stratum = strata == stratum
+        assert(picked[in_stratum].sum() == min(5, in_stratum.sum()))
+        assert(np.isclose(weights[in_stratum].sum(), in_stratum.sum()))
+    assert(picked.sum() < number_of_pixels / 4)
+    assert(abs(np.average(values[picked], weights=weights[picked]) - values.mean()) < 0.05)
+    assert(subsampling.get_inclusion_weights([], []).tolist() == [])
+
+    assert(get_weights([2, 4], [3.0, None]).tolist() == [1.5, 0.25])
+    assert(get_weights([2, None]).tolist() == [1.0, 1.0])
+    print subsampling
+    print "OK"
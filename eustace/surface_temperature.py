@@ -133,6 +133,19 @@ def get_surface_temperature(st_algorithm, coeff, t11, t12, t37, t_clim,
      IST |                 IST                   |
          +---------------------------------------+
     """
+    st = _get_unchecked_surface_temperature(st_algorithm, coeff, t11, t12,
+                                            t37, t_clim, sun_zenith_angle,
+                                            sat_zenith_angle)
+    return sanity_check_surface_temperature(st, t11, t12)
+
+
+def _get_unchecked_surface_temperature(st_algorithm, coeff, t11, t12, t37,
+                                       t_clim, sun_zenith_angle,
+                                       sat_zenith_angle):
+    """
+    The surface temperature for the algorithm, before the sanity check.
+    Works on both single values and arrays.
+    """
     s_teta = sat_teta(sat_zenith_angle)
     st = None
 
@@ -163,9 +176,185 @@ def get_surface_temperature(st_algorithm, coeff, t11, t12, t37, t_clim,
                                                       sun_zenith_angle)
     else:
         raise SstException("Unknown sst algorithm, '%s'." % (str(st_algorithm)))
+    return st
+
+
+# The algorithms by their codes. The array functions below use the codes,
+# e.g. when selecting the algorithms for a whole block of pixels at once.
+ALGORITHMS = [ST_ALGORITHM.SST_DAY,
+              ST_ALGORITHM.SST_NIGHT,
+              ST_ALGORITHM.SST_TWILIGHT,
+              ST_ALGORITHM.IST,
+              ST_ALGORITHM.MIZT_SST_IST_DAY,
+              ST_ALGORITHM.MIZT_SST_IST_NIGHT,
+              ST_ALGORITHM.MIZT_SST_IST_TWILIGHT]
+ALGORITHM_CODES = dict((algorithm, code) for code, algorithm in enumerate(ALGORITHMS))
+
+
+def select_surface_temperature_algorithms(sun_zenith_angle, t11, t37):
+    """
+    Array version of select_surface_temperature_algorithm.
+    Returns the algorithm codes, see ALGORITHMS.
+    """
+    sun_zenith_angle, t11, t37 = np.broadcast_arrays(sun_zenith_angle, t11, t37)
+
+    # The day states, see _get_day_state.
+    day = (sun_zenith_angle <= 90) | np.isnan(t37)
+    twilight = ~day & (sun_zenith_angle < 110)
+    night = ~day & ~twilight
+
+    mizt = (t11 >= 268.95) & (t11 < 270.95)
+    sst = t11 >= 270.95
+
+    algorithms = np.empty(t11.shape, dtype=np.int8)
+    algorithms.fill(ALGORITHM_CODES[ST_ALGORITHM.IST])
+    for mask, algorithm in [(mizt & day, ST_ALGORITHM.MIZT_SST_IST_DAY),
+                            (mizt & night, ST_ALGORITHM.MIZT_SST_IST_NIGHT),
+                            (mizt & twilight, ST_ALGORITHM.MIZT_SST_IST_TWILIGHT),
+                            (sst & day, ST_ALGORITHM.SST_DAY),
+                            (sst & night, ST_ALGORITHM.SST_NIGHT),
+                            (sst & twilight, ST_ALGORITHM.SST_TWILIGHT)]:
+        algorithms[mask] = ALGORITHM_CODES[algorithm]
+    return algorithms
+
+
+def get_surface_temperatures(algorithms, coeff, t11, t12, t37, t_clim,
+                             sun_zenith_angle, sat_zenith_angle):
+    """
+    Array version of get_surface_temperature. The algorithms are the
+    algorithm codes for every pixel, see ALGORITHMS.
+
+    The coefficients may be per pixel, e.g. for pixels of several
+    satellites, see eustace.coefficients.PixelCoefficients.
+    """
+    terms = SurfaceTemperatureTerms(coeff, t11, t12, t37, t_clim,
+                                    sun_zenith_angle, sat_zenith_angle)
+    st = np.empty(terms.t11.shape, dtype=np.result_type(t11, t12, np.float32))
+    st.fill(np.NaN)
+    # Only the algorithms of the pixels are combined, and with all the
+    # pixels, as that is faster than selecting the pixels of each.
+    algorithms = np.asarray(algorithms)
+    counts = np.bincount(algorithms.ravel(), minlength=len(ALGORITHMS))
+    for code in np.nonzero(counts)[0]:
+        np.copyto(st, terms.get(ALGORITHMS[code]), where=algorithms == code)
+    return sanity_check_surface_temperatures(st, terms.t11)
+
+
+def get_candidate_surface_temperatures(coeff, t11, t12, t37, t_clim,
+                                       sun_zenith_angle, sat_zenith_angle):
+    """
+    The surface temperatures of all the algorithms for every pixel,
+    e.g. for comparing the candidate retrievals. The terms shared by the
+    algorithms are computed once. Returns the sanity checked surface
+    temperatures by algorithm, the selected algorithms (codes), and the
+    surface temperatures of the selected algorithms.
+
+    The night algorithms are NaN where there is no t37.
+    """
+    terms = SurfaceTemperatureTerms(coeff, t11, t12, t37, t_clim,
+                                    sun_zenith_angle, sat_zenith_angle)
+    candidates = {}
+    for st_algorithm in ALGORITHMS:
+        st = np.array(terms.get(st_algorithm), dtype=np.result_type(t11, t12, np.float32))
+        candidates[st_algorithm] = sanity_check_surface_temperatures(st, terms.t11)
+
+    algorithms = select_surface_temperature_algorithms(terms.sun_zenith_angle,
+                                                       terms.t11, terms.t37)
+    st = np.empty(terms.t11.shape, dtype=np.result_type(t11, t12, np.float32))
+    for code, st_algorithm in enumerate(ALGORITHMS):
+        mask = algorithms == code
+        st[mask] = candidates[st_algorithm][mask]
+    return candidates, algorithms, st
+
+
+# The terms used by the algorithms, see SurfaceTemperatureTerms.
+_TERMS = {ST_ALGORITHM.SST_DAY: ["sst_day"],
+          ST_ALGORITHM.SST_NIGHT: ["sst_night"],
+          ST_ALGORITHM.SST_TWILIGHT: ["sst_day", "sst_night"],
+          ST_ALGORITHM.IST: ["ist"],
+          ST_ALGORITHM.MIZT_SST_IST_DAY: ["ist", "sst_day"],
+          ST_ALGORITHM.MIZT_SST_IST_NIGHT: ["ist", "sst_night"],
+          ST_ALGORITHM.MIZT_SST_IST_TWILIGHT: ["ist", "sst_day", "sst_night"]}
+
+
+class SurfaceTemperatureTerms(object):
+    """
+    The terms shared by the algorithms, for a block of pixels: s_teta,
+    t11 - t12, and the IST, SST day and SST night temperatures. Each is
+    computed once, for all the pixels, when first used, and the
+    (unchecked) temperatures of the algorithms are combined from them,
+    e.g. MIZT twilight from IST, SST day and SST night.
+
+    SST night is NaN where there is no t37.
+    """
+    def __init__(self, coeff, t11, t12, t37, t_clim, sun_zenith_angle,
+                 sat_zenith_angle):
+        self.coeff = coeff
+        self.t11, self.t12, self.t37, self.t_clim, self.sun_zenith_angle, \
+            self.sat_zenith_angle = np.broadcast_arrays(t11, t12, t37, t_clim,
+                                                        sun_zenith_angle,
+                                                        sat_zenith_angle)
+        self.s_teta = sat_teta(self.sat_zenith_angle)
+        self.dt = self.t11 - self.t12
+        self._ist = None
+        self._sst_day = None
+        self._sst_night = None
+
+    @property
+    def ist(self):
+        if self._ist is None:
+            self._ist = _ice_surface_temperature(self.coeff, self.t11, self.dt,
+                                                 self.s_teta)
+        return self._ist
+
+    @property
+    def sst_day(self):
+        if self._sst_day is None:
+            self._sst_day = _sea_surface_temperature_day(self.coeff, self.t11, self.dt,
+                                                         self.t_clim, self.s_teta)
+        return self._sst_day
+
+    @property
+    def sst_night(self):
+        if self._sst_night is None:
+            self._sst_night = _sea_surface_temperature_night(self.coeff, self.t37, self.dt,
+                                                             self.s_teta)
+        return self._sst_night
+
+    def get(self, st_algorithm):
+        """
+        The unchecked surface temperatures of the algorithm.
+        """
+        if st_algorithm == ST_ALGORITHM.SST_DAY:
+            return self.sst_day
+        elif st_algorithm == ST_ALGORITHM.SST_NIGHT:
+            return self.sst_night
+        elif st_algorithm == ST_ALGORITHM.SST_TWILIGHT:
+            return surface_temperature_twilight(self.sst_day, self.sst_night,
+                                                self.sun_zenith_angle)
+        elif st_algorithm == ST_ALGORITHM.IST:
+            return self.ist
+        elif st_algorithm == ST_ALGORITHM.MIZT_SST_IST_DAY:
+            return _marginal_ice_zone_temperature(self.t11, self.ist, self.sst_day)
+        elif st_algorithm == ST_ALGORITHM.MIZT_SST_IST_NIGHT:
+            return _marginal_ice_zone_temperature(self.t11, self.ist, self.sst_night)
+        elif st_algorithm == ST_ALGORITHM.MIZT_SST_IST_TWILIGHT:
+            return surface_temperature_twilight(
+                _marginal_ice_zone_temperature(self.t11, self.ist, self.sst_day),
+                _marginal_ice_zone_temperature(self.t11, self.ist, self.sst_night),
+                self.sun_zenith_angle)
+        raise SstException("Unknown sst algorithm, '%s'." % (str(st_algorithm)))
+
+
+def sanity_check_surface_temperatures(t_surface, t11):
+    """
+    Array version of sanity_check_surface_temperature. The invalid
+    temperatures are set to NaN, in place.
+    """
+    with np.errstate(invalid="ignore"):
+        t_surface[(t_surface < t11) | (t_surface < 150.0) | (t_surface > 350.0)] = np.NaN
+    return t_surface
 
-    return sanity_check_surface_temperature(st, t11, t12)
-    
 
 
 def ice_surface_temperature(coeff, t11, t12, s_teta):
@@ -173,8 +362,15 @@ def ice_surface_temperature(coeff, t11, t12, s_teta):
     Ice Surface Temperature algorithm
     IST split window algorithm from Key et al 1997.
     """
+    return _ice_surface_temperature(coeff, t11, t11 - t12, s_teta)
+
+
+def _ice_surface_temperature(coeff, t11, dt, s_teta):
+    """
+    See ice_surface_temperature, with dt = t11 - t12.
+    """
     a, b, c, d = coeff.get_ist_coefficients(t11)
-    return a + b * t11 + c * (t11 - t12) + d * ((t11 - t12) * s_teta)
+    return a + b * t11 + c * dt + d * (dt * s_teta)
 
 
 def marginal_ice_zone_temperature_day(coeff, t11, t12, t_clim, s_teta):
@@ -201,6 +397,10 @@ def marginal_ice_zone_temperature(coeff, t11, t12, sst, s_teta):
     sst and ist scaled linearly - relative to T11 in range 268.95K - 270.95K
     """
     ist = ice_surface_temperature(coeff, t11, t12, s_teta)
+    return _marginal_ice_zone_temperature(t11, ist, sst)
+
+
+def _marginal_ice_zone_temperature(t11, ist, sst):
     return ((t11 - 270.95) * (-0.5) * ist) + ((t11 - 268.95) * 0.5 * sst)
 
 
@@ -217,10 +417,17 @@ def sea_surface_temperature_day(coeff, t11, t12, t_clim, s_teta):
 
     Arctic SST algorithm for 'day' and 'night' from PLBorgne 2010
     """
+    return _sea_surface_temperature_day(coeff, t11, t11 - t12, t_clim, s_teta)
+
+
+def _sea_surface_temperature_day(coeff, t11, dt, t_clim, s_teta):
+    """
+    See sea_surface_temperature_day, with dt = t11 - t12.
+    """
     a_d, b_d, c_d, d_d, e_d, f_d, g_d = coeff.get_sst_day_coefficients()
     return (
         (a_d + b_d * s_teta) * (t11)
-        + (c_d + d_d * s_teta + e_d * (t_clim)) * (t11 - t12)
+        + (c_d + d_d * s_teta + e_d * (t_clim)) * dt
         + f_d
         + g_d * s_teta
         )
@@ -232,12 +439,20 @@ def sea_surface_temperature_night(coeff, t11, t12, t37, s_teta):
     """
     # If t37 is zero, we should never have gone in here...
     # Then something is wrong in the selection process.
-    assert(t37 is not None and not np.isnan(t37))
+    assert(t37 is not None and not np.any(np.isnan(t37)))
+    return _sea_surface_temperature_night(coeff, t37, t11 - t12, s_teta)
+
+
+def _sea_surface_temperature_night(coeff, t37, dt, s_teta):
+    """
+    See sea_surface_temperature_night, with dt = t11 - t12. NaN where
+    there is no t37.
+    """
     a_n, b_n, c_n, d_n, e_n, f_n, cor_n \
         = coeff.get_sst_night_coefficients(s_teta)
     return (
         (a_n + b_n * s_teta) * (t37)
-        + (c_n + d_n * s_teta) * (t11 - t12)
+        + (c_n + d_n * s_teta) * dt
         + e_n
         + f_n * s_teta
         + cor_n
@@ -354,3 +569,31 @@ if __name__ == "__main__":
         print get_surface_temperature(ST_ALGORITHM.MIZT_SST_IST_NIGHT, coeff,
                                       t11, t12, t37, t_clim, sun_zenith_angle,
                                       sat_zenith_angle)
+
+        # The candidates are those of the single value versions.
+        t11 = np.array([250.0, 269.5, 272.0, 272.0, 269.8])
+        t12 = t11 - np.array([0.5, 1.0, 1.5, 0.2, 0.7])
+        t37 = np.array([251.0, np.NaN, 273.0, 274.0, 270.5])
+        t_clim = t11 + 1
+        sun_zenith_angle = np.array([120.0, 80.0, 100.0, 115.0, 95.0])
+        sat_zenith_angle = np.array([10.0, 20.0, 30.0, 40.0, 50.0])
+        candidates, algorithms, st = get_candidate_surface_temperatures(
+            coeff, t11, t12, t37, t_clim, sun_zenith_angle, sat_zenith_angle)
+        assert(np.allclose(st, get_surface_temperatures(algorithms, coeff, t11, t12, t37, t_clim,
+                                                        sun_zenith_angle, sat_zenith_angle),
+                           equal_nan=True))
+        for i in range(len(t11)):
+            algorithm = select_surface_temperature_algorithm(sun_zenith_angle[i], t11[i], t37[i])
+            assert(ALGORITHMS[algorithms[i]] == algorithm)
+            for st_algorithm in ALGORITHMS:
+                if np.isnan(t37[i]) and st_algorithm in [ST_ALGORITHM.SST_NIGHT,
+                                                         ST_ALGORITHM.SST_TWILIGHT,
+                                                         ST_ALGORITHM.MIZT_SST_IST_NIGHT,
+                                                         ST_ALGORITHM.MIZT_SST_IST_TWILIGHT]:
+                    assert(np.isnan(candidates[st_algorithm][i]))
+                    continue
+                expected = get_surface_temperature(st_algorithm, coeff, t11[i], t12[i], t37[i],
+                                                   t_clim[i], sun_zenith_angle[i],
+                                                   sat_zenith_angle[i])
+                assert(np.allclose(candidates[st_algorithm][i], expected, equal_nan=True))
+        print "OK"
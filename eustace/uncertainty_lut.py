@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+A lookup table of the uncertainty of the retrieved surface temperature,
+the std of the perturbed surface temperatures of a pixel,
+std(p.surface_temp - s.surface_temp), over a grid of the features the
+uncertainty depends on, see FEATURES, for the coefficients and sigmas of
+a satellite.
+
+The table is computed once by Monte Carlo, see generate and
+create_uncertainty_lut.py, with the same retrieval as the perturbations.
+The uncertainty of the pixels of a swath is then interpolated from the
+table, all the pixels at once, instead of perturbing them, see
+UncertaintyLut.get_uncertainties.
+
+The pixels without t37 are always retrieved by the day algorithms, and
+have a table of their own, without the t37 feature.
+"""
+import itertools
+import warnings
+import numpy as np
+import eustace.perturbation
+import eustace.random_streams
+import eustace.surface_temperature
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The features of the pixels, the axes of the table.
+FEATURES = ["t11", "t11_minus_t12", "t37_minus_t11", "t_clim_minus_t11",
+            "sun_zenith_angle", "sat_zenith_angle"]
+
+# The features of the pixels without t37.
+FEATURES_WITHOUT_T37 = [feature for feature in FEATURES if feature != "t37_minus_t11"]
+
+# The grid of the features. The t11 axis has the thresholds of the
+# algorithms, and the sun zenith axis the day, twilight and night
+# thresholds, where the retrieval changes.
+DEFAULT_AXES = {
+    "t11": np.union1d(np.arange(230.0, 300.1, 2.5), [268.95, 269.95, 270.95]),
+    "t11_minus_t12": np.arange(-0.5, 3.51, 0.5),
+    "t37_minus_t11": np.arange(-2.0, 6.1, 2.0),
+    "t_clim_minus_t11": np.arange(-10.0, 15.1, 5.0),
+    "sun_zenith_angle": np.array([0.0, 90.0, 95.0, 100.0, 105.0, 110.0, 180.0]),
+    "sat_zenith_angle": np.arange(0.0, 70.1, 10.0),
+    }
+
+DEFAULT_NUMBER_OF_PERTURBATIONS = 200
+
+# The memory used for the perturbations of a block of grid points, in MB.
+DEFAULT_MEMORY_BUDGET_MB = 512
+
+# The granule id of the random streams of the table.
+_RANDOM_STREAMS_ID = "uncertainty_lut"
+
+
+class UncertaintyLutException(Exception):
+    pass
+
+
+def interpolate(axes, values, points):
+    """
+    Multilinear interpolation of the values on the grid of the axes, at
+    the points, an array per axis. The points outside the grid get the
+    values at its edges. The corners of the grid cell of a point that
+    are NaN are left out, and the weights of the others scaled up. NaN
+    where all the corners with a weight are NaN.
+    """
+    if values.shape != tuple(len(axis) for axis in axes):
+        raise UncertaintyLutException("The values are %s, not of the axes %s." % (
+                str(values.shape), str(tuple(len(axis) for axis in axes))))
+    indexes = []
+    fractions = []
+    for axis, x in zip(axes, points):
+        if len(axis) < 2:
+            raise UncertaintyLutException("An axis needs at least 2 values, not %i." % (len(axis)))
+        x = np.asarray(x, dtype=np.float64)
+        index = np.clip(np.searchsorted(axis, x, side="right") - 1, 0, len(axis) - 2)
+        indexes.append(index)
+        fractions.append(np.clip((x - axis[index]) / (axis[index + 1] - axis[index]), 0.0, 1.0))
+
+    total = np.zeros(np.shape(points[0]))
+    total_weight = np.zeros(np.shape(points[0]))
+    for corner in itertools.product([0, 1], repeat=len(axes)):
+        weight = np.ones(np.shape(points[0]))
+        for upper, fraction in zip(corner, fractions):
+            weight *= fraction if upper else 1.0 - fraction
+        corner_values = values[tuple(index + upper for index, upper in zip(indexes, corner))]
+        is_number = ~np.isnan(corner_values)
+        total += np.where(is_number, weight * np.where(is_number, corner_values, 0.0), 0.0)
+        total_weight += np.where(is_number, weight, 0.0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(total_weight > 0, total / total_weight, np.NaN)
+
+
+def get_features(t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle, sat_zenith_angle):
+    """
+    The features of the pixels, by the names in FEATURES.
+    """
+    return {"t11": t11_K,
+            "t11_minus_t12": t11_K - t12_K,
+            "t37_minus_t11": t37_K - t11_K,
+            "t_clim_minus_t11": t_clim_K - t11_K,
+            "sun_zenith_angle": sun_zenith_angle,
+            "sat_zenith_angle": sat_zenith_angle}
+
+
+def get_stds(coeff, sigmas, t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle, sat_zenith_angle,
+             random_streams, column, number_of_perturbations=DEFAULT_NUMBER_OF_PERTURBATIONS,
+             memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB):
+    """
+    The std of the perturbed surface temperatures of each pixel, a
+    block of pixels at a time, within the memory budget. The random
+    numbers of the pixels are those of the rows of the pixels in the
+    column of the random streams. NaN where the surface temperature,
+    or less than two of its perturbations, are not a number.
+    """
+    number_of_pixels = len(t11_K)
+    block_pixels = eustace.perturbation.rows_per_block(memory_budget_mb * 1024**2, 1,
+                                                       number_of_perturbations)
+    buffers = eustace.perturbation.PerturbationBuffers(min(block_pixels, number_of_pixels),
+                                                       number_of_perturbations)
+    algorithms = eustace.surface_temperature.select_surface_temperature_algorithms(
+        sun_zenith_angle, t11_K, t37_K)
+    st_truth_K = eustace.surface_temperature.get_surface_temperatures(
+        algorithms, coeff, t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle, sat_zenith_angle)
+
+    stds = np.empty(number_of_pixels)
+    stds.fill(np.NaN)
+    for start, stop in eustace.perturbation.row_blocks(number_of_pixels, block_pixels):
+        pixels = np.arange(start, stop)
+        block = eustace.perturbation.perturb(coeff, buffers,
+                                             t11_K[pixels], t12_K[pixels], t37_K[pixels],
+                                             t_clim_K[pixels],
+                                             sigmas["sigma_11"] or 0.0,
+                                             sigmas["sigma_12"] or 0.0,
+                                             sigmas["sigma_37"] or 0.0,
+                                             sun_zenith_angle[pixels], sat_zenith_angle[pixels],
+                                             random_streams.for_pixels(
+                                                 pixels, np.repeat(column, len(pixels))))
+        differences = block.surface_temp - st_truth_K[pixels, np.newaxis]
+        has_std = (~np.isnan(differences)).sum(axis=1) >= 2
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            stds[pixels[has_std]] = np.nanstd(differences[has_std], axis=1, ddof=1)
+        LOG.debug("Perturbed the pixels %i-%i of %i." % (start, stop, number_of_pixels))
+    return stds
+
+
+class UncertaintyLut(object):
+    """
+    The table of the uncertainties of a satellite, by the axes of the
+    features. The uncertainties of the pixels without t37 are in a
+    table of their own, by the same axes, apart from t37.
+    """
+    def __init__(self, satellite_id, axes, stds, stds_without_t37, sigmas,
+                 number_of_perturbations):
+        self.satellite_id = str(satellite_id)
+        self.axes = dict((feature, np.asarray(axes[feature], dtype=np.float64))
+                         for feature in FEATURES)
+        self.stds = stds
+        self.stds_without_t37 = stds_without_t37
+        self.sigmas = dict((name, sigmas[name]) for name in ["sigma_11", "sigma_12", "sigma_37"])
+        self.number_of_perturbations = number_of_perturbations
+
+    def __repr__(self):
+        return "UncertaintyLut(%s, %s, %i perturbations, %s)" % (
+            self.satellite_id, "x".join(["%i" % len(self.axes[feature]) for feature in FEATURES]),
+            self.number_of_perturbations, self.sigmas)
+
+    def save(self, filename):
+        """
+        Saves the table to a (compressed) numpy file.
+        """
+        arrays = dict(("axis_%s" % (feature), self.axes[feature]) for feature in FEATURES)
+        arrays.update(dict((name, np.NaN if value is None else value)
+                           for name, value in self.sigmas.items()))
+        np.savez_compressed(filename, satellite_id=self.satellite_id, stds=self.stds,
+                            stds_without_t37=self.stds_without_t37,
+                            number_of_perturbations=self.number_of_perturbations, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as arrays:
+            sigmas = dict((name, None if np.isnan(arrays[name]) else float(arrays[name]))
+                          for name in ["sigma_11", "sigma_12", "sigma_37"])
+            return cls(str(arrays["satellite_id"]),
+                       dict((feature, arrays["axis_%s" % (feature)]) for feature in FEATURES),
+                       arrays["stds"], arrays["stds_without_t37"], sigmas,
+                       int(arrays["number_of_perturbations"]))
+
+    def get_uncertainties(self, t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle,
+                          sat_zenith_angle):
+        """
+        The uncertainty of each pixel, interpolated from the table, see
+        interpolate.
+        """
+        features = get_features(*[np.asarray(values, dtype=np.float64) for values in
+                                  [t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle,
+                                   sat_zenith_angle]])
+        uncertainties = np.empty(len(features["t11"]))
+        has_t37 = ~np.isnan(features["t37_minus_t11"])
+        for pixels, stds, table_features in [(has_t37, self.stds, FEATURES),
+                                             (~has_t37, self.stds_without_t37, FEATURES_WITHOUT_T37)]:
+            uncertainties[pixels] = interpolate([self.axes[feature] for feature in table_features],
+                                                stds,
+                                                [features[feature][pixels] for feature in table_features])
+        return uncertainties
+
+
+def generate(coeff, sigmas, axes=None, number_of_perturbations=DEFAULT_NUMBER_OF_PERTURBATIONS,
+             memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, random_seed=1, sampling="random"):
+    """
+    Computes the table of the coefficients and sigmas, by perturbing a
+    pixel at each point of the grid of the axes, by default DEFAULT_AXES.
+    The random numbers of a grid point are drawn from the random streams
+    of the satellite, see eustace.random_streams.RandomStreams, so the
+    table is the same, however it is computed.
+    """
+    axes = dict(DEFAULT_AXES, **(axes or {}))
+    random_streams = eustace.random_streams.RandomStreams(coeff.sat_id, _RANDOM_STREAMS_ID,
+                                                          random_seed, sampling)
+    tables = []
+    for column, table_features in enumerate([FEATURES, FEATURES_WITHOUT_T37]):
+        shape = tuple(len(axes[feature]) for feature in table_features)
+        grid = dict((feature, values.ravel()) for feature, values in
+                    zip(table_features, np.meshgrid(*[axes[feature] for feature in table_features],
+                                                    indexing="ij")))
+        t11_K = grid["t11"]
+        if "t37_minus_t11" in grid:
+            t37_K = t11_K + grid["t37_minus_t11"]
+        else:
+            t37_K = np.empty(len(t11_K))
+            t37_K.fill(np.NaN)
+        LOG.info("Perturbing %i grid points, %s, %i times." % (len(t11_K), "x".join(map(str, shape)),
+                                                               number_of_perturbations))
+        stds = get_stds(coeff, sigmas, t11_K, t11_K - grid["t11_minus_t12"], t37_K,
+                        t11_K + grid["t_clim_minus_t11"], grid["sun_zenith_angle"],
+                        grid["sat_zenith_angle"], random_streams, column,
+                        number_of_perturbations, memory_budget_mb)
+        tables.append(stds.reshape(shape))
+    return UncertaintyLut(coeff.sat_id, axes, tables[0], tables[1], sigmas,
+                          number_of_perturbations)
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    The interpolation is exact for multilinear values, and the
+    interpolated uncertainties are close to the Monte Carlo ones.
+    """
+    import os
+    import tempfile
+    import eustace.coefficients
+
+    axes = [np.array([0.0, 1.0, 3.0]), np.array([-1.0, 1.0])]
+    grid = np.meshgrid(*axes, indexing="ij")
+    values = 2.0 * grid[0] - grid[1] + 0.5 * grid[0] * grid[1]
+    x, y = np.array([0.5, 2.0, 3.0, 5.0]), np.array([0.0, -0.5, 1.0, 1.0])
+    assert(np.allclose(interpolate(axes, values, [x, y])[:3], (2.0 * x - y + 0.5 * x * y)[:3]))
+    assert(np.isclose(interpolate(axes, values, [x, y])[3], 2.0 * 3.0 - 1.0 + 0.5 * 3.0))
+    values[0, 0] = np.NaN
+    assert(np.isclose(interpolate(axes, values, [[0.0], [0.0]])[0], values[0, 1]))
+
+    random_state = np.random.RandomState(1)
+    number_of_pixels = 50
+    t11_K = random_state.uniform(272, 285, number_of_pixels)
+    t12_K = t11_K - random_state.uniform(0.0, 2.0, number_of_pixels)
+    t37_K = t11_K + random_state.uniform(-1.0, 3.0, number_of_pixels)
+    t37_K[:10] = np.NaN
+    t_clim_K = t11_K + random_state.uniform(-2.0, 2.0, number_of_pixels)
+    sun_zenith_angle = random_state.uniform(40, 130, number_of_pixels)
+    sat_zenith_angle = random_state.uniform(0, 50, number_of_pixels)
+    sigmas = {"sigma_11": 0.1, "sigma_12": 0.15, "sigma_37": 0.2}
+    with eustace.coefficients.Coefficients("noaa18") as coeff:
+        # Only the t11 of the pixels.
+        lut = generate(coeff, sigmas, {"t11": np.arange(271.0, 287.0, 2.5)})
+        streams = eustace.random_streams.RandomStreams("noaa18", "test")
+        expected = get_stds(coeff, sigmas, t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle,
+                            sat_zenith_angle, streams, 0, 2000)
+    uncertainties = lut.get_uncertainties(t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle,
+                                          sat_zenith_angle)
+    relative_errors = np.abs(uncertainties - expected) / expected
+    assert(np.median(relative_errors) < 0.05 and relative_errors.max() < 0.15)
+
+    filename = os.path.join(tempfile.mkdtemp(), "noaa18.lut.npz")
+    lut.save(filename)
+    loaded = UncertaintyLut.load(filename)
+    assert(np.allclose(loaded.get_uncertainties(t11_K, t12_K, t37_K, t_clim_K,
+                                                sun_zenith_angle, sat_zenith_angle),
+                       uncertainties, rtol=0, atol=0, equal_nan=True))
+    os.remove(filename)
+    print lut
+    print "OK"
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+The variance of the perturbed surface temperatures by channel, i.e.
+how much of the uncertainty comes from the noise of t11, t12 and t37.
+
+Along with the perturbations of all the channels, the surface
+temperatures are retrieved with the epsilons of one channel at a time,
+from the same random numbers, and the partial derivatives of the
+surface temperatures give the linear (analytic) variance of each
+channel, (d st / d t)**2 * sigma**2.
+
+The sums are per algorithm of the pixels, and are added up over the
+blocks and granules, see Db.insert_variance_budget.
+"""
+import numpy as np
+import eustace.surface_temperature
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The channels, by the names of their epsilons and sigmas.
+CHANNELS = ["11", "12", "37"]
+
+# The perturbations of all the channels at once.
+ALL_CHANNELS = "all"
+
+# The step of the central differences, in K.
+DEFAULT_STEP_K = 0.01
+
+
+class VarianceBudget(object):
+    """
+    Computes the sums of the variance budget of the perturbations of a
+    block of pixels, see get_sums.
+    """
+    def __init__(self, step_K=DEFAULT_STEP_K):
+        self.step_K = step_K
+
+    def __repr__(self):
+        return "VarianceBudget(%g)" % (self.step_K)
+
+    def get_partial_derivatives(self, coeff, algorithms, t11_K, t12_K, t37_K, t_clim_K,
+                                sun_zenith_angle, sat_zenith_angle):
+        """
+        The partial derivatives of the surface temperatures with respect
+        to the temperature of each channel, by central differences, with
+        the algorithms of the pixels. NaN where either side is not a
+        number.
+        """
+        temperatures = {"11": t11_K, "12": t12_K, "37": t37_K}
+        partials = {}
+        for channel in CHANNELS:
+            sides = []
+            for step in [self.step_K, -self.step_K]:
+                stepped = dict(temperatures)
+                stepped[channel] = temperatures[channel] + step
+                sides.append(eustace.surface_temperature.get_surface_temperatures(
+                        algorithms, coeff, stepped["11"], stepped["12"], stepped["37"],
+                        t_clim_K, sun_zenith_angle, sat_zenith_angle))
+            partials[channel] = (sides[0] - sides[1]) / (2 * self.step_K)
+        return partials
+
+    def get_channel_surface_temperatures(self, coeff, block, t11_K, t12_K, t37_K, t_clim_K,
+                                         sun_zenith_angle, sat_zenith_angle):
+        """
+        The surface temperatures of the perturbations of the block, see
+        eustace.perturbation.perturb, with only the epsilons of one
+        channel added, by channel.
+        """
+        temperatures = {"11": t11_K, "12": t12_K, "37": t37_K}
+        epsilons = {"11": block.epsilon_11, "12": block.epsilon_12, "37": block.epsilon_37}
+        surface_temps = {}
+        for channel in CHANNELS:
+            perturbed = dict((name, values[:, np.newaxis])
+                             for name, values in temperatures.items())
+            perturbed[channel] = perturbed[channel] + epsilons[channel]
+            t11, t12, t37 = np.broadcast_arrays(perturbed["11"], perturbed["12"], perturbed["37"])
+            algorithms = eustace.surface_temperature.select_surface_temperature_algorithms(
+                sun_zenith_angle[:, np.newaxis], t11, t37)
+            surface_temps[channel] = eustace.surface_temperature.get_surface_temperatures(
+                algorithms, coeff, t11, t12, t37, t_clim_K[:, np.newaxis],
+                sun_zenith_angle[:, np.newaxis], sat_zenith_angle[:, np.newaxis])
+        return surface_temps
+
+    def get_sums(self, coeff, sigmas, block, algorithms, st_truth_K, t11_K, t12_K, t37_K,
+                 t_clim_K, sun_zenith_angle, sat_zenith_angle):
+        """
+        The sums of the differences from the unperturbed surface
+        temperatures, d = st - st_truth, of the perturbations of the
+        block, by the algorithm of the pixels, for all the channels and
+        each channel. Returns a list of (algorithm name, channel, number
+        of pixels, number of perturbations, sum(d), sum(d**2), sum of the
+        linear variance of the pixels).
+        """
+        partials = self.get_partial_derivatives(coeff, algorithms, t11_K, t12_K, t37_K,
+                                                t_clim_K, sun_zenith_angle, sat_zenith_angle)
+        linear_variances = dict((channel, (partials[channel] * (sigmas["sigma_%s" % (channel)] or 0.0))**2)
+                                for channel in CHANNELS)
+        linear_variances[ALL_CHANNELS] = sum([linear_variances[channel] for channel in CHANNELS])
+
+        surface_temps = self.get_channel_surface_temperatures(coeff, block, t11_K, t12_K, t37_K,
+                                                              t_clim_K, sun_zenith_angle,
+                                                              sat_zenith_angle)
+        surface_temps[ALL_CHANNELS] = block.surface_temp
+
+        sums = []
+        for code in np.unique(algorithms):
+            pixels = algorithms == code
+            for channel in [ALL_CHANNELS] + CHANNELS:
+                differences = (surface_temps[channel][pixels] -
+                               st_truth_K[pixels, np.newaxis]).astype(np.float64)
+                differences = differences[~np.isnan(differences)]
+                sums.append((eustace.surface_temperature.ALGORITHMS[code], channel,
+                             int(pixels.sum()), len(differences),
+                             float(differences.sum()), float(np.square(differences).sum()),
+                             float(np.nansum(linear_variances[channel][pixels]))))
+        return sums
+
+
+def get_variances(sums):
+    """
+    The variance of the perturbations, and the mean linear variance of
+    the pixels, from the sums of get_sums, added up, e.g. over the
+    granules.
+    """
+    number_of_pixels, number_of_perturbations, sum_d, sum_d2, linear_variance_sum = sums
+    if number_of_perturbations == 0:
+        return np.NaN, np.NaN
+    mean = sum_d / number_of_perturbations
+    return (sum_d2 / number_of_perturbations - mean**2,
+            linear_variance_sum / number_of_pixels)
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    For SST pixels far from the thresholds the retrieval is linear, so
+    the variances of the channels add up to the variance of all the
+    channels, and are the linear variances.
+    """
+    import eustace.coefficients
+    import eustace.perturbation
+    random_state = np.random.RandomState(1)
+    number_of_pixels = 100
+    t11_K = random_state.uniform(280, 290, number_of_pixels)
+    t12_K = t11_K - random_state.uniform(0.5, 1.5, number_of_pixels)
+    t37_K = t11_K + random_state.uniform(0.0, 1.0, number_of_pixels)
+    t_clim_K = t11_K + 1.0
+    sun_zenith_angle = random_state.uniform(40, 80, number_of_pixels)
+    sat_zenith_angle = random_state.uniform(0, 50, number_of_pixels)
+    sigmas = {"sigma_11": 0.1, "sigma_12": 0.2, "sigma_37": 0.3}
+    with eustace.coefficients.Coefficients("noaa18") as coeff:
+        algorithms = eustace.surface_temperature.select_surface_temperature_algorithms(
+            sun_zenith_angle, t11_K, t37_K)
+        st_truth_K = eustace.surface_temperature.get_surface_temperatures(
+            algorithms, coeff, t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle, sat_zenith_angle)
+        buffers = eustace.perturbation.PerturbationBuffers(number_of_pixels, 2000)
+        block = eustace.perturbation.perturb(coeff, buffers, t11_K, t12_K, t37_K, t_clim_K,
+                                             sigmas["sigma_11"], sigmas["sigma_12"],
+                                             sigmas["sigma_37"], sun_zenith_angle,
+                                             sat_zenith_angle, random_state)
+        sums = VarianceBudget().get_sums(coeff, sigmas, block, algorithms, st_truth_K,
+                                         t11_K, t12_K, t37_K, t_clim_K, sun_zenith_angle,
+                                         sat_zenith_angle)
+    variances = dict((values[1], get_variances(values[2:])) for values in sums)
+    assert([s[0] for s in sums] == [eustace.surface_temperature.ST_ALGORITHM.SST_DAY] * 4)
+    total = sum([variances[channel][0] for channel in CHANNELS])
+    assert(abs(total - variances[ALL_CHANNELS][0]) < 0.05 * total)
+    assert(variances["37"][0] < 1e-12)
+    for channel in [ALL_CHANNELS] + CHANNELS:
+        assert(abs(variances[channel][0] - variances[channel][1]) <= 0.05 * total)
+    print "OK"
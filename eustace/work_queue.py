@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+# coding: utf-8
+import os
+import time
+import uuid
+import errno
+import socket
+import threading
+
+import logging
+LOG = logging.getLogger(__name__)
+
+
+def default_worker_id():
+    """
+    Unique for the process, also across the nodes.
+    """
+    return "%s-%i" % (socket.gethostname(), os.getpid())
+
+
+def shard_filename(database_filename, worker_id):
+    """
+    The database file written by a worker,
+    e.g. /data/noaa18.sqlite3 -> /data/noaa18.<worker_id>.sqlite3
+    """
+    root, extension = os.path.splitext(database_filename)
+    return "%s.%s%s" % (root, worker_id, extension)
+
+
+class WorkQueue(object):
+    """
+    A queue of granules on a shared file system, for workers running on
+    several nodes without a scheduler.
+
+    The queue directory holds:
+
+      catalogue       The granules, one per line.
+      lock            Exists while a worker changes the state of the queue.
+                      It holds the worker and a token of the locking.
+      claims/<key>    The worker holding the granule. The modification
+                      time of the file is when the lease was last renewed.
+      done/<key>      The worker that finished the granule.
+
+    A worker claims the next granule that is neither done nor held by
+    another worker, while holding the lock. The claimed granules are
+    renewed in the background, every third of the lease time. If a
+    worker dies, its leases expire, and the granules are claimed by the
+    next worker looking for work. A worker, whose lease expired, can not
+    complete the granule, and must drop its values of the granule, as
+    must a worker releasing a granule, see complete and release.
+
+    The times are taken from the file system, i.e. the modification
+    time of the lock file, so that the clocks of the nodes do not have
+    to agree.
+
+    queue = WorkQueue(queue_directory)
+    queue.add(avhrr_filenames)
+    for avhrr_filename in queue.granules():
+        ... # Process the granule.
+        if not queue.complete(avhrr_filename):
+            ... # Drop the values of the granule.
+    """
+    CATALOGUE = "catalogue"
+    LOCK = "lock"
+    CLAIMS = "claims"
+    DONE = "done"
+
+    def __init__(self, queue_directory, worker_id=None, lease_seconds=600,
+                 stale_lock_seconds=60, poll_seconds=0.1):
+        self.queue_directory = queue_directory
+        self.worker_id = worker_id if worker_id is not None else default_worker_id()
+        self.lease_seconds = lease_seconds
+        self.stale_lock_seconds = stale_lock_seconds
+        self.poll_seconds = poll_seconds
+
+        for directory in [self.queue_directory,
+                          self._path(WorkQueue.CLAIMS),
+                          self._path(WorkQueue.DONE)]:
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # The number of granules held by other workers, at the last claim.
+        self.held_by_others = 0
+
+        # The granules claimed by this worker, which are being renewed.
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._renewer = None
+
+        # The token of the lock, of the thread holding it.
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "WorkQueue(%s, worker: %s)" % (self.queue_directory, self.worker_id)
+
+    def _path(self, *parts):
+        return os.path.join(self.queue_directory, *parts)
+
+    @staticmethod
+    def key(granule):
+        """
+        The file name used for the granule in the claims and done directories.
+        """
+        return os.path.basename(granule.strip())
+
+    def _lock(self):
+        """
+        Takes the lock. Creating a file with O_EXCL is atomic, also on
+        NFS (v3 and later). The file holds a token unique to this
+        locking, so that only the locking can remove it, see _unlock.
+        Returns the time of the file system.
+        """
+        lock_filename = self._path(WorkQueue.LOCK)
+        token = "%s %s" % (self.worker_id, uuid.uuid4().hex)
+        while True:
+            try:
+                fd = os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self._break_stale_lock(lock_filename)
+                time.sleep(self.poll_seconds)
+                continue
+
+            try:
+                os.write(fd, token)
+            finally:
+                os.close(fd)
+            self._local.token = token
+            return os.stat(lock_filename).st_mtime
+
+    def _break_stale_lock(self, lock_filename):
+        """
+        Removes the lock, if the worker holding it has not released it in
+        stale_lock_seconds, e.g. because it died while holding it.
+
+        The lock is renamed to a name of its own first, and only removed
+        if it is still the lock found stale. Otherwise, another waiter
+        broke the stale lock first, and the lock renamed is a fresh one,
+        which is put back.
+        """
+        stale_token = self._read(lock_filename)
+        try:
+            age = self._now() - os.stat(lock_filename).st_mtime
+        except OSError:
+            # Released meanwhile.
+            return
+        if stale_token is None or age <= self.stale_lock_seconds:
+            return
+
+        broken_filename = "%s.broken.%s.%s" % (lock_filename, self.worker_id, uuid.uuid4().hex)
+        try:
+            os.rename(lock_filename, broken_filename)
+        except OSError:
+            # Released, or broken by another waiter, meanwhile.
+            return
+        if self._read(broken_filename) == stale_token:
+            LOG.warning("Removed the stale lock '%s' of %s, which was %i seconds old." % (
+                    lock_filename, stale_token.split()[0], age))
+            os.remove(broken_filename)
+            return
+
+        # A fresh lock. Putting it back fails, if the lock was taken
+        # again meanwhile, as linking does not replace a file.
+        try:
+            os.link(broken_filename, lock_filename)
+        except OSError:
+            LOG.warning("Could not put back the lock '%s'." % (lock_filename))
+        os.remove(broken_filename)
+
+    def _unlock(self):
+        """
+        Removes the lock, if it is still the lock of this locking. It is
+        not, if it was broken as stale, and then taken by another worker.
+        """
+        lock_filename = self._path(WorkQueue.LOCK)
+        token, self._local.token = getattr(self._local, "token", None), None
+        if self._read(lock_filename) != token:
+            LOG.warning("%s held the lock '%s' for so long, that it was broken." % (
+                    self.worker_id, lock_filename))
+            return
+        os.remove(lock_filename)
+
+    def _now(self):
+        """
+        The time of the file system.
+        """
+        filename = self._path(".now.%s" % (self.worker_id))
+        with open(filename, "w"):
+            pass
+        now = os.stat(filename).st_mtime
+        os.remove(filename)
+        return now
+
+    def _write(self, filename, text):
+        """
+        Writes the file atomically, by renaming a temporary file.
+        """
+        temporary_filename = "%s.%s.tmp" % (filename, self.worker_id)
+        with open(temporary_filename, "w") as fp:
+            fp.write(text)
+        os.rename(temporary_filename, filename)
+
+    def _read(self, filename):
+        try:
+            with open(filename, "r") as fp:
+                return fp.read().strip()
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def catalogue(self):
+        """
+        All the granules in the queue.
+        """
+        catalogue_filename = self._path(WorkQueue.CATALOGUE)
+        if not os.path.isfile(catalogue_filename):
+            return []
+        with open(catalogue_filename, "r") as fp:
+            return [line.strip() for line in fp if line.strip() != ""]
+
+    def add(self, granules):
+        """
+        Adds the granules that are not already in the catalogue.
+        Every worker may add the same granules.
+        """
+        self._lock()
+        try:
+            catalogue = self.catalogue()
+            keys = set([WorkQueue.key(granule) for granule in catalogue])
+            new_granules = []
+            for granule in granules:
+                if WorkQueue.key(granule) not in keys:
+                    keys.add(WorkQueue.key(granule))
+                    new_granules.append(granule)
+            if len(new_granules) > 0:
+                self._write(self._path(WorkQueue.CATALOGUE),
+                            "".join(["%s\n" % granule for granule in catalogue + new_granules]))
+            LOG.info("Added %i granules to %s." % (len(new_granules), self))
+        finally:
+            self._unlock()
+
+    def claim(self):
+        """
+        Claims the next granule. Returns None if there are no granules
+        left to claim.
+        """
+        now = self._lock()
+        self.held_by_others = 0
+        try:
+            for granule in self.catalogue():
+                key = WorkQueue.key(granule)
+                if os.path.exists(self._path(WorkQueue.DONE, key)):
+                    continue
+
+                claim_filename = self._path(WorkQueue.CLAIMS, key)
+                holder = self._read(claim_filename)
+                if holder is not None:
+                    try:
+                        lease_age = now - os.stat(claim_filename).st_mtime
+                    except OSError:
+                        # Completed or released meanwhile. It is looked
+                        # at again by the next claim.
+                        self.held_by_others += 1
+                        continue
+                    if lease_age <= self.lease_seconds:
+                        self.held_by_others += 1
+                        continue
+                    LOG.warning("The lease of %s by %s expired %i seconds ago. Requeuing it." % (
+                            key, holder, lease_age - self.lease_seconds))
+
+                self._write(claim_filename, self.worker_id)
+                with self._held_lock:
+                    self._held.add(key)
+                self._start_renewing()
+                LOG.info("%s claimed %s." % (self.worker_id, key))
+                return granule
+        finally:
+            self._unlock()
+        return None
+
+    def granules(self, wait=True):
+        """
+        Yields the claimed granules, until there are no more to claim.
+
+        If wait is set, the worker keeps looking, as long as there are
+        granules held by other workers, as their leases may expire.
+        """
+        while True:
+            granule = self.claim()
+            if granule is not None:
+                yield granule
+            elif wait and self.held_by_others > 0:
+                time.sleep(min(self.lease_seconds / 3.0, 60))
+            else:
+                return
+
+    def renew(self, granule):
+        """
+        Renews the lease of the granule. Returns False, if the granule
+        is no longer held by this worker.
+        """
+        key = WorkQueue.key(granule)
+        claim_filename = self._path(WorkQueue.CLAIMS, key)
+        self._lock()
+        try:
+            held = self._read(claim_filename) == self.worker_id
+            if held:
+                os.utime(claim_filename, None)
+        finally:
+            self._unlock()
+        if not held:
+            LOG.warning("%s lost the lease of %s." % (self.worker_id, key))
+            with self._held_lock:
+                self._held.discard(key)
+        return held
+
+    def complete(self, granule):
+        """
+        Marks the granule as done. Must only be called when the results
+        of the granule are safely stored.
+
+        Returns False, if the granule was not completed, as the lease
+        expired, and the granule was claimed by another worker, or is
+        done already. The values of the granule stored by this worker
+        must then be dropped, as the granule is done by the other worker.
+        """
+        key = WorkQueue.key(granule)
+        claim_filename = self._path(WorkQueue.CLAIMS, key)
+        done_filename = self._path(WorkQueue.DONE, key)
+        self._lock()
+        try:
+            holder = self._read(claim_filename)
+            # Without a holder, the granule was released by the worker
+            # claiming it after the lease expired, and this worker can
+            # still complete it.
+            completed = holder == self.worker_id or \
+                (holder is None and not os.path.exists(done_filename))
+            if completed:
+                self._write(done_filename, self.worker_id)
+                if holder is not None:
+                    os.remove(claim_filename)
+        finally:
+            self._unlock()
+        with self._held_lock:
+            self._held.discard(key)
+        if completed:
+            LOG.info("%s completed %s." % (self.worker_id, key))
+        else:
+            LOG.warning("%s lost the lease of %s, which is %s." % (
+                    self.worker_id, key, "done" if holder is None else "held by %s" % (holder)))
+        return completed
+
+    def release(self, granule):
+        """
+        Gives the granule back to the queue, e.g. if it failed. The
+        values of the granule stored by this worker must be dropped.
+        """
+        key = WorkQueue.key(granule)
+        with self._held_lock:
+            self._held.discard(key)
+        self._lock()
+        try:
+            if self._read(self._path(WorkQueue.CLAIMS, key)) == self.worker_id:
+                os.remove(self._path(WorkQueue.CLAIMS, key))
+        finally:
+            self._unlock()
+        LOG.info("%s released %s." % (self.worker_id, key))
+
+    def done(self):
+        """
+        The finished granules, and the workers that finished them.
+        The values of a granule are in the shard of that worker. The
+        workers drop their values of the granules they release, or
+        could not complete, see complete. Only a worker that died while
+        holding a granule leaves values of it in its shard, so the values
+        of a granule are taken from the shard of the worker in done.
+        """
+        result = {}
+        for granule in self.catalogue():
+            worker_id = self._read(self._path(WorkQueue.DONE, WorkQueue.key(granule)))
+            if worker_id is not None:
+                result[granule] = worker_id
+        return result
+
+    def _start_renewing(self):
+        if self._renewer is None:
+            self._renewer = threading.Thread(target=self._renew_all,
+                                             name="work-queue-renewer")
+            self._renewer.daemon = True
+            self._renewer.start()
+
+    def _renew_all(self):
+        while not self._stop.wait(self.lease_seconds / 3.0):
+            with self._held_lock:
+                keys = list(self._held)
+            for key in keys:
+                try:
+                    self.renew(key)
+                except Exception:
+                    LOG.exception("Could not renew the lease of %s." % (key))
+
+    def close(self):
+        """
+        Stops renewing the leases. Granules still held will be requeued
+        when their leases expire.
+        """
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+
+
+def _test_worker(queue_directory, worker_id, lease_seconds, crash_after=None, stall_at=None):
+    """
+    Used by the test below. Processes granules, until there are no
+    more, or until it "crashes" after crash_after granules. The values
+    of a granule are its lines in the shard of the worker, which are
+    written while processing the granule, and dropped if the granule
+    could not be completed. The worker stalls on the stall_at granule,
+    without renewing it, until the lease expired.
+    """
+    queue = WorkQueue(queue_directory, worker_id=worker_id,
+                      lease_seconds=lease_seconds)
+    shard_filename = os.path.join(queue_directory, "shard.%s" % (worker_id))
+
+    def write_shard(lines):
+        with open(shard_filename + ".tmp", "w") as fp:
+            fp.write("".join(lines))
+        os.rename(shard_filename + ".tmp", shard_filename)
+
+    def read_shard():
+        if not os.path.exists(shard_filename):
+            return []
+        with open(shard_filename, "r") as fp:
+            return fp.readlines()
+
+    processed = 0
+    for granule in queue.granules():
+        key = WorkQueue.key(granule)
+        write_shard(read_shard() + ["%s first half\n" % (key)])
+        if crash_after is not None and processed == crash_after:
+            # Dies, holding the granule, and without renewing the lease.
+            os._exit(0)
+        if stall_at is not None and processed == stall_at:
+            with queue._held_lock:
+                queue._held.discard(key)
+            time.sleep(lease_seconds * 4)
+        time.sleep(0.05)
+        write_shard(read_shard() + ["%s second half\n" % (key)])
+        if not queue.complete(granule):
+            write_shard([line for line in read_shard() if line.split()[0] != key])
+        processed += 1
+    queue.close()
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    Several workers on the queue, of which one dies holding a granule,
+    and one stalls in the middle of a granule, until its lease expired.
+    All the granules must be done once, the one held by the dead worker
+    by one of the others, and the values of each granule must be in the
+    shard of the worker that completed it, and only there.
+    """
+    import tempfile
+    import shutil
+    import multiprocessing
+    logging.basicConfig(level=logging.INFO)
+
+    queue_directory = tempfile.mkdtemp()
+    try:
+        granules = ["/data/noaa18_20080901_%04i_99999_satproj_00000_%05i_avhrr.h5" % (i, i)
+                    for i in range(20)]
+        WorkQueue(queue_directory).add(granules)
+        # Adding the same granules again changes nothing.
+        WorkQueue(queue_directory).add(granules)
+        assert(len(WorkQueue(queue_directory).catalogue()) == len(granules))
+
+        processes = []
+        for i, (crash_after, stall_at) in enumerate([(None, None), (None, None), (2, None),
+                                                     (None, 1)]):
+            p = multiprocessing.Process(target=_test_worker,
+                                        args=(queue_directory, "worker%i" % i,
+                                              1, crash_after, stall_at))
+            p.start()
+            processes.append(p)
+        for p in processes:
+            p.join()
+
+        done = WorkQueue(queue_directory).done()
+        assert(sorted(done.keys()) == sorted(granules))
+        assert(len(os.listdir(os.path.join(queue_directory, WorkQueue.CLAIMS))) == 0)
+
+        # The values of the granules, from the shards.
+        values = {}
+        for i in range(4):
+            shard_filename = os.path.join(queue_directory, "shard.worker%i" % (i))
+            if os.path.exists(shard_filename):
+                with open(shard_filename, "r") as fp:
+                    for line in fp:
+                        values.setdefault(line.split()[0], []).append("worker%i" % (i))
+        # The dead worker left half a granule in its shard, which is
+        # done by another worker. The worker that stalled dropped its
+        # values of the granule it lost.
+        for granule, worker_id in done.items():
+            workers = values[WorkQueue.key(granule)]
+            assert(workers.count(worker_id) == 2)
+            assert(len(workers) == 2 or (workers.count("worker2") == 1 and len(workers) == 3))
+        assert(sum([workers.count("worker2") == 1 for workers in values.values()]) == 1)
+
+        # A stale lock is broken, and a lock broken and taken by another
+        # worker is not removed by the worker it was broken of.
+        queue = WorkQueue(queue_directory, worker_id="worker5", stale_lock_seconds=1)
+        lock_filename = os.path.join(queue_directory, WorkQueue.LOCK)
+        with open(lock_filename, "w") as fp:
+            fp.write("worker6 dead")
+        os.utime(lock_filename, (time.time() - 10, time.time() - 10))
+        queue._lock()
+        with open(lock_filename, "w") as fp:
+            fp.write("worker7 fresh")
+        queue._unlock()
+        assert(queue._read(lock_filename) == "worker7 fresh")
+        os.remove(lock_filename)
+        print "OK. Done by: %s" % (", ".join(sorted(set(done.values()))))
+    finally:
+        shutil.rmtree(queue_directory)
@@ -3,21 +3,69 @@ import datetime
 import h5py
 import numpy as np
 from base_model import BaseModel
+from block_cache import BlockCache
 
 import logging
 LOG = logging.getLogger(__name__)
 
+# The memory used for the decoded values, in MB.
+DEFAULT_CACHE_MB = 512
+
+# The file and the data set of the fields. The cloud mask is read as is,
+# the other values are decoded, by the gain and offset.
+_DATASETS = {
+    "sun_zenith_angle": ("sunsatangle_file", "image1"),
+    "sat_zenith_angle": ("sunsatangle_file", "image2"),
+    "ch1": ("avhrr_file", "image1"),
+    "ch2": ("avhrr_file", "image2"),
+    "ch3b": ("avhrr_file", "image3"),
+    "ch4": ("avhrr_file", "image4"),
+    "ch5": ("avhrr_file", "image5"),
+    "ch3a": ("avhrr_file", "image6"),
+    "lon": ("avhrr_file", "where/lon"),
+    "lat": ("avhrr_file", "where/lat"),
+    "cloudmask": ("cloudmask_file", "cloudmask"),
+    }
+
+# The geolocation is decoded to float64, whatever the dtype of the
+# model. In float32 the positions would be off by up to ~1 m.
+_FLOAT64_FIELDS = ["lat", "lon"]
+
+
 class Hdf5(BaseModel):
-    def __init__(self, avhrr_filename, sunsatangle_filename, cloudmask_filename):
+    """
+    The values are read from the files when they are used, a block of
+    rows at a time if read by block. The decoded values are kept in a
+    least recently used cache of cache_mb, so that the memory used
+    depends on the blocks being worked on, and not the granule.
+
+    The brightness temperatures and the angles are decoded to dtype,
+    float32 by default, which halves the memory and the bandwidth of
+    the retrieval and the perturbations. The temperatures are stored as
+    scaled integers, with a gain of ~0.01 K. The rounding to float32
+    adds less than 2e-5 K at 300 K (half a unit in the last place), and
+    the retrieved surface temperatures change by less than ~2e-4 K,
+    three orders of magnitude below the NEdT. Pixels within that of an
+    algorithm threshold may select another algorithm. Use
+    dtype=np.float64 to decode like before.
+    """
+    def __init__(self, avhrr_filename, sunsatangle_filename, cloudmask_filename,
+                 cache_mb=DEFAULT_CACHE_MB, dtype=np.float32):
         self.avhrr_filename = avhrr_filename
         self.sunsatangle_filename = sunsatangle_filename
         self.cloudmask_filename = cloudmask_filename
+        self.dtype = np.dtype(dtype)
 
         self.avhrr_file = h5py.File(self.avhrr_filename, 'r')
         self.sunsatangle_file = h5py.File(self.sunsatangle_filename, 'r')
         self.cloudmask_file = h5py.File(self.cloudmask_filename, 'r')
+
+        # The small values, like the satellite id.
         self.cache = {}
 
+        # The decoded arrays, by (field, row_start, row_stop).
+        self.block_cache = BlockCache(int(cache_mb * 1024**2))
+
     def __enter__(self):
         return self
 
@@ -41,33 +89,84 @@ class Hdf5(BaseModel):
     def __repr__(self):
         return "Measurements from %s" % self.satellite_id
 
-    def _get_data(self, data_file, key):
+    def _get_dataset(self, field):
+        data_file, key = _DATASETS[field]
+        if field == "cloudmask":
+            return getattr(self, data_file)[key]
+        return getattr(self, data_file)[key]["data"]
+
+    def _get_dtype(self, field):
         """
-        Getting the data from the key from the specified data file.
+        The dtype of the field, when decoded.
         """
-        if not self.cache.has_key(key):
-            d = data_file[key]
-            data_values = d["data"].value
-            
-            no_data_mask = data_values == d["what"].attrs["nodata"]
-            missing_data_mask = data_values == d["what"].attrs["missingdata"]
-            false_data_mask = no_data_mask | missing_data_mask
-            data_values = np.where(false_data_mask, np.NaN, data_values)
-
-            self.cache[key] = data_values * d["what"].attrs["gain"] + d["what"].attrs["offset"]
-        return self.cache[key]
-        
-    def _get_avhrr_data(self, key):
+        if field == "cloudmask":
+            return self._get_dataset(field).dtype
+        if field in _FLOAT64_FIELDS:
+            return np.dtype(np.float64)
+        return self.dtype
+
+    def _read_block(self, field, row_start, row_stop):
+        """
+        Reading and decoding the rows of the field from the file.
+        """
+        if field == "cloudmask":
+            return self._get_dataset(field)[row_start:row_stop]
+
+        data_file, key = _DATASETS[field]
+        d = getattr(self, data_file)[key]
+        data_values = d["data"][row_start:row_stop]
+
+        # The mask is built in place from the raw counts, and the counts
+        # are scaled in place, so the only other array is the decoded one.
+        false_data_mask = data_values == d["what"].attrs["nodata"]
+        false_data_mask |= data_values == d["what"].attrs["missingdata"]
+
+        data_values = data_values.astype(self._get_dtype(field))
+        data_values *= d["what"].attrs["gain"]
+        data_values += d["what"].attrs["offset"]
+        data_values[false_data_mask] = np.NaN
+        return data_values
+
+    def block(self, field, row_start=None, row_stop=None):
+        """
+        The rows row_start:row_stop of the field, e.g. block("ch4", 0, 100).
+        Only the rows are read and decoded, unless the whole field is
+        already in the cache.
         """
-        Getting data from the avhrr file.
+        key = (field, row_start, row_stop)
+        data_values = self.block_cache.get(key)
+        if data_values is None:
+            if (row_start is not None or row_stop is not None) and \
+                    (field, None, None) in self.block_cache:
+                return self.block_cache.get((field, None, None))[row_start:row_stop]
+            data_values = self._read_block(field, row_start, row_stop)
+            self.block_cache.put(key, data_values)
+        return data_values
+
+    @property
+    def shape(self):
+        """
+        The shape of the swath, without reading the values.
         """
-        return self._get_data(self.avhrr_file, key)
+        shape = self._get_dataset("lat").shape
+        assert(self._get_dataset("lon").shape == shape)
+        return shape
 
-    def _get_sun_sat_data(self, key):
+    def preload(self, fields):
         """
-        Getting data from the sunsat file.
+        Reads and decodes the whole fields, as long as they fit in the
+        cache. The rest are read by block, when used. Returns the fields
+        that were read.
         """
-        return self._get_data(self.sunsatangle_file, key)
+        number_of_pixels = np.prod(self.shape)
+        preloaded = []
+        for field in fields:
+            if not self.block_cache.fits(number_of_pixels * self._get_dtype(field).itemsize):
+                break
+            self.block(field)
+            preloaded.append(field)
+        LOG.debug("Preloaded %s into %s." % (", ".join(preloaded), self.block_cache))
+        return preloaded
 
     @property
     def satellite_id(self):
@@ -82,7 +181,7 @@ class Hdf5(BaseModel):
         image1, SUNZ
         # return self._get_sun_sat_angle_value("image1", "SUNZ")
         """
-        return self._get_sun_sat_data("image1")
+        return self.block("sun_zenith_angle")
 
     @property
     def sat_zenith_angle(self):
@@ -90,53 +189,50 @@ class Hdf5(BaseModel):
         image2, SATZ
         return self._get_sun_sat_angle_value("image2", "SATZ")
         """
-        return self._get_sun_sat_data("image2")
+        return self.block("sat_zenith_angle")
 
     @property
     def ch1(self):        
         # 'image1:channel': '1', 'image1:description': 'AVHRR ch1',
-        return self._get_avhrr_data("image1")
+        return self.block("ch1")
 
     @property
     def ch2(self):
         # 'image2:channel': '2', 'image2:description': 'AVHRR ch2',
-        return self._get_avhrr_data("image2")
+        return self.block("ch2")
 
     @property
     def ch3b(self):
         # 'image3:channel': '3b', 'image3:description': 'AVHRR ch3b',
-        return self._get_avhrr_data("image3")
+        return self.block("ch3b")
 
     @property
     def ch3a(self):
         # 'image6:channel': '3a', 'image6:description': 'AVHRR ch3a',
-        return self._get_avhrr_data("image6")
+        return self.block("ch3a")
 
     @property
     def ch4(self):
         #  'image4:channel': '4', 'image4:description': 'AVHRR ch4',
-        return self._get_avhrr_data("image4")
+        return self.block("ch4")
 
     @property
     def ch5(self):
         # 'image5:channel': '5', 'image5:description': 'AVHRR ch5',
-        return self._get_avhrr_data("image5")
+        return self.block("ch5")
 
     @property
     def lon(self):
-        return self._get_avhrr_data("where/lon")
+        return self.block("lon")
 
     @property
     def lat(self):
         # h["where/lat/what"].attrs["gain"]
-        return self._get_avhrr_data("where/lat")
+        return self.block("lat")
 
     @property
     def cloudmask(self):
-        key = "cloudmask"
-        if not self.cache.has_key(key):
-            self.cache[key] = self.cloudmask_file['cloudmask'].value
-        return self.cache[key]
+        return self.block("cloudmask")
 
     @property
     def swath_datetime(self):
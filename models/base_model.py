@@ -1,8 +1,30 @@
 from abc import ABCMeta, abstractproperty
+import numpy as np
 
 class BaseModel(object):
     __metaclass__ = ABCMeta
 
+    # The dtype of the brightness temperatures and the angles.
+    dtype = np.dtype(np.float64)
+
+    @property
+    def shape(self):
+        return self.lat.shape
+
+    def block(self, field, row_start=None, row_stop=None):
+        """
+        The rows row_start:row_stop of the field. Models reading the
+        values from file may read only the rows.
+        """
+        return getattr(self, field)[row_start:row_stop]
+
+    def preload(self, fields):
+        """
+        Models reading the values from file may read the fields in
+        advance. Returns the fields that were read.
+        """
+        return []
+
     @abstractproperty
     def satellite_id(self):
         raise NotImplementedError
@@ -0,0 +1,85 @@
+import threading
+import collections
+
+import logging
+LOG = logging.getLogger(__name__)
+
+
+class BlockCache(object):
+    """
+    A least recently used cache of arrays, bounded by the total size of
+    the arrays in bytes. When a new array does not fit, the arrays used
+    the longest time ago are dropped.
+
+    cache = BlockCache(256 * 1024**2)
+    block = cache.get(("ch4", 0, 100))
+    if block is None:
+        block = ... # Read the block.
+        cache.put(("ch4", 0, 100), block)
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "BlockCache(%i blocks, %.1f of %.1f MB, %i hits, %i misses)" % (
+            len(self._blocks), self.nbytes / 1024.0**2, self.max_bytes / 1024.0**2,
+            self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def __contains__(self, key):
+        return key in self._blocks
+
+    def fits(self, nbytes):
+        """
+        True if nbytes more fits in the cache, without dropping any blocks.
+        """
+        return self.nbytes + nbytes <= self.max_bytes
+
+    def get(self, key):
+        """
+        The block, or None if it is not in the cache.
+        """
+        with self._lock:
+            try:
+                block = self._blocks.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Moved to the end, as the most recently used.
+            self._blocks[key] = block
+            self.hits += 1
+            return block
+
+    def put(self, key, block):
+        """
+        Adds the block, dropping the least recently used blocks to make
+        room. Returns False if the block is larger than the cache, in
+        which case it is not added.
+        """
+        if block.nbytes > self.max_bytes:
+            LOG.debug("%s of %.1f MB does not fit in %s." % (
+                    str(key), block.nbytes / 1024.0**2, self))
+            return False
+
+        with self._lock:
+            if key in self._blocks:
+                self.nbytes -= self._blocks.pop(key).nbytes
+            while self.nbytes + block.nbytes > self.max_bytes:
+                dropped_key, dropped_block = self._blocks.popitem(last=False)
+                self.nbytes -= dropped_block.nbytes
+                LOG.debug("Dropped %s from the cache." % (str(dropped_key)))
+            self._blocks[key] = block
+            self.nbytes += block.nbytes
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.nbytes = 0
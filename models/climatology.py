@@ -0,0 +1,248 @@
+import threading
+import contextlib
+import numpy as np
+import netCDF4
+from sea_ice_fractions import NETCDF_LOCK
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The names tried for the variables, if not given.
+_SST_VARIABLES = ["t_clim", "sst", "analysed_sst", "sea_surface_temperature"]
+_LAT_VARIABLES = ["lat", "latitude"]
+_LON_VARIABLES = ["lon", "longitude"]
+
+# Units of the climatologies given in degrees celsius.
+_CELSIUS_UNITS = ["celsius", "degc", "deg_c", "degrees_celsius", "c"]
+
+
+class ClimatologyException(Exception):
+    pass
+
+
+def get_climatology(climatology_filename=None):
+    """
+    The climatology in the file, or T11Climatology if no file is given.
+    """
+    if climatology_filename is None:
+        return T11Climatology()
+    return GriddedClimatology(climatology_filename)
+
+
+class T11Climatology(object):
+    """
+    Used when there is no climatology. t_clim is set to T11.
+    """
+    def __repr__(self):
+        return "T11Climatology()"
+
+    def get_field(self, month):
+        return self
+
+    def get_t_clim(self, lat, lon, t11):
+        return t11
+
+
+class GriddedClimatology(object):
+    """
+    A climatology of the sea surface temperature on a regular lat/lon
+    grid, in a netCDF file. The variable is either (lat, lon), or
+    (time, lat, lon) with 12 months or 1 time step.
+
+    The grid of a month is read the first time it is used, and kept.
+
+    climatology = GriddedClimatology(filename)
+    field = climatology.get_field(swath_datetime.month)
+    t_clim = field.get_t_clim(lat, lon, t11)
+    """
+    def __init__(self, climatology_filename, variable=None):
+        self.climatology_filename = climatology_filename
+        self._fields = {}
+        self._fields_lock = threading.Lock()
+
+        with self._dataset() as nc:
+            self.variable = variable if variable is not None else \
+                self._find_variable(nc, _SST_VARIABLES, "sea surface temperature")
+            if self.variable not in nc.variables:
+                raise ClimatologyException("'%s' is not in '%s'." % (self.variable,
+                                                                     climatology_filename))
+            self.number_of_months = 1
+            if len(nc.variables[self.variable].shape) == 3:
+                self.number_of_months = nc.variables[self.variable].shape[0]
+                if self.number_of_months not in [1, 12]:
+                    raise ClimatologyException("Expected 1 or 12 time steps in '%s', not %i." % (
+                            climatology_filename, self.number_of_months))
+
+            lat = nc.variables[self._find_variable(nc, _LAT_VARIABLES, "latitude")][:]
+            lon = nc.variables[self._find_variable(nc, _LON_VARIABLES, "longitude")][:]
+            self.lat = np.asarray(lat, dtype=np.float64)
+            self.lon = np.asarray(lon, dtype=np.float64)
+
+        for name, values in [("lat", self.lat), ("lon", self.lon)]:
+            if len(values) < 2 or not np.allclose(np.diff(values), values[1] - values[0]):
+                raise ClimatologyException("The %s in '%s' is not on a regular grid." % (
+                        name, climatology_filename))
+
+        # The grid is stored with increasing latitudes.
+        self._flip_lat = self.lat[1] < self.lat[0]
+        if self._flip_lat:
+            self.lat = self.lat[::-1]
+
+        self.dlat = self.lat[1] - self.lat[0]
+        self.dlon = self.lon[1] - self.lon[0]
+        self.is_global = np.isclose(len(self.lon) * self.dlon, 360.0)
+        LOG.info("%s, %i x %i, %i month(s)." % (self, len(self.lat), len(self.lon),
+                                               self.number_of_months))
+
+    def __repr__(self):
+        return "GriddedClimatology(%s, %s)" % (self.climatology_filename,
+                                               getattr(self, "variable", None))
+
+    @contextlib.contextmanager
+    def _dataset(self):
+        with NETCDF_LOCK:
+            with contextlib.closing(netCDF4.Dataset(self.climatology_filename)) as nc:
+                yield nc
+
+    def _find_variable(self, nc, names, description):
+        for name in names:
+            if name in nc.variables:
+                return name
+        raise ClimatologyException("No %s in '%s'. Tried '%s'." % (
+                description, self.climatology_filename, "', '".join(names)))
+
+    def _read_grid(self, month):
+        """
+        The temperatures of the month in K, float32, with NaN where missing.
+        """
+        with self._dataset() as nc:
+            variable = nc.variables[self.variable]
+            if len(variable.shape) == 3:
+                grid = variable[(month - 1) % self.number_of_months]
+            else:
+                grid = variable[:]
+            units = getattr(variable, "units", "K")
+        grid = np.ma.filled(np.ma.asarray(grid).astype(np.float32), np.NaN)
+        if units.strip().lower() in _CELSIUS_UNITS:
+            grid += np.float32(273.15)
+        if self._flip_lat:
+            grid = grid[::-1]
+        return grid
+
+    def get_field(self, month):
+        """
+        The climatology of the month, 1-12.
+        """
+        key = (month - 1) % self.number_of_months
+        with self._fields_lock:
+            if key not in self._fields:
+                LOG.debug("Reading month %i of %s." % (month, self))
+                self._fields[key] = ClimatologyField(self, self._read_grid(month))
+            return self._fields[key]
+
+
+class ClimatologyField(object):
+    """
+    The climatology of a month, interpolated onto the pixels.
+    """
+    def __init__(self, climatology, grid):
+        self.lat0 = climatology.lat[0]
+        self.lon0 = climatology.lon[0]
+        self.dlat = climatology.dlat
+        self.dlon = climatology.dlon
+        self.is_global = climatology.is_global
+        self.grid = grid
+
+    def interpolate(self, lat, lon):
+        """
+        Bilinear interpolation of the grid onto the lat/lon arrays. The
+        longitudes wrap around, if the grid is global. Missing grid
+        points (e.g. land) are left out, and the weights of the other
+        neighbours are scaled up. Where all four are missing, the
+        result is NaN.
+        """
+        number_of_lats, number_of_lons = self.grid.shape
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+
+        y = np.clip((lat - self.lat0) / self.dlat, 0, number_of_lats - 1)
+        if self.is_global:
+            x = np.mod(lon - self.lon0, 360.0) / self.dlon
+        else:
+            x = np.clip((lon - self.lon0) / self.dlon, 0, number_of_lons - 1)
+
+        y0 = np.minimum(np.floor(y).astype(np.intp), number_of_lats - 2)
+        x0 = np.floor(x).astype(np.intp)
+        wy = y - y0
+        wx = x - x0
+        y1 = y0 + 1
+        if self.is_global:
+            x0 = np.mod(x0, number_of_lons)
+            x1 = np.mod(x0 + 1, number_of_lons)
+        else:
+            x0 = np.minimum(x0, number_of_lons - 2)
+            wx = x - x0
+            x1 = x0 + 1
+
+        t_clim = np.zeros(lat.shape, dtype=np.float64)
+        weights = np.zeros(lat.shape, dtype=np.float64)
+        for yi, xi, w in [(y0, x0, (1 - wy) * (1 - wx)),
+                          (y0, x1, (1 - wy) * wx),
+                          (y1, x0, wy * (1 - wx)),
+                          (y1, x1, wy * wx)]:
+            values = self.grid[yi, xi]
+            has_value = ~np.isnan(values)
+            t_clim[has_value] += w[has_value] * values[has_value]
+            weights[has_value] += w[has_value]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t_clim /= weights
+        t_clim[weights == 0] = np.NaN
+        return t_clim
+
+    def get_t_clim(self, lat, lon, t11):
+        """
+        The climatology at the pixels, falling back to T11 where there
+        is no climatology.
+        """
+        t11 = np.asarray(t11)
+        t_clim = self.interpolate(lat, lon)
+        missing = np.isnan(t_clim) | np.isnan(lat) | np.isnan(lon)
+        t_clim[missing] = t11[missing]
+        return t_clim.astype(t11.dtype)
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    The interpolation of a linear field is exact, also across the
+    date line.
+    """
+    class _TestClimatology(object):
+        lat = np.arange(-89.5, 90, 1.0)
+        lon = np.arange(-179.5, 180, 1.0)
+        dlat = 1.0
+        dlon = 1.0
+        is_global = True
+
+    lon_grid, lat_grid = np.meshgrid(_TestClimatology.lon, _TestClimatology.lat)
+    grid = (273.15 + 0.1 * lat_grid + 0.01 * np.abs(lon_grid)).astype(np.float32)
+    field = ClimatologyField(_TestClimatology, grid)
+
+    lat = np.array([60.25, -70.0, 0.0, 89.9])
+    lon = np.array([10.75, -20.5, 45.0, 100.0])
+    expected = 273.15 + 0.1 * np.minimum(lat, 89.5) + 0.01 * np.abs(lon)
+    assert(np.allclose(field.interpolate(lat, lon), expected, atol=1e-4))
+
+    # Across the date line, between 179.5 and -179.5.
+    assert(np.allclose(field.interpolate(np.array([0.5]), np.array([180.0])),
+                       273.15 + 0.05 + 0.01 * 179.5, atol=1e-4))
+
+    # Missing neighbours are left out, and T11 is used, if all are missing.
+    grid[90:92, 180:182] = np.NaN
+    field = ClimatologyField(_TestClimatology, grid)
+    t11 = np.array([271.0, 272.0])
+    t_clim = field.get_t_clim(np.array([1.0, 0.0]), np.array([1.0, 0.75]), t11)
+    assert(t_clim[0] == 271.0)
+    assert(not np.isnan(t_clim[1]) and t_clim[1] != 272.0)
+    print "OK"
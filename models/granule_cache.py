@@ -0,0 +1,294 @@
+import os
+import json
+import struct
+import datetime
+import numpy as np
+from base_model import BaseModel
+import avhrr_hdf5
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The start of a granule cache file, followed by the length of the
+# header, and the header (json).
+MAGIC = "EUGRANC1"
+
+# The arrays start on page boundaries, so that they are mapped directly.
+_ALIGNMENT = 4096
+
+# The number of rows copied at a time, when writing the cache.
+_ROWS_PER_COPY = 256
+
+# The fields in the cache, and their dtypes. None means the dtype of
+# the model, i.e. of the brightness temperatures and the angles.
+FIELDS = [("ch1", None),
+          ("ch2", None),
+          ("ch3a", None),
+          ("ch3b", None),
+          ("ch4", None),
+          ("ch5", None),
+          ("sun_zenith_angle", None),
+          ("sat_zenith_angle", None),
+          ("cloudmask", np.uint8),
+          ("lat", np.float64),
+          ("lon", np.float64)]
+
+_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class GranuleCacheException(Exception):
+    pass
+
+
+def get_cache_filename(cache_directory, avhrr_filename):
+    """
+    The cache file of the granule, e.g.
+    noaa18_20080901_1157_99999_satproj_00000_12119_avhrr.h5
+    -> <cache_directory>/noaa18_20080901_1157_99999_satproj_00000_12119.granule
+    """
+    file_id = os.path.basename(avhrr_filename).rsplit("_", 1)[0]
+    return os.path.join(cache_directory, "%s.granule" % (file_id))
+
+
+def get_source(filenames):
+    """
+    Identifies the input files, so that a cache of files that have
+    changed is not used.
+    """
+    source = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        source.append([os.path.abspath(filename), stat.st_size, int(stat.st_mtime)])
+    return source
+
+
+def _align(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def write_granule_cache(model, cache_filename, source=None):
+    """
+    Writes the decoded values of the model to the cache file. The values
+    are copied a block of rows at a time, so the whole granule is never
+    in memory. The file is written under a temporary name, and renamed
+    when done, so that a cache file is always complete.
+    """
+    shape = tuple(model.shape)
+    header = {"satellite_id": str(model.satellite_id),
+              "swath_datetime": model.swath_datetime.strftime(_DATETIME_FORMAT),
+              "avhrr_filename": getattr(model, "avhrr_filename", None),
+              "dtype": np.dtype(model.dtype).str,
+              "shape": shape,
+              "source": source,
+              "fields": {}}
+
+    # The offsets depend on the length of the header, which is
+    # therefore reserved up front.
+    offset = _ALIGNMENT
+    for field, dtype in FIELDS:
+        dtype = np.dtype(model.dtype if dtype is None else dtype)
+        header["fields"][field] = {"dtype": dtype.str, "offset": offset}
+        offset = _align(offset + int(np.prod(shape)) * dtype.itemsize)
+    header_json = json.dumps(header)
+    if len(MAGIC) + 8 + len(header_json) > _ALIGNMENT:
+        raise GranuleCacheException("The header of '%s' is too long." % (cache_filename))
+
+    temporary_filename = "%s.%i.tmp" % (cache_filename, os.getpid())
+    try:
+        with open(temporary_filename, "wb") as fp:
+            fp.write(MAGIC)
+            fp.write(struct.pack("<Q", len(header_json)))
+            fp.write(header_json)
+            fp.truncate(offset)
+
+        for field, dtype in FIELDS:
+            field_header = header["fields"][field]
+            values = np.memmap(temporary_filename, dtype=np.dtype(field_header["dtype"]),
+                               mode="r+", offset=field_header["offset"], shape=shape)
+            for row_start in range(0, shape[0], _ROWS_PER_COPY):
+                row_stop = min(row_start + _ROWS_PER_COPY, shape[0])
+                values[row_start:row_stop] = model.block(field, row_start, row_stop)
+            values.flush()
+            del values
+        os.rename(temporary_filename, cache_filename)
+    except:
+        if os.path.exists(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+    LOG.info("Wrote the granule cache '%s', %.1f MB." % (cache_filename, offset / 1024.0**2))
+
+
+def read_header(cache_filename):
+    with open(cache_filename, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise GranuleCacheException("'%s' is not a granule cache file." % (cache_filename))
+        header_length, = struct.unpack("<Q", fp.read(8))
+        return json.loads(fp.read(header_length))
+
+
+class CachedGranule(BaseModel):
+    """
+    A granule from a cache file written by write_granule_cache. The
+    values are memory mapped, so opening is instant, and the pages are
+    only read when used, and then shared through the page cache.
+    """
+    def __init__(self, cache_filename):
+        self.cache_filename = cache_filename
+        header = read_header(cache_filename)
+        self.satellite_id = header["satellite_id"]
+        self.swath_datetime = datetime.datetime.strptime(header["swath_datetime"],
+                                                         _DATETIME_FORMAT)
+        self.avhrr_filename = header["avhrr_filename"]
+        self.dtype = np.dtype(header["dtype"])
+        self.source = header["source"]
+        self._shape = tuple(header["shape"])
+        self._fields = header["fields"]
+        self._values = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # The maps are closed when the arrays are no longer used.
+        self._values.clear()
+
+    def __repr__(self):
+        return "Measurements from %s (%s)" % (self.satellite_id, self.cache_filename)
+
+    def _get_values(self, field):
+        if field not in self._values:
+            field_header = self._fields[field]
+            self._values[field] = np.memmap(self.cache_filename,
+                                            dtype=np.dtype(field_header["dtype"]),
+                                            mode="r", offset=field_header["offset"],
+                                            shape=self._shape)
+        return self._values[field]
+
+    @property
+    def shape(self):
+        return self._shape
+
+    # Set when opening. It must be defined here, as it is abstract in
+    # BaseModel.
+    satellite_id = None
+
+    @property
+    def sun_zenith_angle(self):
+        return self._get_values("sun_zenith_angle")
+
+    @property
+    def sat_zenith_angle(self):
+        return self._get_values("sat_zenith_angle")
+
+    @property
+    def ch1(self):
+        return self._get_values("ch1")
+
+    @property
+    def ch2(self):
+        return self._get_values("ch2")
+
+    @property
+    def ch3a(self):
+        return self._get_values("ch3a")
+
+    @property
+    def ch3b(self):
+        return self._get_values("ch3b")
+
+    @property
+    def ch4(self):
+        return self._get_values("ch4")
+
+    @property
+    def ch5(self):
+        return self._get_values("ch5")
+
+    @property
+    def lat(self):
+        return self._get_values("lat")
+
+    @property
+    def lon(self):
+        return self._get_values("lon")
+
+    @property
+    def cloudmask(self):
+        return self._get_values("cloudmask")
+
+
+def open_cached_granule(cache_directory, filenames, dtype=np.float32,
+                        read_cache_mb=None):
+    """
+    Opens the granule from the cache, converting the granule files
+    into the cache first, if it is not there, or if it was written from
+    other files or with another dtype.
+    """
+    avhrr_filename, sunsatangle_filename, cloudmask_filename = filenames
+    cache_filename = get_cache_filename(cache_directory, avhrr_filename)
+    source = get_source(filenames)
+
+    if os.path.exists(cache_filename):
+        try:
+            granule = CachedGranule(cache_filename)
+            if granule.source == source and granule.dtype == np.dtype(dtype):
+                LOG.debug("Using the granule cache '%s'." % (cache_filename))
+                return granule
+            LOG.info("The granule cache '%s' is out of date." % (cache_filename))
+        except (GranuleCacheException, ValueError), e:
+            LOG.warning("Could not use the granule cache '%s': %s" % (cache_filename, e))
+
+    kwargs = {"dtype": dtype}
+    if read_cache_mb is not None:
+        kwargs["cache_mb"] = read_cache_mb
+    with avhrr_hdf5.Hdf5(avhrr_filename, sunsatangle_filename, cloudmask_filename,
+                         **kwargs) as model:
+        write_granule_cache(model, cache_filename, source)
+    return CachedGranule(cache_filename)
+
+
+if __name__ == "__main__":
+    import docopt
+    __doc__ = """
+File: {filename}
+
+Converts a granule into the granule cache, and checks that the cached
+values are the same as those of the granule.
+
+Usage:
+  {filename} <avhrr-filename> <sunsatangle-filename> <cloudmask-filename> <cache-directory> [-d|-v] [options]
+  {filename} (-h | --help)
+  {filename} --version
+
+Options:
+  -h --help        Show this screen.
+  --version        Show version.
+  -v --verbose     Show some diagostics.
+  -d --debug       Show some more diagostics.
+  --dtype=<dtype>  The type of the temperatures and angles, [default: float32].
+""".format(filename=__file__)
+    args = docopt.docopt(__doc__, version='0.1')
+    if args["--debug"]:
+        logging.basicConfig(level=logging.DEBUG)
+    elif args["--verbose"]:
+        logging.basicConfig(level=logging.INFO)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+    LOG.info(args)
+
+    filenames = (args["<avhrr-filename>"], args["<sunsatangle-filename>"],
+                 args["<cloudmask-filename>"])
+    with open_cached_granule(args["<cache-directory>"], filenames, args["--dtype"]) as granule:
+        with avhrr_hdf5.Hdf5(*filenames, dtype=args["--dtype"]) as model:
+            assert(granule.shape == model.shape)
+            assert(granule.satellite_id == str(model.satellite_id))
+            assert(granule.swath_datetime == model.swath_datetime)
+            for field, dtype in FIELDS:
+                cached = getattr(granule, field)
+                values = getattr(model, field)
+                assert(np.array_equal(np.isnan(cached), np.isnan(values))
+                       if cached.dtype.kind == "f" else np.array_equal(cached, values))
+                if cached.dtype.kind == "f":
+                    assert(np.array_equal(cached[~np.isnan(cached)], values[~np.isnan(values)]))
+        print granule
+        print "OK"
@@ -0,0 +1,208 @@
+import sys
+import threading
+import Queue
+
+import logging
+LOG = logging.getLogger(__name__)
+
+
+class PrefetchException(Exception):
+    pass
+
+
+# Marks the end of the items in the results.
+_END = object()
+
+
+class Prefetcher(object):
+    """
+    Loads the items in the background, while the previously loaded
+    items are being processed.
+
+    The items are loaded by the load function on one or more threads,
+    and are returned in the same order as they were given. At most
+    look_ahead items are loaded in front of the one being processed,
+    so that the memory usage is bounded.
+
+    The items are taken from the iterable only when there is room to
+    load them, so the iterable may be a generator, e.g. claiming the
+    items from a work queue.
+
+    with Prefetcher(load_granule, filenames, look_ahead=1) as prefetcher:
+        for filename, granule in prefetcher:
+            ... # filename+1 is being loaded meanwhile.
+    """
+    def __init__(self, load, items, look_ahead=1, number_of_threads=1,
+                 release=None):
+        if look_ahead < 1:
+            raise PrefetchException("look_ahead must be at least 1, was %i."
+                                    % (look_ahead))
+        if number_of_threads < 1:
+            raise PrefetchException("number_of_threads must be at least 1, "
+                                    "was %i." % (number_of_threads))
+        self.load = load
+        self.look_ahead = look_ahead
+        self.number_of_threads = number_of_threads
+
+        # Called with the loaded values that were never handed out,
+        # e.g. to close the files, if the iteration is stopped early.
+        self.release = release
+
+        # One slot for the item being processed plus the ones loaded ahead.
+        self._slots = threading.Semaphore(look_ahead + 1)
+        self._items = iter(items)
+        self._items_lock = threading.Lock()
+        self._next_index = 0
+        self._exhausted = False
+        self._results = Queue.Queue()
+        # The results taken from the queue, but not handed out yet, by
+        # their index.
+        self._pending = {}
+        self._stop = threading.Event()
+        self._threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def start(self):
+        for i in range(self.number_of_threads):
+            thread = threading.Thread(target=self._run,
+                                      name="prefetch-%i" % (i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_item(self):
+        """
+        The next item and its index, or None when there are no more.
+        """
+        with self._items_lock:
+            if self._exhausted:
+                return None
+            try:
+                item = self._items.next()
+            except StopIteration:
+                self._exhausted = True
+                self._results.put((self._next_index, None, None, _END))
+                return None
+            except Exception:
+                LOG.exception("Could not get the next item.")
+                self._exhausted = True
+                self._results.put((self._next_index, None, None, sys.exc_info()))
+                return None
+            index = self._next_index
+            self._next_index += 1
+            return index, item
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Wait for a free slot. The timeout makes sure that the
+            # thread notices when the prefetcher is closed.
+            if not self._slots.acquire(False):
+                self._stop.wait(0.05)
+                continue
+
+            next_item = self._next_item()
+            if next_item is None:
+                self._slots.release()
+                return
+
+            index, item = next_item
+            LOG.debug("Prefetching %s." % (str(item)))
+            try:
+                self._results.put((index, item, self.load(item), None))
+            except Exception:
+                LOG.exception("Could not load %s." % (str(item)))
+                self._results.put((index, item, None, sys.exc_info()))
+
+    def __iter__(self):
+        if len(self._threads) == 0:
+            self.start()
+
+        pending = self._pending
+        index = 0
+        while True:
+            while index not in pending:
+                result_index, item, value, error = self._results.get()
+                pending[result_index] = (item, value, error)
+
+            item, value, error = pending.pop(index)
+            if error is _END:
+                return
+            if error is not None:
+                # Raised with the traceback of the loading thread. The
+                # values loaded after it are released by close.
+                raise error[0], error[1], error[2]
+
+            try:
+                yield item, value
+            finally:
+                # The item is done, so the next one may be loaded.
+                self._slots.release()
+            index += 1
+
+    def close(self):
+        """
+        Stops the loading threads and releases the loaded values that
+        were never processed, also the ones already taken from the
+        results, e.g. after a failed load or when the iteration stopped
+        early.
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+        values = [value for item, value, error in self._pending.values()]
+        self._pending.clear()
+        while True:
+            try:
+                index, item, value, error = self._results.get_nowait()
+            except Queue.Empty:
+                break
+            values.append(value)
+        for value in values:
+            if value is not None and self.release is not None:
+                self.release(value)
+
+
+if __name__ == "__main__":
+    """
+    Kind of a test...
+    The values loaded after a failed load are released when closing,
+    and the error is raised with the traceback of the loading thread.
+    """
+    import time
+    import traceback
+
+    def load(item):
+        if item == 1:
+            # The items after it are loaded first.
+            time.sleep(0.2)
+            raise PrefetchException("Could not load %i." % (item))
+        return "value %i" % (item)
+
+    released = []
+    prefetcher = Prefetcher(load, range(4), look_ahead=3, number_of_threads=4,
+                            release=released.append)
+    try:
+        with prefetcher:
+            for item, value in prefetcher:
+                assert(item == 0)
+        assert(False)
+    except PrefetchException:
+        assert("in load" in traceback.format_exc())
+    assert(sorted(released) == ["value 2", "value 3"])
+
+    # Stopping early.
+    released = []
+    with Prefetcher(lambda item: "value %i" % (item), range(3), look_ahead=2,
+                    release=released.append) as prefetcher:
+        for item, value in prefetcher:
+            time.sleep(0.1)
+            break
+    assert(sorted(released) == ["value 1", "value 2"])
+    print "OK"
@@ -0,0 +1,120 @@
+import os
+import re
+import threading
+import contextlib
+import numpy as np
+import netCDF4
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The netCDF library is not thread safe, also not for different files,
+# and the granules may be loaded on prefetching threads.
+NETCDF_LOCK = threading.Lock()
+
+# 20080901115700-DMI_METNO-L2P_GHRSST-STskin-GAC_polar_SST_IST-noaa18_00000_12119-v02.0-fv01.0.nc
+_NC_FILENAME_PATTERN = re.compile(r"^(?P<date>\d{8})(?P<time>\d{4})\d*-.*-"
+                                  r"(?P<satellite_id>[a-z]+\d+)_\d+_(?P<orbit_id>\d+)-.*\.nc$")
+
+
+def get_key(avhrr_filename):
+    """
+    The key of the granule, (satellite id, date, time, orbit id), e.g.
+    noaa18_20080901_1157_99999_satproj_00000_12119_avhrr.h5
+    -> ("noaa18", "20080901", "1157", "12119")
+    """
+    satellite_id, date, time, _, _, _, orbit_id, _ = os.path.basename(avhrr_filename).split("_")
+    return satellite_id, date, time, orbit_id
+
+
+class SeaIceIndex(object):
+    """
+    The level 2 files with the sea ice fractions in the data directory,
+    by the key of the granules. The directory is listed once, so files
+    added afterwards are not found.
+
+    index = SeaIceIndex(data_directory)
+    sea_ice_fractions = index.get(avhrr_filename)
+    """
+    def __init__(self, data_directory):
+        self.data_directory = data_directory
+        self._filenames = {}
+        for filename in sorted(os.listdir(data_directory)):
+            match = _NC_FILENAME_PATTERN.match(filename)
+            if match is None:
+                continue
+            key = (match.group("satellite_id"), match.group("date"),
+                   match.group("time"), match.group("orbit_id"))
+            if key in self._filenames:
+                LOG.warning("Several sea ice fraction files for %s. Using '%s'." % (
+                        str(key), self._filenames[key]))
+                continue
+            self._filenames[key] = os.path.join(data_directory, filename)
+        LOG.info("Indexed %i sea ice fraction files in '%s'." % (len(self._filenames),
+                                                                 data_directory))
+
+    def __len__(self):
+        return len(self._filenames)
+
+    def get_filename(self, avhrr_filename):
+        """
+        The sea ice fraction file of the granule, or None.
+        """
+        return self._filenames.get(get_key(avhrr_filename))
+
+    def get(self, avhrr_filename):
+        """
+        The sea ice fractions of the granule, or None if there is no
+        sea ice fraction file for it.
+        """
+        nc_filename = self.get_filename(avhrr_filename)
+        if nc_filename is None:
+            return None
+        return SeaIceFractions(nc_filename)
+
+
+class SeaIceFractions(object):
+    """
+    The sea ice fractions of a granule, aligned with the swath, as
+    float32 with NaN where there are no fractions.
+
+    The values are read from the file a block of rows at a time, if
+    read by block, unless they are given as values.
+    """
+    VARIABLE = "sea_ice_fraction"
+
+    def __init__(self, nc_filename, values=None):
+        self.nc_filename = nc_filename
+        self.values = values
+
+    def __repr__(self):
+        return "SeaIceFractions(%s)" % (self.nc_filename)
+
+    @contextlib.contextmanager
+    def _variable(self):
+        with NETCDF_LOCK:
+            with contextlib.closing(netCDF4.Dataset(self.nc_filename)) as nc:
+                yield nc.variables[SeaIceFractions.VARIABLE]
+
+    @property
+    def shape(self):
+        if self.values is not None:
+            return self.values.shape
+        with self._variable() as variable:
+            return variable.shape[1:]
+
+    def block(self, row_start=None, row_stop=None):
+        """
+        The sea ice fractions of the rows row_start:row_stop.
+        """
+        if self.values is not None:
+            return self.values[row_start:row_stop]
+        with self._variable() as variable:
+            fractions = variable[0, row_start:row_stop]
+        return np.ma.filled(np.ma.asarray(fractions).astype(np.float32), np.NaN)
+
+    def read(self):
+        """
+        All the sea ice fractions.
+        """
+        return self.block()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+import logging
+LOG = logging.getLogger(__name__)
+
+# The directory of the shared swaths, a tmpfs where there is one, so
+# that the arrays are in memory.
+SHARED_MEMORY_DIRECTORY = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+_EXTENSION = ".npy"
+
+
+class SharedSwathException(Exception):
+    pass
+
+
+class SharedSwath(object):
+    """
+    Swath arrays in shared memory.
+
+    The arrays are written once, to the files of a directory on a tmpfs,
+    and are memory mapped by the processes attaching to the directory,
+    by its name. The processes then read the arrays without copying
+    them, also processes started before the swath was shared, e.g. the
+    workers of a multiprocessing.Pool, which can then be given the
+    directory and the rows to work on, in stead of the values.
+
+    The arrays are read like the fields of the model:
+
+    swath = SharedSwath.from_model(avhrr_model, ["ch4", "ch5", "lat"])
+    ... # In another process.
+    swath = SharedSwath(directory)
+    swath.ch4[row_start:row_stop]
+    ... # When done, by the process that shared it.
+    swath.remove()
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._arrays = {}
+        for filename in os.listdir(directory):
+            if filename.endswith(_EXTENSION):
+                self._arrays[filename[:-len(_EXTENSION)]] = np.load(
+                    os.path.join(directory, filename), mmap_mode="r")
+
+    def __repr__(self):
+        return "SharedSwath(%s)" % (self.directory)
+
+    @classmethod
+    def share(cls, arrays, directory=None):
+        """
+        Writes the arrays to a new directory, in the directory given or
+        in SHARED_MEMORY_DIRECTORY, and attaches to it.
+        """
+        directory = tempfile.mkdtemp(prefix="shared_swath_",
+                                     dir=directory or SHARED_MEMORY_DIRECTORY)
+        try:
+            for name, array in arrays.items():
+                array = np.asarray(array)
+                if array.dtype.hasobject:
+                    raise SharedSwathException("'%s' can not be shared, as it "
+                                               "holds python objects." % (name))
+                np.save(os.path.join(directory, name + _EXTENSION), array)
+            swath = cls(directory)
+        except:
+            shutil.rmtree(directory)
+            raise
+        LOG.debug("Shared %.1f MB in '%s'." % (swath.nbytes / 1024.0**2, directory))
+        return swath
+
+    @classmethod
+    def from_model(cls, model, fields, directory=None, **arrays):
+        """
+        Shares the fields of the model, and any additional arrays.
+        """
+        for field in fields:
+            arrays[field] = getattr(model, field)
+        return cls.share(arrays, directory)
+
+    def remove(self):
+        """
+        Removes the files. The processes still attached keep their maps
+        of the arrays, until they close them.
+        """
+        self._arrays.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @property
+    def names(self):
+        return sorted(self._arrays.keys())
+
+    @property
+    def nbytes(self):
+        return sum([array.nbytes for array in self._arrays.values()])
+
+    @property
+    def shape(self):
+        return self.lat.shape
+
+    def block(self, name, row_start=None, row_stop=None):
+        """
+        Like the block of the models.
+        """
+        return getattr(self, name)[row_start:row_stop]
+
+    def __contains__(self, name):
+        return name in self._arrays
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self._arrays[name]
+        except KeyError:
+            raise AttributeError("'%s' is not shared. Shared are: '%s'." % (
+                    name, "', '".join(self.names)))
@@ -4,15 +4,17 @@
 import logging
 LOG = logging.getLogger(__name__)
 import datetime
-import random
 import multiprocessing as mp
 import glob
 import os
+import shutil
 import contextlib
+import threading
+import collections
+import cPickle
 
 # Third party
 import numpy as np
-import netCDF4
 import matplotlib.pyplot as plt
 import pylab
 
@@ -22,71 +24,259 @@ import models.avhrr_hdf5
 import eustace.coefficients
 import eustace.db
 import eustace.sigmas
+import eustace.perturbation
+import eustace.ingest_filter
+import eustace.scanlines
+import eustace.kernels
+import eustace.random_streams
+import eustace.convergence
+import eustace.variance_budget
+import eustace.memo
+import eustace.stratified_subsampling
+import eustace.uncertainty_lut
+import eustace.gridded_output
+import eustace.work_queue
+import models.prefetch
+import models.shared_swath
+import models.sea_ice_fractions
+import models.climatology
+import models.granule_cache
 
+# The model values used by perturb_row_block, in the order they are
+# preloaded by load_granule.
+_SWATH_FIELDS = ["cloudmask", "ch3b", "ch4", "ch5", "sun_zenith_angle",
+                 "sat_zenith_angle", "lat", "lon"]
 
-def perturbate_in_parallel(output_queue, swath_input_id,
-                           coeff, number_of_perturbations,
-                           t11_K, t12_K,
-                           t37_K, t_clim_K,
-                           sigma_11, sigma_12, sigma_37,
-                           sun_zenith_angle, sat_zenith_angle,
-                           random_seed=None):
+# The memory used for the perturbations of a block of rows, in MB.
+DEFAULT_MEMORY_BUDGET_MB = 1024
+
+# The number of granules, for which the scanline hashes are kept, so
+# that the hashes of a granule are at hand when the next one is
+# populated.
+_NUMBER_OF_SCANLINE_HASHES = 2
+
+# The batches of inserts waiting for the db writer, see
+# eustace.db.DbWriter. A batch holds at least one block of rows, so the
+# perturbations waiting to be written are kept to a couple of blocks.
+_DB_QUEUED_BATCHES = 2
+
+# The algorithm names by their codes.
+_ALGORITHM_NAMES = np.array(eustace.surface_temperature.ALGORITHMS)
+
+# A scenario of a sweep, populating its own database file with the
+# sigmas of the sigmas file and the coefficients of the satellite, None
+# for the satellite of the granule. The values are written by the
+# db_writer, if not None.
+Scenario = collections.namedtuple("Scenario", ["database_filename", "sigmas_filename",
+                                               "satellite_id", "db_writer"])
+
+
+@contextlib.contextmanager
+def open_db_writer(database_filename, db_writer=None):
+    """
+    Yields the db writer if given. Otherwise a new db writer to the
+    database file is yielded, and closed when done.
+    """
+    if db_writer is not None:
+        yield db_writer
+    else:
+        with eustace.db.DbWriter(database_filename,
+                                 max_queued_batches=_DB_QUEUED_BATCHES) as db_writer:
+            yield db_writer
+
+
+def get_granule_id(avhrr_filename):
+    """
+    noaa18_20080901_1157_99999_satproj_00000_12119_avhrr.h5
+    -> noaa18_20080901_1157_99999_satproj_00000_12119
+    """
+    return os.path.basename(avhrr_filename).rsplit("_", 1)[0]
+
+
+def get_random_streams(avhrr_model, random_seed=1, sampling="random"):
+    """
+    The random streams of the granule, keyed by the satellite and the
+    granule, so that the perturbations of a pixel are the same, however
+    the granule is perturbed. See eustace.random_streams.SAMPLINGS for
+    the samplings.
+    """
+    return eustace.random_streams.RandomStreams(avhrr_model.satellite_id,
+                                                get_granule_id(avhrr_model.avhrr_filename),
+                                                random_seed, sampling)
+
+
+def get_buffer_perturbations(number_of_perturbations, convergence=None):
+    """
+    The number of perturbations per pixel in the buffers, the batch
+    size of the convergence, if given.
+    """
+    if convergence is not None:
+        return convergence.batch_size
+    return number_of_perturbations
+
+
+def get_sweep_scenarios(database_filename, sigmas_filenames=None, satellite_ids=None):
     """
-    Running the perturbations in parallel. This only seems to make
-    sense if the number of perturbations is large enough.
+    The scenarios of a sweep over the sigmas files and the coefficients
+    of the satellites, apart from the default sigmas file with the
+    coefficients of the satellite of the granule, which populates the
+    database file itself. Each scenario populates the database file
+    with the scenario added,
+    e.g. /data/noaa18.sqlite3 -> /data/noaa18.<sigmas>_<satellite>.sqlite3
     """
-    p = mp.Process(target=perturbate,
-                   args=(output_queue, swath_input_id,
-                         coeff, number_of_perturbations,
-                         t11_K, t12_K,
-                         t37_K, t_clim_K,
-                         sigma_11, sigma_12, sigma_37,
-                         sun_zenith_angle, sat_zenith_angle),
-                   kwargs={"random_seed": random_seed})
-    p.start()
-    LOG.debug("%i started." % (swath_input_id))
+    sigmas_filenames = [eustace.sigmas.SIGMAS_FILE] + list(sigmas_filenames or [])
+    satellite_ids = [None] + list(satellite_ids or [])
+    root, extension = os.path.splitext(database_filename)
+    scenarios = []
+    for sigmas_filename in sigmas_filenames:
+        for satellite_id in satellite_ids:
+            if sigmas_filename == eustace.sigmas.SIGMAS_FILE and satellite_id is None:
+                continue
+            name = "%s_%s" % (os.path.splitext(os.path.basename(sigmas_filename))[0],
+                              satellite_id or "own")
+            scenarios.append(Scenario("%s.%s%s" % (root, name, extension),
+                                      sigmas_filename, satellite_id, None))
+    return scenarios
 
 
-def perturbate(output_queue, swath_input_id, *args, **kwargs):
+def get_granule_filenames(avhrr_filename):
     """
-    Do the perturbations. For input arguments, see the
-    get_n_perturbed_temperatures
+    The avhrr, sunsatangle and cloudmask filenames of the granule,
+    which share the file id of the avhrr filename.
     """
-    perturbations = eustace.surface_temperature.get_n_perturbed_temeratures(*args, **kwargs)
-    output_queue.put((swath_input_id, perturbations))
-    LOG.debug("%i done" % (swath_input_id))
+    file_id = avhrr_filename.rsplit("_", 1)[0]
+    cloudmask_filename = "%s_cloudmask.h5" % file_id
+    sunsatangle_filename = "%s_sunsatangles.h5" % file_id
+    return (avhrr_filename, sunsatangle_filename, cloudmask_filename)
+
+
+# The sea ice fraction indexes, by the data directory.
+_SEA_ICE_INDEXES = {}
+_SEA_ICE_INDEXES_LOCK = threading.Lock()
 
 
 def get_sea_ice_fractions(data_directory, avhrr_filename):
     """
-    Getting the sea ice fraction from a level 2 file.
+    Getting the sea ice fractions from a level 2 file. The files in the
+    data directory are indexed the first time, and the fractions are
+    read when used.
     """
     if data_directory is None:
         return None
 
-    # The id to identify the ice fraction file.
-    # noaa18_20080901_1157_99999_satproj_00000_12119_cloudtype.h5
-    satellite_id, date, time, _, _, _, orbit_id, _ = os.path.basename(avhrr_filename).split("_")
-    # Find the ice fraction nc file:
-    # 20080901115700-DMI_METNO-L2P_GHRSST-STskin-GAC_polar_SST_IST-noaa18_00000_12119-v02.0-fv01.0.nc
-    nc_filenames = glob.glob(os.path.join(data_directory, "*%s%s*%s*%s*" % (date, time, satellite_id, orbit_id)))
-    if len(nc_filenames) == 0:
-        return None
+    with _SEA_ICE_INDEXES_LOCK:
+        if data_directory not in _SEA_ICE_INDEXES:
+            _SEA_ICE_INDEXES[data_directory] = models.sea_ice_fractions.SeaIceIndex(data_directory)
+    return _SEA_ICE_INDEXES[data_directory].get(avhrr_filename)
+
+
+# The scanline hashes of the last granules, by the avhrr filename.
+_SCANLINE_HASHES = collections.OrderedDict()
 
-    with contextlib.closing(netCDF4.Dataset(nc_filenames[0])) as nc:
-        return nc.variables["sea_ice_fraction"][0]
+
+def get_scanline_hashes(filenames, avhrr_model=None):
+    """
+    The scanline hashes of the granule. The geolocation is read from the
+    model, if given, and from the files otherwise.
+    """
+    avhrr_filename = filenames[0]
+    if avhrr_filename not in _SCANLINE_HASHES:
+        if avhrr_model is not None:
+            hashes = eustace.scanlines.get_model_scanline_hashes(avhrr_model)
+        else:
+            # Only the geolocation is read, so nothing is cached.
+            with models.avhrr_hdf5.Hdf5(*filenames, cache_mb=0) as model:
+                hashes = eustace.scanlines.get_model_scanline_hashes(model)
+        _SCANLINE_HASHES[avhrr_filename] = hashes
+        while len(_SCANLINE_HASHES) > _NUMBER_OF_SCANLINE_HASHES:
+            _SCANLINE_HASHES.popitem(last=False)
+    return _SCANLINE_HASHES[avhrr_filename]
+
+
+def get_duplicate_scanlines(avhrr_model, previous_filenames):
+    """
+    The rows of the granule that are also in the previous granule of
+    the satellite, e.g. where the orbits overlap. Returns the row in the
+    previous granule for every row, or -1 where the row is not in it.
+    """
+    filenames = (avhrr_model.avhrr_filename,)
+    owner_rows = eustace.scanlines.find_duplicate_scanlines(
+        get_scanline_hashes(filenames, avhrr_model),
+        get_scanline_hashes(previous_filenames))
+    LOG.info("%i of %i scanlines of %s are in %s." % (
+            (owner_rows >= 0).sum(), len(owner_rows),
+            get_granule_id(avhrr_model.avhrr_filename),
+            get_granule_id(previous_filenames[0])))
+    return owner_rows
+
+
+def load_granule(filenames, sea_ice_fraction_data_directory=None,
+                 read_cache_mb=models.avhrr_hdf5.DEFAULT_CACHE_MB, dtype=np.float32,
+                 granule_cache_directory=None):
+    """
+    Opens the avhrr model and reads in the values needed for the
+    perturbations, as far as they fit in the read cache, and finds the
+    sea ice fractions, which are read by block. The temperatures and
+    the angles are decoded to dtype.
+
+    If the granule cache directory is set, the decoded values are read
+    from the granule cache, converting the granule first if needed.
+
+    The model is returned open. It is closed by populate_from_model,
+    or by release_granule if it is never used.
+    """
+    avhrr_filename, sun_sat_angle_filename, cloudmask_filename = filenames
+    if granule_cache_directory is not None:
+        avhrr_model = models.granule_cache.open_cached_granule(granule_cache_directory,
+                                                               filenames,
+                                                               dtype=dtype,
+                                                               read_cache_mb=read_cache_mb)
+    else:
+        avhrr_model = models.avhrr_hdf5.Hdf5(avhrr_filename,
+                                             sun_sat_angle_filename,
+                                             cloudmask_filename,
+                                             cache_mb=read_cache_mb,
+                                             dtype=dtype)
+    try:
+        # The values are cached in the model, so reading them here
+        # decodes them once, e.g. on a prefetching thread. The values
+        # that do not fit are read a block of rows at a time, when
+        # perturbed.
+        avhrr_model.satellite_id
+        avhrr_model.swath_datetime
+        avhrr_model.preload(_SWATH_FIELDS)
+
+        sea_ice_fractions = get_sea_ice_fractions(sea_ice_fraction_data_directory,
+                                                  avhrr_filename)
+    except:
+        release_granule((avhrr_model, None))
+        raise
+    return avhrr_model, sea_ice_fractions
+
+
+def release_granule(granule):
+    """
+    Closes a granule loaded by load_granule.
+    """
+    avhrr_model, sea_ice_fractions = granule
+    avhrr_model.__exit__(None, None, None)
 
 
 def populate_from_files(database_filename, avhrr_filename, sun_sat_angle_filename,
                         cloudmask_filename, sea_ice_fraction_data_directory,
-                        number_of_perturbations, run_in_parallel = False
-                        ):
+                        number_of_perturbations, run_in_parallel = False,
+                        db_writer=None, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                        read_cache_mb=models.avhrr_hdf5.DEFAULT_CACHE_MB,
+                        dtype=np.float32, ingest_filter=None, climatology=None,
+                        granule_cache_directory=None, previous_filenames=None,
+                        sampling="random", convergence=None, scenarios=None,
+                        variance_budget=None, memo=None, subsampling=None,
+                        uncertainty_lut=None, gridded_output_directory=None, pool=None):
     """
     Populate the database with perturbed values.
     """
-    LOG.info("db_filename:                      %s" % (database_filename))
     LOG.info("avhrr_filename:                   %s" % (avhrr_filename))
-    LOG.info("sunsatangle_filename:             %s" % (sunsatangle_filename))
+    LOG.info("sunsatangle_filename:             %s" % (sun_sat_angle_filename))
     LOG.info("cloudmask_filename:               %s" % (cloudmask_filename))
     LOG.info("sea_ice_fraction_data_directory:  %s" % (sea_ice_fraction_data_directory))
 
@@ -94,38 +284,880 @@ def populate_from_files(database_filename, avhrr_filename, sun_sat_angle_filenam
     # The file is cached, so that when the values are read, they are read
     # from memory, and not from the file system. This speeds up the
     # calculations.
-    with models.avhrr_hdf5.Hdf5(avhrr_filename,
-                                sun_sat_angle_filename,
-                                cloudmask_filename) as avhrr_model:
+    granule = load_granule((avhrr_filename, sun_sat_angle_filename, cloudmask_filename),
+                           sea_ice_fraction_data_directory, read_cache_mb, dtype,
+                           granule_cache_directory)
+    populate_from_model(database_filename, granule, number_of_perturbations,
+                        run_in_parallel, db_writer=db_writer,
+                        memory_budget_mb=memory_budget_mb,
+                        ingest_filter=ingest_filter,
+                        climatology=climatology,
+                        previous_filenames=previous_filenames,
+                        sampling=sampling,
+                        convergence=convergence,
+                        scenarios=scenarios,
+                        variance_budget=variance_budget,
+                        memo=memo,
+                        subsampling=subsampling,
+                        uncertainty_lut=uncertainty_lut,
+                        gridded_output_directory=gridded_output_directory,
+                        pool=pool)
+
+
+def read_valid_pixels(avhrr_model, row_start, row_stop, ingest_filter, climatology_field,
+                      skipped_rows=None, selected=None):
+    """
+    Reads the pixels of the rows selected by the ingest filter, apart
+    from the rows set in skipped_rows, and the pixels not set in
+    selected (the rows), if given. The filters are applied while
+    reading, so that the values of the rows outside the latitude bands
+    are never read.
+
+    Returns the mask of the valid pixels in the rows, followed by lat,
+    lon, cloudmask, t11, t12, t37, sun and sat zenith angles and t_clim
+    of the valid pixels, or None if no pixels are valid.
+    """
+    if skipped_rows is not None and skipped_rows[row_start:row_stop].all():
+        LOG.debug("Rows %i-%i are skipped." % (row_start, row_stop))
+        return None
+    if selected is not None and not selected.any():
+        LOG.debug("No pixels of rows %i-%i are selected." % (row_start, row_stop))
+        return None
+
+    # Only the pixels within the latitude bands are used.
+    lat = avhrr_model.block("lat", row_start, row_stop)
+    if not ingest_filter.any_in_lat_bands(lat):
+        LOG.debug("Rows %i-%i are outside the latitude bands." % (row_start, row_stop))
+        return None
+    lon = avhrr_model.block("lon", row_start, row_stop)
+    valid = ingest_filter.lat_mask(lat) & ~np.isnan(lon)
+    if skipped_rows is not None:
+        valid[skipped_rows[row_start:row_stop]] = False
+    if selected is not None:
+        valid &= selected
+
+    # Only the pixels with these cloud mask values are used.
+    cloudmask = avhrr_model.block("cloudmask", row_start, row_stop)
+    valid &= ingest_filter.cloudmask_mask(cloudmask)
+    if not valid.any():
+        return None
+
+    # T11 is channel 4, T12 is channel 5 and T37 is channel 3b.
+    t11_K = avhrr_model.block("ch4", row_start, row_stop)
+    t12_K = avhrr_model.block("ch5", row_start, row_stop)
+    t37_K = avhrr_model.block("ch3b", row_start, row_stop)
+    if np.isnan(t11_K[valid]).any() or np.isnan(t12_K[valid]).any():
+        # t11 and t12 are both needed for all calculations.
+        raise RuntimeError("Missing T11 or T12")
+    valid &= ingest_filter.t11_mask(t11_K)
+
+    # Only the valid pixels are used from here on.
+    t11_K = t11_K[valid]
+    t12_K = t12_K[valid]
+    t37_K = t37_K[valid]
+    sun_zenith_angle = avhrr_model.block("sun_zenith_angle", row_start, row_stop)[valid]
+    sat_zenith_angle = avhrr_model.block("sat_zenith_angle", row_start, row_stop)[valid]
+
+    # The climatology of the month of the swath.
+    t_clim_K = climatology_field.get_t_clim(lat[valid], lon[valid], t11_K)
+    return (valid, lat[valid], lon[valid], cloudmask[valid], t11_K, t12_K, t37_K,
+            sun_zenith_angle, sat_zenith_angle, t_clim_K)
+
+
+def get_inclusion_weights(avhrr_model, coeff, subsampling, memory_budget_mb, random_streams,
+                          ingest_filter=None, climatology_field=None, skipped_rows=None):
+    """
+    The first pass of the stratified subsampling, see
+    eustace.stratified_subsampling. The pixels that would be perturbed
+    are read a block of rows at a time, and put into their strata,
+    and the pixels of each stratum are picked by the uniform random
+    numbers of the pixels, see get_random_streams. So the subsample
+    only depends on the granule, however it is perturbed.
+
+    Returns the inclusion weight of each pixel of the swath, 0 for the
+    pixels not in the subsample.
+    """
+    if ingest_filter is None:
+        ingest_filter = eustace.ingest_filter.IngestFilter()
+    if climatology_field is None:
+        climatology_field = models.climatology.T11Climatology()
+
+    number_of_rows, number_of_columns = avhrr_model.shape
+    block_rows = eustace.perturbation.rows_per_block(memory_budget_mb * 1024**2,
+                                                     number_of_columns, 1, avhrr_model.dtype)
+    strata, rows, columns = [], [], []
+    for row_start, row_stop in eustace.perturbation.row_blocks(number_of_rows, block_rows):
+        pixels = read_valid_pixels(avhrr_model, row_start, row_stop, ingest_filter,
+                                   climatology_field, skipped_rows)
+        if pixels is None:
+            continue
+        (valid, lat, lon, cloudmask, t11_K, t12_K, t37_K, sun_zenith_angle, sat_zenith_angle,
+         t_clim_K) = pixels
+
+        # Only the pixels with a surface temperature are perturbed.
+        algorithms = eustace.surface_temperature.select_surface_temperature_algorithms(
+            sun_zenith_angle, t11_K, t37_K)
+        st_truth_K = eustace.surface_temperature.get_surface_temperatures(
+            algorithms, coeff, t11_K, t12_K, t37_K, t_clim_K,
+            sun_zenith_angle, sat_zenith_angle)
+        has_st = ~np.isnan(st_truth_K) & ingest_filter.algorithm_mask(algorithms)
+
+        valid_rows, valid_columns = np.nonzero(valid)
+        strata.append(subsampling.get_strata(algorithms[has_st], sun_zenith_angle[has_st],
+                                             sat_zenith_angle[has_st], lat[has_st],
+                                             t11_K[has_st] - t12_K[has_st]))
+        rows.append(valid_rows[has_st] + row_start)
+        columns.append(valid_columns[has_st])
+
+    inclusion_weights = np.zeros(avhrr_model.shape)
+    if len(strata) == 0:
+        return inclusion_weights
+    strata, rows, columns = [np.concatenate(values) for values in [strata, rows, columns]]
+    inclusion_weights[rows, columns] = subsampling.get_inclusion_weights(
+        strata, random_streams.get_pixel_uniforms(rows, columns))
+    LOG.info("Subsampled %i of %i pixels, in %i strata." % (
+            (inclusion_weights > 0).sum(), len(strata), len(np.unique(strata))))
+    return inclusion_weights
+
+
+def perturb_row_block_scenarios(avhrr_model, sea_ice_fractions, scenarios, buffers,
+                                row_start, row_stop, random_streams=None, ingest_filter=None,
+                                climatology_field=None, skipped_rows=None, convergence=None,
+                                variance_budget=None, memo=None, inclusion_weights=None,
+                                uncertainty_lut=None):
+    """
+    Perturbs all the pixels in the rows at once, for each of the
+    scenarios, (coeff, sigmas) pairs. The rows are read and filtered
+    once, and the standard normal random numbers of the pixels are
+    drawn once, and scaled by the sigmas of each scenario, so that the
+    scenarios differ by the sigmas and coefficients only (common random
+    numbers).
+
+    Only the pixels selected by the ingest filter are perturbed, see
+    read_valid_pixels.
+
+    t_clim is taken from the climatology field, where there is one,
+    and is T11 elsewhere.
+
+    The rows set in skipped_rows, e.g. the scanlines owned by another
+    granule, are not perturbed.
+
+    The random numbers are drawn from the random streams of the granule
+    by the rows and columns of the pixels, see get_random_streams.
+
+    With a convergence, see eustace.convergence.ConvergenceStopping, the
+    pixels are perturbed in batches until their std has converged,
+    instead of by the number of perturbations of the buffers. The number
+    of perturbations of each pixel is in the swath values.
+
+    With a variance budget, see eustace.variance_budget.VarianceBudget,
+    the sums of the variance budget of the block are computed from the
+    the same perturbations.
+
+    With a memo, see eustace.memo.PerturbationMemo, the pixels with the
+    inputs of a pixel of the block perturbed before get its
+    perturbations, and the memo pixels of the pixels, indexes of the
+    pixels of the block, are in the swath values.
+
+    With the inclusion weights of the pixels of the swath, see
+    get_inclusion_weights, only the pixels with a weight are perturbed,
+    and the weights are in the swath values.
+
+    With an uncertainty lut, see eustace.uncertainty_lut.UncertaintyLut,
+    the pixels are not perturbed, and their uncertainty, interpolated
+    from the table, is in the swath values.
+
+    Returns the values of each scenario to insert by
+    Db.insert_perturbed_pixels, apart from the satellite name, followed
+    by the sums of the variance budget, or None without a variance
+    budget, and the rows, columns and algorithm codes of the pixels in
+    the swath, see eustace.gridded_output. None where no pixels are
+    perturbed.
+    """
+    if ingest_filter is None:
+        ingest_filter = eustace.ingest_filter.IngestFilter()
+    if climatology_field is None:
+        climatology_field = models.climatology.T11Climatology()
+    if random_streams is None:
+        random_streams = get_random_streams(avhrr_model)
+
+    selected = None
+    if inclusion_weights is not None:
+        selected = inclusion_weights[row_start:row_stop] > 0
+    pixels = read_valid_pixels(avhrr_model, row_start, row_stop, ingest_filter,
+                               climatology_field, skipped_rows, selected)
+    if pixels is None:
+        return [None] * len(scenarios)
+    (valid, lat, lon, cloudmask, t11_K, t12_K, t37_K, sun_zenith_angle, sat_zenith_angle,
+     t_clim_K) = pixels
+
+    # The random numbers depend on the pixels only, so that the results
+    # are the same, whichever process perturbs the rows, and however
+    # many rows there are in the blocks.
+    rows, columns = np.nonzero(valid)
+    rows += row_start
+    normals = None
+    if len(scenarios) > 1 and convergence is None and uncertainty_lut is None:
+        normals = eustace.random_streams.DrawnNormals(
+            random_streams.for_pixels(rows, columns).get_standard_normals(
+                buffers.number_of_perturbations))
+
+    # The pixels stand for themselves, unless they are subsampled.
+    if inclusion_weights is not None:
+        inclusion_weight = inclusion_weights[row_start:row_stop][valid]
+    else:
+        inclusion_weight = np.ones(len(rows))
+
+    if sea_ice_fractions is not None:
+        sea_ice_fraction = sea_ice_fractions.block(row_start, row_stop)[valid]
+    else:
+        sea_ice_fraction = np.empty(len(rows))
+        sea_ice_fraction.fill(np.NaN)
+    swath_values = dict(
+        t_11=t11_K,
+        t_12=t12_K,
+        sat_zenith_angle=sat_zenith_angle,
+        sun_zenith_angle=sun_zenith_angle,
+        cloudmask=cloudmask,
+        lat=lat,
+        lon=lon,
+        sea_ice_fraction=sea_ice_fraction,
+        inclusion_weight=inclusion_weight
+        )
+
+    return [_perturb_pixels(coeff, sigmas, buffers, swath_values, t37_K, t_clim_K,
+                            random_streams, rows, columns, ingest_filter, convergence,
+                            normals, variance_budget, memo, uncertainty_lut)
+            for coeff, sigmas in scenarios]
+
+
+def _perturb_pixels(coeff, sigmas, buffers, swath_values, t37_K, t_clim_K, random_streams,
+                    rows, columns, ingest_filter, convergence=None, normals=None,
+                    variance_budget=None, memo=None, uncertainty_lut=None):
+    """
+    The perturbations of the valid pixels of a row block, for a
+    scenario of perturb_row_block_scenarios.
+    """
+    t11_K = swath_values["t_11"]
+    t12_K = swath_values["t_12"]
+    sun_zenith_angle = swath_values["sun_zenith_angle"]
+    sat_zenith_angle = swath_values["sat_zenith_angle"]
+
+    # Pick algorithm and calculate the temperature.
+    algorithms = eustace.surface_temperature.select_surface_temperature_algorithms(
+        sun_zenith_angle, t11_K, t37_K)
+    st_truth_K = eustace.surface_temperature.get_surface_temperatures(
+        algorithms, coeff, t11_K, t12_K, t37_K, t_clim_K,
+        sun_zenith_angle, sat_zenith_angle)
+
+    # No need to do more for the pixels, where the output is not a number.
+    has_st = ~np.isnan(st_truth_K) & ingest_filter.algorithm_mask(algorithms)
+    if not has_st.any():
+        return None
+
+    budget_sums = None
+    uncertainty = None
+    memo_pixels = None
+    if uncertainty_lut is not None:
+        # The uncertainty of the pixels is interpolated from the table,
+        # and the pixels are not perturbed.
+        uncertainty = uncertainty_lut.get_uncertainties(t11_K[has_st], t12_K[has_st],
+                                                        t37_K[has_st], t_clim_K[has_st],
+                                                        sun_zenith_angle[has_st],
+                                                        sat_zenith_angle[has_st])
+        pixel_indexes = np.zeros(0, dtype=np.int64)
+        algorithm = np.zeros(0, dtype=np.int8)
+        epsilon_11, epsilon_12, epsilon_37, surface_temp = [np.zeros(0) for i in range(4)]
+        number_of_perturbations = np.zeros(has_st.sum(), dtype=np.int64)
+    elif convergence is not None:
+        (pixel_indexes, algorithm, epsilon_11, epsilon_12, epsilon_37, surface_temp,
+         number_of_perturbations) = eustace.convergence.perturb_until_converged(
+            coeff, buffers, convergence,
+            t11_K[has_st], t12_K[has_st], t37_K[has_st], t_clim_K[has_st],
+            sigmas["sigma_11"], sigmas["sigma_12"], sigmas["sigma_37"],
+            sun_zenith_angle[has_st], sat_zenith_angle[has_st], st_truth_K[has_st],
+            random_streams, rows[has_st], columns[has_st])
+    else:
+        def perturb_pixels(pixels):
+            """
+            Perturbs the pixels, indexes of the valid pixels.
+            """
+            if normals is not None:
+                random_state = normals.select(pixels)
+            else:
+                random_state = random_streams.for_pixels(rows[pixels], columns[pixels])
+            return eustace.perturbation.perturb(coeff, buffers,
+                                                t11_K[pixels],
+                                                t12_K[pixels],
+                                                t37_K[pixels],
+                                                t_clim_K[pixels],
+                                                sigmas["sigma_11"],
+                                                sigmas["sigma_12"],
+                                                sigmas["sigma_37"],
+                                                sun_zenith_angle[pixels],
+                                                sat_zenith_angle[pixels],
+                                                random_state)
+
+        st_pixels = np.nonzero(has_st)[0]
+        if memo is not None:
+            # Only the first pixel of the inputs of the block is
+            # perturbed, and is the memo pixel of the others.
+            keys = eustace.memo.get_keys(t11_K[has_st], t12_K[has_st], t37_K[has_st],
+                                         t_clim_K[has_st], sun_zenith_angle[has_st],
+                                         sat_zenith_angle[has_st])
+            (algorithm, epsilon_11, epsilon_12, epsilon_37, surface_temp,
+             memo_pixels) = memo.perturb(keys, _ALGORITHM_NAMES[algorithms[has_st]],
+                                         lambda indexes: perturb_pixels(st_pixels[indexes]))
+            block = eustace.perturbation.PerturbedBlock(algorithm, epsilon_11, epsilon_12,
+                                                        epsilon_37, None, None, None,
+                                                        surface_temp)
+        else:
+            block = perturb_pixels(st_pixels)
+
+        if variance_budget is not None:
+            budget_sums = variance_budget.get_sums(coeff, sigmas, block, algorithms[has_st],
+                                                   st_truth_K[has_st], t11_K[has_st],
+                                                   t12_K[has_st], t37_K[has_st],
+                                                   t_clim_K[has_st], sun_zenith_angle[has_st],
+                                                   sat_zenith_angle[has_st])
+
+        # The perturbations that are not a number are not inserted.
+        # Indexing copies the values out of the buffers, so the writer
+        # can keep them while the next block is perturbed.
+        has_perturbed_st = ~np.isnan(block.surface_temp)
+        pixel_indexes = np.nonzero(has_perturbed_st)[0]
+        algorithm = block.algorithm[has_perturbed_st]
+        epsilon_11 = block.epsilon_11[has_perturbed_st]
+        epsilon_12 = block.epsilon_12[has_perturbed_st]
+        epsilon_37 = block.epsilon_37[has_perturbed_st]
+        surface_temp = block.surface_temp[has_perturbed_st]
+        number_of_perturbations = np.empty(has_st.sum(), dtype=np.int64)
+        number_of_perturbations.fill(buffers.number_of_perturbations)
+
+    swath_values = dict([(name, values[has_st]) for name, values in swath_values.items()])
+    swath_values["surface_temp"] = st_truth_K[has_st]
+    swath_values["number_of_perturbations"] = number_of_perturbations
+    if uncertainty is not None:
+        swath_values["uncertainty"] = uncertainty
+    if memo_pixels is not None:
+        swath_values["memo_pixel"] = memo_pixels
+    return (swath_values,
+            pixel_indexes,
+            _ALGORITHM_NAMES[algorithm],
+            epsilon_11,
+            epsilon_12,
+            epsilon_37,
+            surface_temp,
+            budget_sums,
+            (rows[has_st], columns[has_st], algorithms[has_st]))
+
+
+def perturb_row_block(avhrr_model, sea_ice_fractions, coeff, sigmas, buffers,
+                      row_start, row_stop, random_streams=None, ingest_filter=None,
+                      climatology_field=None, skipped_rows=None, convergence=None,
+                      variance_budget=None, memo=None, inclusion_weights=None,
+                      uncertainty_lut=None):
+    """
+    Perturbs all the pixels in the rows at once, see
+    perturb_row_block_scenarios.
+
+    Returns the values to insert by Db.insert_perturbed_pixels, apart
+    from the satellite name, followed by the sums of the variance
+    budget, and the pixels in the swath, or None if no pixels are
+    perturbed.
+    """
+    return perturb_row_block_scenarios(avhrr_model, sea_ice_fractions, [(coeff, sigmas)],
+                                       buffers, row_start, row_stop, random_streams,
+                                       ingest_filter, climatology_field, skipped_rows,
+                                       convergence, variance_budget, memo,
+                                       inclusion_weights, uncertainty_lut)[0]
+
+
+def insert_perturbed_row_block(db, avhrr_model, perturbed_values):
+    """
+    Inserts the values from perturb_row_block, and the sums of the
+    variance budget, if any. Returns the number of perturbations
+    inserted.
+    """
+    if perturbed_values is None:
+        return 0
+    swath_values, pixel_indexes = perturbed_values[:2]
+    budget_sums = perturbed_values[7]
+    swath_values["swath_datetime"] = [avhrr_model.swath_datetime] * len(swath_values["lat"])
+    db.insert("insert_perturbed_pixels", str(avhrr_model.satellite_id), *perturbed_values[:7],
+              number_of_rows=len(swath_values["lat"]) + len(pixel_indexes))
+    if budget_sums is not None:
+        db.insert("insert_variance_budget", str(avhrr_model.satellite_id),
+                  get_granule_id(avhrr_model.avhrr_filename), budget_sums)
+    return len(pixel_indexes)
+
+
+def log_progress(row_start, row_stop, total_perturbed_st_count, start_time):
+    """
+    Some diagnostics while running.
+    """
+    LOG.info("ROWS: %i-%i.   total st_count: %i.   total_time: %s.   sts./sec: %f" %
+             (row_start, row_stop, total_perturbed_st_count,
+              str(datetime.datetime.now() - start_time),
+              (total_perturbed_st_count / (datetime.datetime.now() -
+                                           start_time).total_seconds())))
+
+
+def log_block_memory(row_start, row_stop, peak_rss_mb, estimated_bytes):
+    """
+    The peak resident memory of the process while perturbing the block,
+    and the memory of the perturbations of the block, as estimated for
+    the memory budget.
+    """
+    LOG.debug("ROWS: %i-%i.   Peak resident memory: %.1f MB.   Perturbations, estimated: %.1f MB." % (
+            row_start, row_stop, peak_rss_mb, estimated_bytes / 1024.0**2))
+
+
+def insert_perturbed_scenarios(scenarios, avhrr_model, perturbed_values):
+    """
+    Inserts the values of each scenario, from
+    perturb_row_block_scenarios, into the db of the scenario. Returns
+    the number of perturbations inserted.
+    """
+    return sum([insert_perturbed_row_block(db, avhrr_model, values)
+                for (db, coeff, sigmas), values in zip(scenarios, perturbed_values)])
+
+
+def populate_by_row_blocks(db, avhrr_model, sea_ice_fractions, coeff, sigmas,
+                           number_of_perturbations, memory_budget_mb,
+                           random_streams=None, ingest_filter=None,
+                           climatology_field=None, skipped_rows=None, convergence=None,
+                           scenarios=None, variance_budget=None, memo=None,
+                           inclusion_weights=None, uncertainty_lut=None,
+                           gridded_granule=None):
+    """
+    Perturbs the swath a block of rows at a time, with all the pixels
+    in the block perturbed at once. The number of rows in a block is
+    set so that the perturbations fit within the memory budget.
+
+    With a convergence, the number of perturbations is the max number
+    of perturbations of a pixel, and the pixels are perturbed a batch
+    at a time.
+
+    The scenarios, (db, coeff, sigmas), are perturbed from the same read
+    of the rows, and with the same random numbers, see
+    perturb_row_block_scenarios.
+
+    The pixels of the first scenario are also added to the gridded
+    granule, if given, see eustace.gridded_output.GriddedGranule.
+    """
+    scenarios = [(db, coeff, sigmas)] + list(scenarios or [])
+    number_of_rows, number_of_columns = avhrr_model.shape
+    block_rows = eustace.perturbation.rows_per_block(memory_budget_mb * 1024**2,
+                                                     number_of_columns,
+                                                     number_of_perturbations,
+                                                     avhrr_model.dtype,
+                                                     len(scenarios))
+    # The buffers are not larger than the swath needs.
+    block_rows = min(block_rows, number_of_rows)
+    LOG.info("Perturbing %i rows at a time, within %.1f MB." % (block_rows, memory_budget_mb))
+
+    # The buffers are reused for all the blocks.
+    buffers = eustace.perturbation.PerturbationBuffers(block_rows * number_of_columns,
+                                                       get_buffer_perturbations(number_of_perturbations,
+                                                                                convergence),
+                                                       avhrr_model.dtype)
+
+    # Book keeping.
+    total_perturbed_st_count = 0
+    start_time = datetime.datetime.now()
+
+    for row_start, row_stop in eustace.perturbation.row_blocks(number_of_rows, block_rows):
+        log_progress(row_start, row_stop, total_perturbed_st_count, start_time)
+        eustace.perturbation.reset_peak_rss()
+        perturbed_values = perturb_row_block_scenarios(avhrr_model, sea_ice_fractions,
+                                                       [(coeff, sigmas) for db, coeff, sigmas
+                                                        in scenarios],
+                                                       buffers, row_start, row_stop,
+                                                       random_streams, ingest_filter,
+                                                       climatology_field, skipped_rows,
+                                                       convergence, variance_budget, memo,
+                                                       inclusion_weights, uncertainty_lut)
+        number_inserted = insert_perturbed_scenarios(scenarios, avhrr_model, perturbed_values)
+        total_perturbed_st_count += number_inserted
+        if gridded_granule is not None:
+            gridded_granule.add(perturbed_values[0])
+
+        number_of_pixels = 0 if perturbed_values[0] is None else len(perturbed_values[0][0]["lat"])
+        LOG.info("Perturbed %i pixels." % (number_of_pixels))
+        log_block_memory(row_start, row_stop, eustace.perturbation.peak_rss_mb(),
+                         eustace.perturbation.block_peak_bytes(buffers, number_of_pixels,
+                                                               len(scenarios)))
+    if memo is not None:
+        memo.log_statistics()
+    return total_perturbed_st_count
+
+
+# The granule and the settings used by a worker process. The worker
+# attaches to the shared swath of a granule, and reads the settings of
+# the granule, when it is first given rows of the granule.
+_WORKER = {}
+
+# The settings of a granule, in the directory of its shared swath.
+_SETTINGS_FILENAME = "settings.pickle"
+
+
+class PerturbationPool(object):
+    """
+    The worker processes of populate_in_parallel. The processes are
+    started once, and perturb the blocks of rows of all the granules.
+    Start the pool before any threads, e.g. of the prefetcher, the db
+    writers and the work queue, as a process forked while another thread
+    holds a lock, e.g. of a logging handler, would wait for it forever.
+
+    The granules are given to the workers by the directories of their
+    shared swaths, see models.shared_swath, and not by forking.
+    """
+    def __init__(self, number_of_processes=None, memo=None):
+        self.number_of_processes = number_of_processes or mp.cpu_count()
+        self.memo = memo
+        self._pool = mp.Pool(self.number_of_processes, initializer=_init_worker,
+                             initargs=(memo,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def __repr__(self):
+        return "PerturbationPool(%i processes)" % (self.number_of_processes)
+
+    def imap(self, function, items):
+        return self._pool.imap(function, items)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def _init_worker(memo):
+    _WORKER["directory"] = None
+    _WORKER["memo"] = memo
+    if memo is not None:
+        # The counts forked from the parent are counted there already.
+        memo.pop_counts()
+
+
+def _attach_granule(directory):
+    """
+    Attaches the worker to the shared swath in the directory, and reads
+    the settings of the granule, see populate_in_parallel. The buffers
+    are kept for the next granule, if they are of the same size.
+    """
+    with open(os.path.join(directory, _SETTINGS_FILENAME), "rb") as fp:
+        settings = cPickle.load(fp)
+    swath = models.shared_swath.SharedSwath(directory)
+    _WORKER.update(settings)
+    _WORKER["swath"] = swath
+    _WORKER["directory"] = directory
+
+    number_of_pixels = settings["block_rows"] * swath.shape[1]
+    number_of_perturbations = get_buffer_perturbations(settings["number_of_perturbations"],
+                                                       settings["convergence"])
+    buffers = _WORKER.get("buffers")
+    if buffers is None or buffers.number_of_pixels != number_of_pixels or \
+            buffers.number_of_perturbations != number_of_perturbations or \
+            buffers.dtype != np.dtype(settings["dtype"]):
+        _WORKER["buffers"] = None
+        _WORKER["buffers"] = eustace.perturbation.PerturbationBuffers(
+            number_of_pixels, number_of_perturbations, settings["dtype"])
+
+
+def _perturb_row_block_in_worker(rows):
+    directory, row_start, row_stop = rows
+    if _WORKER["directory"] != directory:
+        _attach_granule(directory)
+    eustace.perturbation.reset_peak_rss()
+    swath = _WORKER["swath"]
+    sea_ice_fractions = None
+    if "sea_ice_fractions" in swath:
+        sea_ice_fractions = models.sea_ice_fractions.SeaIceFractions(
+            None, values=swath.sea_ice_fractions)
+    perturbed_values = perturb_row_block_scenarios(swath,
+                                                   sea_ice_fractions,
+                                                   _WORKER["scenarios"],
+                                                   _WORKER["buffers"],
+                                                   row_start, row_stop,
+                                                   _WORKER["random_streams"],
+                                                   _WORKER["ingest_filter"],
+                                                   _WORKER["climatology_field"],
+                                                   swath.skipped_rows if "skipped_rows" in swath else None,
+                                                   _WORKER["convergence"],
+                                                   _WORKER["variance_budget"],
+                                                   _WORKER["memo"],
+                                                   swath.inclusion_weights if "inclusion_weights" in swath else None,
+                                                   _WORKER["uncertainty_lut"])
+    # The counts of the memo of the worker are added up by the parent,
+    # which also logs the memory of the worker perturbing the block.
+    memo_counts = None if _WORKER["memo"] is None else _WORKER["memo"].pop_counts()
+    number_of_pixels = 0 if perturbed_values[0] is None else len(perturbed_values[0][0]["lat"])
+    block_memory = (eustace.perturbation.peak_rss_mb(),
+                    eustace.perturbation.block_peak_bytes(_WORKER["buffers"], number_of_pixels,
+                                                          len(_WORKER["scenarios"])))
+    return row_start, row_stop, perturbed_values, memo_counts, block_memory
+
+
+def populate_in_parallel(db, avhrr_model, sea_ice_fractions, coeff, sigmas,
+                         number_of_perturbations, memory_budget_mb,
+                         number_of_processes=None, random_streams=None, ingest_filter=None,
+                         climatology_field=None, skipped_rows=None, convergence=None,
+                         scenarios=None, variance_budget=None, memo=None,
+                         inclusion_weights=None, uncertainty_lut=None,
+                         gridded_granule=None, pool=None):
+    """
+    Perturbs the blocks of rows in worker processes.
+
+    The swath is put into shared memory once, see models.shared_swath,
+    along with the settings of the granule, and the workers are only
+    given the directory of the swath and the rows to perturb. The
+    workers are those of the pool, if given, see PerturbationPool, or
+    are started for the granule. The memory budget is shared between
+    the workers.
+
+    The results are inserted in the order of the rows. The random
+    numbers only depend on the pixels, so the results are the same as
+    from populate_by_row_blocks, also for the scenarios and the gridded
+    granule, although the blocks have fewer rows.
+    """
+    if pool is None:
+        with PerturbationPool(number_of_processes, memo) as pool:
+            return populate_in_parallel(db, avhrr_model, sea_ice_fractions, coeff, sigmas,
+                                        number_of_perturbations, memory_budget_mb,
+                                        random_streams=random_streams,
+                                        ingest_filter=ingest_filter,
+                                        climatology_field=climatology_field,
+                                        skipped_rows=skipped_rows,
+                                        convergence=convergence,
+                                        scenarios=scenarios,
+                                        variance_budget=variance_budget,
+                                        memo=memo,
+                                        inclusion_weights=inclusion_weights,
+                                        uncertainty_lut=uncertainty_lut,
+                                        gridded_granule=gridded_granule,
+                                        pool=pool)
+    if pool.memo is not memo:
+        raise RuntimeError("The memo must be the memo of the pool.")
+
+    scenarios = [(db, coeff, sigmas)] + list(scenarios or [])
+    number_of_processes = pool.number_of_processes
+    if random_streams is None:
+        random_streams = get_random_streams(avhrr_model)
+    if ingest_filter is None:
+        ingest_filter = eustace.ingest_filter.IngestFilter()
+    if climatology_field is None:
+        climatology_field = models.climatology.T11Climatology()
+
+    number_of_rows, number_of_columns = avhrr_model.shape
+    block_rows = eustace.perturbation.rows_per_block(memory_budget_mb * 1024**2 / number_of_processes,
+                                                     number_of_columns,
+                                                     number_of_perturbations,
+                                                     avhrr_model.dtype,
+                                                     len(scenarios))
+    block_rows = min(block_rows, number_of_rows)
+    LOG.info("Perturbing %i rows at a time in %i processes, within %.1f MB." % (
+            block_rows, number_of_processes, memory_budget_mb))
+
+    extra_arrays = {}
+    if sea_ice_fractions is not None:
+        extra_arrays["sea_ice_fractions"] = sea_ice_fractions.read()
+    if skipped_rows is not None:
+        extra_arrays["skipped_rows"] = skipped_rows
+    if inclusion_weights is not None:
+        extra_arrays["inclusion_weights"] = inclusion_weights
+    shared_swath = models.shared_swath.SharedSwath.from_model(avhrr_model,
+                                                              _SWATH_FIELDS,
+                                                              **extra_arrays)
+
+    # Book keeping.
+    total_perturbed_st_count = 0
+    start_time = datetime.datetime.now()
+
+    try:
+        settings = dict(scenarios=[(coeff, sigmas) for db, coeff, sigmas in scenarios],
+                        number_of_perturbations=number_of_perturbations,
+                        block_rows=block_rows,
+                        dtype=np.dtype(avhrr_model.dtype),
+                        random_streams=random_streams,
+                        ingest_filter=ingest_filter,
+                        climatology_field=climatology_field,
+                        convergence=convergence,
+                        variance_budget=variance_budget,
+                        uncertainty_lut=uncertainty_lut)
+        with open(os.path.join(shared_swath.directory, _SETTINGS_FILENAME), "wb") as fp:
+            cPickle.dump(settings, fp, cPickle.HIGHEST_PROTOCOL)
+
+        # The blocks outside the latitude bands, skipped, or without
+        # pixels in the subsample, are not given to the workers.
+        blocks = [(shared_swath.directory, row_start, row_stop) for row_start, row_stop
+                  in eustace.perturbation.row_blocks(number_of_rows, block_rows)
+                  if ingest_filter.any_in_lat_bands(shared_swath.lat[row_start:row_stop]) and
+                  (skipped_rows is None or not skipped_rows[row_start:row_stop].all()) and
+                  (inclusion_weights is None or inclusion_weights[row_start:row_stop].any())]
+        for row_start, row_stop, perturbed_values, memo_counts, block_memory in pool.imap(
+                _perturb_row_block_in_worker, blocks):
+            log_progress(row_start, row_stop, total_perturbed_st_count, start_time)
+            log_block_memory(row_start, row_stop, *block_memory)
+            if memo_counts is not None:
+                memo.add_counts(memo_counts)
+            total_perturbed_st_count += insert_perturbed_scenarios(scenarios, avhrr_model,
+                                                                   perturbed_values)
+            if gridded_granule is not None:
+                gridded_granule.add(perturbed_values[0])
+    finally:
+        shared_swath.remove()
+    if memo is not None:
+        memo.log_statistics()
+    return total_perturbed_st_count
+
+
+def populate_from_model(database_filename, granule, number_of_perturbations,
+                        run_in_parallel = False, db_writer=None,
+                        memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB,
+                        ingest_filter=None, climatology=None, previous_filenames=None,
+                        sampling="random", convergence=None, scenarios=None,
+                        variance_budget=None, memo=None, subsampling=None,
+                        uncertainty_lut=None, gridded_output_directory=None, pool=None):
+    """
+    Populate the database with perturbed values from a granule loaded
+    by load_granule. The avhrr model is closed when done.
+
+    The values are written by the db_writer, if given, so that the
+    same writer can be used for several granules. Otherwise a writer
+    is opened (and closed) for the database file.
+
+    The swath is perturbed in blocks of rows, using at most
+    memory_budget_mb for the perturbations of the blocks. Only the
+    pixels selected by the ingest filter are perturbed, by default the
+    pixels with cloud mask 1 or 4.
+
+    t_clim is taken from the climatology, if given, and is T11 otherwise.
+
+    If the files of the previous granule of the satellite are given,
+    the scanlines that are also in the previous granule are skipped, and
+    recorded in the database as owned by the previous granule.
+
+    The perturbations of a pixel are sampled by the sampling, see
+    eustace.random_streams.SAMPLINGS.
+
+    With a convergence, see eustace.convergence.ConvergenceStopping, each
+    pixel is perturbed until the std of its perturbed surface
+    temperatures has converged, and number_of_perturbations is the max
+    number of perturbations. The number of perturbations of each pixel
+    is stored with the pixel.
+
+    The scenarios, see get_sweep_scenarios, are populated from the same
+    read of the granule, with the same random numbers, each into its
+    own database file.
+
+    With a variance budget, see eustace.variance_budget.VarianceBudget,
+    the variance of the perturbed surface temperatures by channel is
+    added to the variance_budget table.
+
+    With a memo, see eustace.memo.PerturbationMemo, the pixels with the
+    same inputs as a pixel perturbed before in the same block of rows
+    get its perturbations, and it is stored as their memo pixel. The
+    memo does not reach across blocks, nor granules.
+
+    With a subsampling, see eustace.stratified_subsampling, only a
+    stratified subsample of the pixels of the granule is perturbed, see
+    get_inclusion_weights, and the inclusion weight of each pixel is
+    stored with the pixel. The subsample is picked with the coefficients
+    of the satellite, also for the scenarios.
+
+    With an uncertainty lut, see eustace.uncertainty_lut, of the
+    satellite, the pixels are not perturbed. The uncertainty of each
+    pixel is interpolated from the table, and stored with the pixel.
+
+    With a gridded output directory, the surface temperature, algorithm,
+    uncertainty, number of perturbations, sea ice fraction and inclusion
+    weight of the pixels are also written on the grid of the swath, to
+    an HDF5 file of the granule in the directory, see
+    eustace.gridded_output.
+
+    When run in parallel, the blocks are perturbed by the workers of the
+    pool, if given, see PerturbationPool.
+    """
+    LOG.info("db_filename:                      %s" % (database_filename))
+    avhrr_model, sea_ice_fractions = granule
+    with avhrr_model:
         LOG.info(avhrr_model)
-        assert(avhrr_model.lat.shape == avhrr_model.lon.shape)
-        
+        # The shape also checks that lat and lon are of the same shape.
+        assert(len(avhrr_model.shape) == 2)
+
         # Get the sigma values based on the satellite id.
         sigmas = eustace.sigmas.get_sigmas(avhrr_model.satellite_id)
         LOG.info(sigmas)
 
-        sea_ice_fractions = get_sea_ice_fractions(sea_ice_fraction_data_directory, avhrr_filename)
+        if uncertainty_lut is not None:
+            if uncertainty_lut.satellite_id != str(avhrr_model.satellite_id):
+                raise RuntimeError("The uncertainty lut is of %s, not %s." % (
+                        uncertainty_lut.satellite_id, avhrr_model.satellite_id))
+            if any([uncertainty_lut.sigmas[name] != sigmas[name] for name in uncertainty_lut.sigmas]):
+                LOG.warning("The sigmas of the uncertainty lut, %s, are not the sigmas of %s." % (
+                        uncertainty_lut.sigmas, avhrr_model.satellite_id))
+
         if sea_ice_fractions is not None:
-            assert(avhrr_model.lat.shape == sea_ice_fractions.shape)
+            assert(avhrr_model.shape == sea_ice_fractions.shape)
+
+        # The climatology of the month of the swath.
+        if climatology is None:
+            climatology = models.climatology.T11Climatology()
+        climatology_field = climatology.get_field(avhrr_model.swath_datetime.month)
+
+        # The overlap with the previous granule.
+        owner_rows = None
+        skipped_rows = None
+        if previous_filenames is not None:
+            owner_rows = get_duplicate_scanlines(avhrr_model, previous_filenames)
+            skipped_rows = owner_rows >= 0
 
-        # Some book keeping...
-        total_perturbed_st_count = 0
-        counter = 0
-        
-        # Set the random seed, so that the results are the same
-        # the next time the exact same system is is run.
-        random.seed(1)
+        # The random numbers of the pixels of the granule.
+        random_streams = get_random_streams(avhrr_model, sampling=sampling)
 
-        output_queue = mp.Queue()
-        number_of_cpus = mp.cpu_count()
-        number_of_processes_started = 0
-        number_of_processes_finished = 0
+        # The pixels on the grid of the swath.
+        gridded_granule = None
+        if gridded_output_directory is not None:
+            gridded_granule = eustace.gridded_output.GriddedGranule(avhrr_model.shape)
 
-        # Book keeping.
-        start_time = datetime.datetime.now()
+        # The sigmas of the satellite and the coefficients of each
+        # scenario.
+        scenarios = list(scenarios or [])
+        scenario_sigmas = [eustace.sigmas.get_sigmas(avhrr_model.satellite_id,
+                                                     scenario.sigmas_filename)
+                           for scenario in scenarios]
+        scenario_coefficients = contextlib.nested(*[
+                eustace.coefficients.Coefficients(scenario.satellite_id or avhrr_model.satellite_id)
+                for scenario in scenarios])
+        scenario_writers = contextlib.nested(*[
+                open_db_writer(scenario.database_filename, scenario.db_writer)
+                for scenario in scenarios])
 
         # Using the coefficients based on the satellite id.
-        with eustace.coefficients.Coefficients(avhrr_model.satellite_id) as coeff:
+        with eustace.coefficients.Coefficients(avhrr_model.satellite_id) as coeff, \
+                scenario_coefficients as scenario_coeffs, scenario_writers as scenario_dbs:
+            scenario_values = zip(scenario_dbs, scenario_coeffs, scenario_sigmas)
+
+            # The pixels to perturb, and their weights.
+            inclusion_weights = None
+            if subsampling is not None:
+                inclusion_weights = get_inclusion_weights(avhrr_model, coeff, subsampling,
+                                                          memory_budget_mb, random_streams,
+                                                          ingest_filter, climatology_field,
+                                                          skipped_rows)
+
             ## Using a ram disk speeds up the calculations, quite a lot.
             ## Creating ramdisk:
             # mkdir /tmp/ramdisk
@@ -139,154 +1171,62 @@ def populate_from_files(database_filename, avhrr_filename, sun_sat_angle_filenam
             # mount -t tmpfs -o size=$((12 * 1024))m tmpfs /tmp/ramdisk
             #
             #
-            ## Defining the database.
-            with eustace.db.Db(database_filename) as db:
-                # Rows.
-                for row_index in np.arange(avhrr_model.lon.shape[0]):
-                    # Some diagnostics while running.
-                    LOG.info("ROW: %i.   total st_count: %i.   total_time: %s.   sts./sec: %f" %
-                             (row_index, total_perturbed_st_count,
-                              str(datetime.datetime.now() - start_time),
-                              (total_perturbed_st_count / (datetime.datetime.now() -
-                                                           start_time).total_seconds())))
-
-                    # Cols.
-                    for col_index in np.arange(avhrr_model.lon.shape[1]):
-                        counter += 1
-
-                        # Reading in the values.
-                        cloudmask = avhrr_model.cloudmask[row_index, col_index] 
-                        if cloudmask != 1 and cloudmask != 4:
-                            LOG.debug("Bad cloudmask: %i" % (cloudmask))
-                            continue
-
-                        # T11 is channel 4.
-                        t11_K = avhrr_model.ch4[row_index, col_index]
-
-                        # T12 is channel 5.
-                        t12_K = avhrr_model.ch5[row_index, col_index]
-
-                        # T37 is channel 3b.
-                        t37_K = avhrr_model.ch3b[row_index, col_index]
-
-                        if np.isnan(t11_K) or np.isnan(t12_K):
-                            # t11 and t12 are both needed for all calculations.
-                            # Is something wrong if they are both missing?
-                            # Consider what to do.
-                            raise RuntimeException("Missing T11 or T12")
-
-                        # Angles.
-                        sun_zenith_angle = float(avhrr_model.sun_zenith_angle[row_index, col_index])
-                        sat_zenith_angle = float(avhrr_model.sat_zenith_angle[row_index, col_index])
-
-                        # Missing climatology. Using t11_K in stead.
-                        t_clim_K = t11_K
-
-                        # Lat / lon.
-                        lat = avhrr_model.lat[row_index, col_index]
-                        lon = avhrr_model.lon[row_index, col_index]
-                        if lat is None or np.isnan(lat) or lon is None or np.isnan(lon):
-                            continue
-
-                        # Pick algorithm.
-                        algorithm = eustace.surface_temperature.select_surface_temperature_algorithm(
-                            sun_zenith_angle,
-                            t11_K,
-                            t37_K)
-
-                        # Calculate the temperature.
-                        st_truth_K = eustace.surface_temperature.get_surface_temperature(algorithm,
-                                                                                         coeff,
-                                                                                         t11_K,
-                                                                                         t12_K,
-                                                                                         t37_K,
-                                                                                         t_clim_K,
-                                                                                         sun_zenith_angle,
-                                                                                         sat_zenith_angle)
-
-                        if np.isnan(st_truth_K):
-                            # No need to do more for this pixel, if the output is not a number.
-                            continue
-
-                        if sea_ice_fractions is not None:
-                            if sea_ice_fractions[row_index][col_index] is None or np.isnan(sea_ice_fractions[row_index][col_index]):
-                                sea_ice_fraction = None
-                            else:
-                                sea_ice_fraction = float(sea_ice_fractions[row_index][col_index])
-                        else:
-                            sea_ice_fraction = None
-
-
-                        swath_input_id = db.insert_swath_values(
-                            str(avhrr_model.satellite_id),
-                            surface_temp=st_truth_K, # float(true_st_K),
-                            t_11=float(t11_K),
-                            t_12=float(t12_K),
-                            sat_zenith_angle=sat_zenith_angle,
-                            sun_zenith_angle=sun_zenith_angle,
-                            cloudmask=int(avhrr_model.cloudmask[row_index, col_index]),
-                            swath_datetime=avhrr_model.swath_datetime,
-                            lat=float(lat),
-                            lon=float(lon),
-                            sea_ice_fraction=sea_ice_fraction
-                            )
-
-
-                        if not run_in_parallel:
-                            # WARNING!
-                            # If the number of perturbations is a small number, it is much faster
-                            # to run sequencially!!
-                            perturbations = eustace.surface_temperature.get_n_perturbed_temeratures(coeff,
-                                                                                                    number_of_perturbations,
-                                                                                                    t11_K,
-                                                                                                    t12_K,
-                                                                                                    t37_K,
-                                                                                                    t_clim_K,
-                                                                                                    sigmas["sigma_11"],
-                                                                                                    sigmas["sigma_12"],
-                                                                                                    sigmas["sigma_37"],
-                                                                                                    sun_zenith_angle,
-                                                                                                    sat_zenith_angle,
-                                                                                                    random_seed=counter)
-                            num_inserted = db.insert_many_perturbations(swath_input_id, perturbations)
-                            total_perturbed_st_count += num_inserted
-
-                        else:
-                            # This starts a process running a number of perturbations
-                            # and inserts the result in the in the output queue.
-                            perturbate_in_parallel(output_queue,
-                                                   swath_input_id,
-                                                   coeff,
-                                                   number_of_perturbations,
-                                                   t11_K,
-                                                   t12_K,
-                                                   t37_K,
-                                                   t_clim_K,
-                                                   sigmas["sigma_11"],
-                                                   sigmas["sigma_12"],
-                                                   sigmas["sigma_37"],
-                                                   sun_zenith_angle,
-                                                   sat_zenith_angle,
-                                                   random_seed=counter)
-                            number_of_processes_started += 1
-
-                            if number_of_processes_started > number_of_cpus:
-                                # Get will wait forever, for the process to finish.
-                                swath_input_id, perturbations = output_queue.get()
-                                number_of_processes_finished += 1
-                                num_inserted = db.insert_many_perturbations(swath_input_id, perturbations)
-                                total_perturbed_st_count += num_inserted
-
+            ## Defining the database. The values are committed by the
+            ## writer in the background, while the perturbations go on.
+            with open_db_writer(database_filename, db_writer) as db:
+                if skipped_rows is not None and skipped_rows.any():
+                    for scenario_db in [db] + list(scenario_dbs):
+                        scenario_db.insert("insert_duplicate_scanlines",
+                                           str(avhrr_model.satellite_id),
+                                           get_granule_id(avhrr_model.avhrr_filename),
+                                           np.nonzero(skipped_rows)[0],
+                                           get_granule_id(previous_filenames[0]),
+                                           owner_rows[skipped_rows],
+                                           number_of_rows=int(skipped_rows.sum()))
 
                 if run_in_parallel:
-                    while number_of_processes_started > number_of_processes_finished:
-                        swath_input_id, perturbations = output_queue.get()
-                        number_of_processes_finished += 1
-                        db.insert_many_perturbations(swath_input_id, perturbations)
+                    populate_in_parallel(db, avhrr_model, sea_ice_fractions,
+                                         coeff, sigmas, number_of_perturbations,
+                                         memory_budget_mb,
+                                         random_streams=random_streams,
+                                         ingest_filter=ingest_filter,
+                                         climatology_field=climatology_field,
+                                         skipped_rows=skipped_rows,
+                                         convergence=convergence,
+                                         scenarios=scenario_values,
+                                         variance_budget=variance_budget,
+                                         memo=memo,
+                                         inclusion_weights=inclusion_weights,
+                                         uncertainty_lut=uncertainty_lut,
+                                         gridded_granule=gridded_granule,
+                                         pool=pool)
+                else:
+                    populate_by_row_blocks(db, avhrr_model, sea_ice_fractions,
+                                           coeff, sigmas, number_of_perturbations,
+                                           memory_budget_mb,
+                                           random_streams=random_streams,
+                                           ingest_filter=ingest_filter,
+                                           climatology_field=climatology_field,
+                                           skipped_rows=skipped_rows,
+                                           convergence=convergence,
+                                           scenarios=scenario_values,
+                                           variance_budget=variance_budget,
+                                           memo=memo,
+                                           inclusion_weights=inclusion_weights,
+                                           uncertainty_lut=uncertainty_lut,
+                                           gridded_granule=gridded_granule)
+
+                if gridded_granule is not None:
+                    granule_id = get_granule_id(avhrr_model.avhrr_filename)
+                    gridded_granule.write(
+                        eustace.gridded_output.get_gridded_filename(gridded_output_directory,
+                                                                    granule_id),
+                        satellite_id=str(avhrr_model.satellite_id),
+                        granule_id=granule_id,
+                        swath_datetime=avhrr_model.swath_datetime.strftime("%Y-%m-%dT%H:%M:%S"))
 
                 # FIN.
                 LOG.info("Finished perturbing '%s'." % (avhrr_model.avhrr_filename))
-                    
 
 
 if __name__ == "__main__":
@@ -305,9 +1245,85 @@ Options:
   -v --verbose                             Show some diagostics.
   -d --debug                               Show some more diagostics.
   --number-of-perturbations=<NoP>          The number of perturbations per pixel, [default: 10].
-  --result-directory=<directory>           Put the result (the database file) into this directory if set.
-  --perturbate-in-parallel                 Running the perturbations in parallel.
+  --adaptive-precision=<relative>          Perturb each pixel in batches, until the relative standard error of the std
+                                           of its perturbed surface temperatures is at most this, e.g. 0.1. The
+                                           number of perturbations is then the max number per pixel.
+  --min-perturbations=<N>                  The number of perturbations in a batch, and the least number of
+                                           perturbations of a pixel, with --adaptive-precision, [default: 8].
+  --result-directory=<directory>           Put the result (the database files, also of the sweeps) into this
+                                           directory if set.
+  --perturbate-in-parallel                 Perturbing the blocks of rows in parallel processes.
   --sea-ice-fraction-data-directory=<dir>  The sea ice fraction data directory.
+  --prefetch=<granules>                    The number of granules to read in the background, while
+                                           perturbing the current one. 0 reads them one at a time, [default: 1].
+  --prefetch-threads=<threads>             The number of threads reading the granules, [default: 1].
+  --db-batch-size=<rows>                   The number of rows (pixels and perturbations) committed to the database
+                                           at a time. The rows of a block are handed to the writer, as soon as
+                                           there are this many, [default: 100000].
+  --memory-budget=<MB>                     The memory used for perturbing a block of rows. The number of rows
+                                           in a block depends on this, the number of perturbations and the
+                                           number of scenarios of a sweep, as the values of each scenario, and
+                                           the random numbers shared by the scenarios, are held along with the
+                                           block, [default: 1024].
+  --read-cache=<MB>                        The memory used for the values read from a granule. Values that do not
+                                           fit are read a block of rows at a time, [default: 512].
+  --dtype=<dtype>                          The type the temperatures and angles are decoded to, float32 or float64.
+                                           float32 halves the memory, changing the surface temperatures
+                                           by less than ~2e-4 K, [default: float32].
+  --sampling=<sampling>                    The sampling of the perturbations of a pixel, random, lhs (a Latin
+                                           hypercube) or sobol (a scrambled Sobol sequence). The stratified
+                                           samplings need fewer perturbations, see benchmark_sampling.py,
+                                           [default: random].
+  --sweep-sigmas=<filenames>               Also populate with the sigmas of these NEdT files (comma separated), each
+                                           into its own database file, see get_sweep_scenarios. The scenarios are
+                                           perturbed from the same read, with the same random numbers.
+  --sweep-coefficients=<satellite-ids>     Also populate with the coefficients of these satellites, e.g. noaa17,noaa19,
+                                           for each of the sigmas.
+  --variance-budget                        Also retrieve the surface temperatures with the noise of one channel at a
+                                           time, from the same random numbers, and the partial derivatives, and add
+                                           the variance by algorithm and channel to the variance_budget table, see
+                                           create_variance_budget_table.py. Not with --subsample or --memo, whose
+                                           weights are not in the sums.
+  --memo                                   Reuse the perturbations of a pixel for the pixels of the block of rows
+                                           with the same t11, t12, t37, t_clim and angles. The pixel perturbed is
+                                           stored with the others, as their memo pixel, so that the statistics can
+                                           count the independent values. The blocks depend on the memory budget
+                                           and, when perturbing in parallel, the number of processes. The hit
+                                           rates are logged (-v).
+  --subsample=<pixels>                     Only perturb a stratified subsample of the pixels of each granule, of at
+                                           most this many pixels per algorithm, sun and sat zenith angle, lat and
+                                           t11 - t12 bin, see eustace/stratified_subsampling.py. The inclusion
+                                           weights of the pixels are stored, and used by the statistics.
+  --uncertainty-lut=<filename>             Do not perturb the pixels, but interpolate their uncertainty from the table
+                                           of the satellite, see create_uncertainty_lut.py, which is stored with
+                                           the pixels.
+  --gridded-output=<directory>             Also write the surface temperature, algorithm, uncertainty (the std of the
+                                           perturbations, or from --uncertainty-lut), number of perturbations, sea
+                                           ice fraction and inclusion weight of the pixels of each granule, on the
+                                           grid of the swath, to a compressed HDF5 file of the granule in this
+                                           directory, see eustace/gridded_output.py.
+  --backend=<backend>                      The perturbed surface temperatures are retrieved by a kernel compiled
+                                           with numba (numba), or with NumPy (numpy). auto uses numba if it is
+                                           installed, [default: auto].
+  --keep-overlapping-scanlines             Populate the scanlines that are also in the previous granule. By default
+                                           they are skipped, and recorded in the duplicate_scanlines table.
+  --granule-cache=<directory>              Read the granules from decoded copies in this directory, which are
+                                           memory mapped. Granules not in the directory are converted first.
+  --climatology=<filename>                 A netCDF file with a gridded (monthly) SST climatology, used for t_clim.
+                                           Without it, t_clim is set to T11.
+  --lat-lt=<lat>                           Only ingest the pixels with lats less than, or greater than
+  --lat-gt=<lat>                           --lat-gt if set. Rows outside are not read.
+  --cloudmask=<classes>                    Only ingest the pixels with these cloud mask classes, [default: 1,4].
+  --t11-gt=<K>                             Only ingest the pixels with T11 greater than.
+  --t11-lt=<K>                             Only ingest the pixels with T11 less than.
+  --algorithm=<algorithms>                 Only ingest the pixels retrieved by these algorithms, e.g. SST,IST.
+                                           The start of a name selects all the matching ones, e.g. SST or MIZT.
+  --work-queue=<directory>                 Share the granules with workers on other nodes, through a queue in this
+                                           directory on a shared file system. Each worker writes to its own database,
+                                           <database-filename> with the worker id added.
+  --worker-id=<id>                         The id of the worker in the work queue. Defaults to <host>-<pid>.
+  --lease-seconds=<seconds>                A granule not renewed by its worker within this time is given to
+                                           another worker, [default: 600].
 """.format(filename=__file__)
     args = docopt.docopt(__doc__, version='0.1')
     if args["--debug"]:
@@ -328,6 +1344,61 @@ Options:
         raise RuntimeError("The sea ice fraction data directory '%s' must exist." %\
                                (args["--result-directory"]))
 
+    if args["--granule-cache"] is not None and \
+            not os.path.isdir(args["--granule-cache"]):
+        raise RuntimeError("The granule cache directory '%s' must exist." % args["--granule-cache"])
+
+    if args["--gridded-output"] is not None and \
+            not os.path.isdir(args["--gridded-output"]):
+        raise RuntimeError("The gridded output directory '%s' must exist." % args["--gridded-output"])
+
+    eustace.kernels.set_backend(args["--backend"])
+
+    if args["--sampling"] not in eustace.random_streams.SAMPLINGS:
+        raise RuntimeError("The sampling must be one of '%s', not '%s'." % (
+                "', '".join(eustace.random_streams.SAMPLINGS), args["--sampling"]))
+
+    # The perturbations of the pixels stop when their std has converged.
+    convergence = None
+    if args["--adaptive-precision"] is not None:
+        if args["--sampling"] == "lhs":
+            raise RuntimeError("The lhs sampling can not be used with --adaptive-precision.")
+        convergence = eustace.convergence.ConvergenceStopping(float(args["--adaptive-precision"]),
+                                                              int(args["--min-perturbations"]),
+                                                              int(args["--number-of-perturbations"]))
+        LOG.info(convergence)
+
+    # The variance by channel.
+    variance_budget = None
+    if args["--variance-budget"]:
+        if convergence is not None or args["--subsample"] is not None or args["--memo"]:
+            raise RuntimeError("The variance budget can not be used with --adaptive-precision, "
+                               "--subsample or --memo.")
+        variance_budget = eustace.variance_budget.VarianceBudget()
+
+    # Only a subsample of the pixels is perturbed.
+    subsampling = None
+    if args["--subsample"] is not None:
+        subsampling = eustace.stratified_subsampling.StratifiedSubsampling(int(args["--subsample"]))
+        LOG.info(subsampling)
+
+    # The uncertainty is interpolated from the table, instead of perturbing.
+    uncertainty_lut = None
+    if args["--uncertainty-lut"] is not None:
+        if convergence is not None or variance_budget is not None or \
+                args["--sweep-sigmas"] is not None or args["--sweep-coefficients"] is not None:
+            raise RuntimeError("The uncertainty lut can not be used with --adaptive-precision, "
+                               "--variance-budget or the sweeps.")
+        uncertainty_lut = eustace.uncertainty_lut.UncertaintyLut.load(args["--uncertainty-lut"])
+        LOG.info(uncertainty_lut)
+
+    # The perturbations of the pixels with the same inputs are reused.
+    memo = None
+    if args["--memo"]:
+        if convergence is not None:
+            raise RuntimeError("The memo can not be used with --adaptive-precision.")
+        memo = eustace.memo.PerturbationMemo()
+
     # There are two options to populate the database,
     # 1. by <satellite-id> or
     # 2. by specifying the file names.
@@ -342,29 +1413,180 @@ Options:
         # Getting all avhrr files with satellite id in name from data directory.
         avhrr_files = glob.glob(os.path.join(args["<data-directory>"], "*%s*avhrr*" % (args["<satellite-id>"])))
         if len(avhrr_files) == 0:
-            raise RuntimeException("No %s files in %s." % (args["<satellite-id>"], args["<data-directory>"]))
-
-        for avhrr_filename in avhrr_files:
-            file_id = avhrr_filename.rsplit("_", 1)[0]
-            cloudmask_filename = "%s_cloudmask.h5" % file_id
-            sunsatangle_filename = "%s_sunsatangles.h5" % file_id
-            populate_from_files(args["<database-filename>"],
-                                avhrr_filename,
-                                sunsatangle_filename,
-                                cloudmask_filename,
-                                args["--sea-ice-fraction-data-directory"],
-                                int(args["--number-of-perturbations"]),
-                                args["--perturbate-in-parallel"]
-                                )
+            raise RuntimeError("No %s files in %s." % (args["<satellite-id>"], args["<data-directory>"]))
+
+        granule_filenames = [get_granule_filenames(avhrr_filename)
+                             for avhrr_filename in sorted(avhrr_files)]
     else:
         # Option 2: By specifying the filenames.
-        populate_from_files(args["<database-filename>"],
-                            args["<avhrr-filename>"],
-                            args["<sunsatangle-filename>"],
-                            args["<cloudmask-filename>"],
+        granule_filenames = [(args["<avhrr-filename>"],
+                              args["<sunsatangle-filename>"],
+                              args["<cloudmask-filename>"]),]
+
+    # The pixels to ingest.
+    ingest_filter = eustace.ingest_filter.IngestFilter(
+        lat_less_than=None if args["--lat-lt"] is None else float(args["--lat-lt"]),
+        lat_greater_than=None if args["--lat-gt"] is None else float(args["--lat-gt"]),
+        cloudmask_classes=[int(c) for c in args["--cloudmask"].split(",")],
+        t11_greater_than=None if args["--t11-gt"] is None else float(args["--t11-gt"]),
+        t11_less_than=None if args["--t11-lt"] is None else float(args["--t11-lt"]),
+        algorithms=None if args["--algorithm"] is None else args["--algorithm"].split(","))
+    LOG.info(ingest_filter)
+
+    # The climatology is read once, for all the granules.
+    climatology = models.climatology.get_climatology(args["--climatology"])
+
+    # The previous granule of each granule, for finding the scanlines
+    # that are in both, where the orbits overlap.
+    previous_granules = {}
+    if not args["--keep-overlapping-scanlines"]:
+        for previous_filenames, filenames in zip(granule_filenames[:-1], granule_filenames[1:]):
+            previous_granules[filenames[0]] = previous_filenames
+
+    database_filename = args["<database-filename>"]
+    work_queue = None
+    if args["--work-queue"] is not None:
+        # The granules are shared with the workers on the other nodes,
+        # through the queue. Each worker writes to its own database file
+        # (shard), so that no database file is written by two nodes.
+        work_queue = eustace.work_queue.WorkQueue(args["--work-queue"],
+                                                  worker_id=args["--worker-id"],
+                                                  lease_seconds=float(args["--lease-seconds"]))
+        work_queue.add([filenames[0] for filenames in granule_filenames])
+        database_filename = eustace.work_queue.shard_filename(database_filename,
+                                                              work_queue.worker_id)
+        LOG.info("%s writes to '%s'." % (work_queue, database_filename))
+
+        # The granules are claimed one at a time, when there is room to
+        # read them, so that a worker does not hold more than it works on.
+        known_filenames = dict([(filenames[0], filenames) for filenames in granule_filenames])
+        granule_filenames = (known_filenames.get(avhrr_filename,
+                                                 get_granule_filenames(avhrr_filename))
+                             for avhrr_filename in work_queue.granules())
+
+    # The scenarios of a sweep, populated along with the database file.
+    scenarios = get_sweep_scenarios(
+        database_filename,
+        None if args["--sweep-sigmas"] is None else args["--sweep-sigmas"].split(","),
+        None if args["--sweep-coefficients"] is None else args["--sweep-coefficients"].split(","))
+    for scenario in scenarios:
+        LOG.info("Also populating '%s', with the sigmas of '%s' and the coefficients of %s." % (
+                scenario.database_filename, scenario.sigmas_filename,
+                scenario.satellite_id or "the satellite"))
+
+    def load(filenames):
+        return load_granule(filenames,
                             args["--sea-ice-fraction-data-directory"],
-                            int(args["--number-of-perturbations"]),
-                            args["--perturbate-in-parallel"])
+                            float(args["--read-cache"]),
+                            args["--dtype"],
+                            args["--granule-cache"])
+
+    def drop_granule(granule_values):
+        """
+        Deletes the values of the granule from the database files of
+        the worker, when it releases the granule, or lost its lease, so
+        that only the worker completing the granule has its values.
+        """
+        for writer in [db_writer] + list(scenario_writers):
+            writer.insert("delete_granule", *granule_values)
+            writer.flush()
+
+    def populate_granule(filenames, granule=None):
+        """
+        Populates from the granule, and waits for its values to be
+        committed, so that the values of no more than one granule are
+        held by the writers. Marks the granule as done in the work
+        queue, when the values are committed.
+        """
+        granule_values = None
+        try:
+            if granule is None:
+                granule = load(filenames)
+            # The satellite, datetime and id of the values of the
+            # granule in the database files.
+            avhrr_model = granule[0]
+            granule_values = (str(avhrr_model.satellite_id), avhrr_model.swath_datetime,
+                              get_granule_id(avhrr_model.avhrr_filename))
+            populate_from_model(database_filename,
+                                granule,
+                                int(args["--number-of-perturbations"]),
+                                args["--perturbate-in-parallel"],
+                                db_writer=db_writer,
+                                memory_budget_mb=float(args["--memory-budget"]),
+                                ingest_filter=ingest_filter,
+                                climatology=climatology,
+                                previous_filenames=previous_granules.get(filenames[0]),
+                                sampling=args["--sampling"],
+                                convergence=convergence,
+                                scenarios=scenarios,
+                                variance_budget=variance_budget,
+                                memo=memo,
+                                subsampling=subsampling,
+                                uncertainty_lut=uncertainty_lut,
+                                gridded_output_directory=args["--gridded-output"],
+                                pool=pool)
+            for writer in [db_writer] + list(scenario_writers):
+                writer.flush()
+            if work_queue is not None:
+                if not work_queue.complete(filenames[0]):
+                    drop_granule(granule_values)
+        except:
+            if work_queue is not None:
+                work_queue.release(filenames[0])
+                if granule_values is not None:
+                    # Do not hide the original exception.
+                    try:
+                        drop_granule(granule_values)
+                    except Exception:
+                        LOG.exception("Could not delete the values of %s." % (granule_values[2]))
+            raise
+
+    # Reading the next granule(s) in the background, while the current
+    # one is perturbed, hides the time spent waiting for the file system.
+    # The same writer is used for all the granules, so that the database
+    # is written in the background, also between the granules.
+    look_ahead = int(args["--prefetch"])
+
+    # The worker processes are started before any of the threads, see
+    # PerturbationPool.
+    pool = None
+    if args["--perturbate-in-parallel"]:
+        pool = PerturbationPool(memo=memo)
+        LOG.info(pool)
+    try:
+        with eustace.db.DbWriter(database_filename,
+                                 batch_size=int(args["--db-batch-size"]),
+                                 max_queued_batches=_DB_QUEUED_BATCHES) as db_writer, \
+                contextlib.nested(*[eustace.db.DbWriter(scenario.database_filename,
+                                                        batch_size=int(args["--db-batch-size"]),
+                                                        max_queued_batches=_DB_QUEUED_BATCHES)
+                                    for scenario in scenarios]) as scenario_writers:
+            scenarios = [scenario._replace(db_writer=writer)
+                         for scenario, writer in zip(scenarios, scenario_writers)]
+            if look_ahead > 0:
+                with models.prefetch.Prefetcher(load, granule_filenames,
+                                                look_ahead=look_ahead,
+                                                number_of_threads=int(args["--prefetch-threads"]),
+                                                release=release_granule) as prefetcher:
+                    for filenames, granule in prefetcher:
+                        LOG.info("Populating from %s." % (", ".join(filenames)))
+                        populate_granule(filenames, granule)
+            else:
+                for filenames in granule_filenames:
+                    LOG.info("Populating from %s." % (", ".join(filenames)))
+                    populate_granule(filenames)
+    except:
+        if pool is not None:
+            pool.terminate()
+            pool = None
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+        # Granules claimed, but not populated (e.g. prefetched when
+        # failing), are requeued when their leases expire.
+        if work_queue is not None:
+            work_queue.close()
 
     # The population actually gets slower when the perturbations run in parallel.
     # This of course depends on hardware, but it may be quicker to run it serially.
@@ -373,17 +1595,20 @@ Options:
             int(args["--number-of-perturbations"]) < 50:
         LOG.warning("--perturbate-in-parallel may be slower for small number of perturbations. Make sure that it is actually beneficial! E.g. run a test with the option flag -v set to se the number of perturbations inserted into the database.")
 
-    # Put the result (the database file) into this directory if set.
-    # When using a RAM disk, it often gets filled up. Therefore the database file
-    # can be moved to a more permanent storage when finished.
+    # Put the result (the database files, of the scenarios too) into this
+    # directory if set. When using a RAM disk, it often gets filled up.
+    # Therefore the database files can be moved to a more permanent
+    # storage when finished.
     if args["--result-directory"] is not None:
-        LOG.info("Moving database '%s' filename to '%s'." % (args["<database-filename>"],
-                                                             args["--result-directory"]))
         if not os.path.isdir(args["--result-directory"]):
-            raise RuntimeException("%s does not exist." % args["--result-directory"])
+            raise RuntimeError("%s does not exist." % args["--result-directory"])
 
-        output_filename = os.path.join(args["--result-directory"],
-                                       os.path.basename(arg["<database-filename>"]))
-        os.rename(arg["<database-filename>"], output_filename)
-        LOG.info("The database file '%s' was moved to '%s'." % (arg["<database-filename>"],
-                                                                output_filename))
+        for filename in [database_filename] + [scenario.database_filename
+                                               for scenario in scenarios]:
+            LOG.info("Moving database '%s' filename to '%s'." % (filename,
+                                                                 args["--result-directory"]))
+            output_filename = os.path.join(args["--result-directory"],
+                                           os.path.basename(filename))
+            shutil.move(filename, output_filename)
+            LOG.info("The database file '%s' was moved to '%s'." % (filename,
+                                                                    output_filename))
@@ -5,6 +5,7 @@ import matplotlib.gridspec
 import pylab
 import eustace.db
 import eustace.surface_temperature
+import eustace.stratified_subsampling
 import numpy as np
 import logging
 import datetime
@@ -85,7 +86,22 @@ def randomly_prune(x_array, y_array, fraction_to_keep):
         LOG.debug("Took: %s" % (str(datetime.datetime.now() - t)))
         return x_array_pruned, y_array_pruned
 
-def get_x_stats(x_array, y_array, x_interval_centers, offset):
+def get_weighted_stats(y_array, weights=None):
+    """
+    The weighted average and standard deviation, see
+    eustace.stratified_subsampling.get_weights. Without weights, the
+    values weigh the same. The values without weight are left out, and
+    without any values left, both are NaN.
+    """
+    if weights is not None:
+        y_array = y_array[weights > 0]
+        weights = weights[weights > 0]
+    if len(y_array) == 0:
+        return np.NaN, np.NaN
+    average = np.average(y_array, weights=weights)
+    return average, np.sqrt(np.average((y_array - average)**2, weights=weights))
+
+def get_x_stats(x_array, y_array, x_interval_centers, offset, weights=None):
     assert(len(x_array) == len(y_array))
     
     # Time it...
@@ -111,8 +127,10 @@ def get_x_stats(x_array, y_array, x_interval_centers, offset):
             averages.append(np.NaN)
             standard_deviations.append(np.NaN)
         else:
-            averages.append(np.average(y_array[x_mask]))
-            standard_deviations.append(np.std(y_array[x_mask]))
+            average, standard_deviation = get_weighted_stats(
+                y_array[x_mask], None if weights is None else weights[x_mask])
+            averages.append(average)
+            standard_deviations.append(standard_deviation)
 
     LOG.debug("get_x_stats took: %s" % (str(datetime.datetime.now() - t)))
     return np.array(averages), np.array(standard_deviations)
@@ -219,6 +237,12 @@ Example:
     for variable in variable_names:
         x_arrays[variable]=[]
 
+    # The number of perturbations and the inclusion weight of the pixel
+    # of each perturbation, for the weighted statistics.
+    weight_variables = ["s.number_of_perturbations", "s.inclusion_weight"]
+    numbers_of_perturbations = []
+    inclusion_weights = []
+
     random.seed(1)
 
     LOG.debug("Get the values from the database.")
@@ -230,13 +254,15 @@ Example:
                                        tb_11_minus_tb_12_limit=args["--t11-t12-limit"],
                                        algorithm=args["--algorithm"])
         # Get the values.
-        for row in db.get_perturbed_values(variable_names,
+        for row in db.get_perturbed_values(variable_names + weight_variables,
                                            lat_less_than=args["--lat-lt"],
                                            lat_greater_than=args["--lat-gt"],
                                            tb_11_minus_tb_12_limit=args["--t11-t12-limit"],
                                            algorithm=args["--algorithm"],
                                            limit=limit):
             y_array.append(row[0])
+            numbers_of_perturbations.append(row[-2])
+            inclusion_weights.append(row[-1])
             for i in range(len(variable_names)):
                 if row[i + 1] == None:
                     x_arrays[variable_names[i]].append(np.NaN)
@@ -246,10 +272,11 @@ Example:
 
     LOG.info("%i samples" %(len(y_array)))
     y_array = np.array(y_array)
+    weights = eustace.stratified_subsampling.get_weights(numbers_of_perturbations,
+                                                         inclusion_weights)
 
     y_array_is_not_nan = y_array[~np.isnan(y_array)]
-    average_all = np.average(y_array_is_not_nan)
-    std_all = np.std(y_array_is_not_nan)
+    average_all, std_all = get_weighted_stats(y_array_is_not_nan, weights[~np.isnan(y_array)])
     y_array_length = len(y_array)
     number_of_points_wished_in_plot = 5e5
     y_range_min, y_range_max = float(args["--y-min"]), float(args["--y-max"])
@@ -310,7 +337,7 @@ Example:
         LOG.debug("Getting stats.")
         t = datetime.datetime.now()  # Diagnostics.
         averages, standard_deviations = get_x_stats(x_array, y_array,
-                                                    x_interval_centers, x_offset)
+                                                    x_interval_centers, x_offset, weights)
         LOG.debug("Took: %s" % (str(datetime.datetime.now() - t)))
 
         # Getting x-axis ranges. It just adds a little on the edges.